@@ -0,0 +1,170 @@
+from __future__ import absolute_import
+
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+
+import numpy
+import six
+
+if six.PY3:
+    from typing import Any, Dict  # noqa: F401 (used for typing)
+
+from .commands import Command
+
+
+class ResultCache(object):
+    """
+    Stores command results on disk between runs, keyed by a hash of everything a result depends on: the command class,
+    its cleaned arguments, the keys of the results it uses, and the path, modification time, and size of any files it
+    reads (or of every file in any directory it reads). If ``max_size`` (in bytes) is given, the least recently used
+    results are removed to stay within it.
+    """
+
+    def __init__(self, directory, max_size=None):
+        # type: (str, int) -> None
+
+        from . import __version__
+
+        self.directory = directory
+        self.max_size = max_size
+        self.version = __version__
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def fingerprint(self, value):
+        # type: (Any) -> Any
+        """ Returns a representation of an argument value to hash, or ``None`` if the value can't be cached. """
+
+        if isinstance(value, Command):
+            return ("result", value.cache_key) if value.cache_key is not None else None
+
+        if isinstance(value, (list, tuple)):
+            items = [self.fingerprint(item) for item in value]
+            return None if any(item is None for item in items) else tuple(items)
+
+        if isinstance(value, dict):
+            items = [(k, self.fingerprint(v)) for k, v in sorted(value.items())]
+            return None if any(item is None for _, item in items) else tuple(items)
+
+        if isinstance(value, numpy.ndarray):
+            return ("array", value.dtype.str, value.shape, hashlib.sha256(value.tobytes()).hexdigest())
+
+        if isinstance(value, type):
+            return ("type", value.__module__, value.__name__)
+
+        if isinstance(value, six.string_types) and os.path.isfile(value):
+            stat = os.stat(value)
+            return ("file", value, stat.st_mtime_ns, stat.st_size)
+
+        if isinstance(value, six.string_types) and os.path.isdir(value):
+            # Datasets stored as directories (e.g., NumPy datasets) change when any of their files do
+            files = []
+            for root, dirs, names in os.walk(value):
+                dirs.sort()
+                for name in sorted(names):
+                    stat = os.stat(os.path.join(root, name))
+                    files.append((os.path.relpath(os.path.join(root, name), value), stat.st_mtime_ns, stat.st_size))
+
+            return ("directory", value, tuple(files))
+
+        return (type(value).__name__, repr(value))
+
+    def get_key(self, command, params):
+        # type: (Command, Dict[str, Any]) -> str
+        """ Returns the key of a command's result, or ``None`` if it can't be cached. """
+
+        arguments = self.fingerprint({name: value for name, value in params.items() if name != "Metadata"})
+        if arguments is None:
+            return None
+
+        cls = type(command)
+        description = (self.version, cls.__module__, cls.__name__, arguments, repr(command.window))
+
+        return hashlib.sha256(repr(description).encode("utf-8")).hexdigest()
+
+    def get_path(self, key):
+        # type: (str) -> str
+
+        return os.path.join(self.directory, "{}.pickle".format(key))
+
+    def load(self, key):
+        # type: (str) -> Any
+        """ Returns a cached result. Raises ``KeyError`` if it isn't cached (or can't be read). """
+
+        path = self.get_path(key)
+
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            raise KeyError(key)
+
+        # Mark the result as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return value
+
+    def store(self, key, value):
+        # type: (str, Any) -> None
+        """ Adds a result to the cache, then removes the least recently used results if the cache is too large. """
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.get_path(key))
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def evict(self, max_size):
+        # type: (int) -> None
+        """ Removes the least recently used results until the cache is no larger than ``max_size`` bytes. """
+
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".pickle"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+
+            for _, size, path in sorted(entries):
+                if total <= max_size:
+                    break
+
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+    def clear(self):
+        """ Removes every cached result. """
+
+        self.evict(0)
@@ -6,11 +6,61 @@ import sys
 import click
 import six
 
+from ..cache import ResultCache
 from ..exceptions import MPilotError, ProgramError
-from ..program import Program, EEMS_CSV_LIBRARIES, EEMS_NETCDF_LIBRARIES
+from ..executors import ProcessExecutor
+from ..program import Program, EEMS_CSV_LIBRARIES, EEMS_NETCDF_LIBRARIES, EEMS_NPY_LIBRARIES
+from ..utils import parse_size
 
 LINE_CONTEX_LENGTH = 3
 
+LIBRARIES = {
+    "eems-csv": EEMS_CSV_LIBRARIES,
+    "eems-netcdf": EEMS_NETCDF_LIBRARIES,
+    "eems-npy": EEMS_NPY_LIBRARIES,
+}
+
+
+def validate_size(ctx, param, value):
+    if value is None:
+        return None
+
+    try:
+        return parse_size(value)
+    except ValueError:
+        raise click.BadParameter("Expected a size such as 512M or 8G")
+
+
+def validate_shape(ctx, param, value):
+    if value is None:
+        return None
+
+    try:
+        shape = tuple(int(size) for size in value.lower().split("x"))
+    except ValueError:
+        shape = ()
+
+    if not shape or any(size < 1 for size in shape):
+        raise click.BadParameter("Expected a shape such as 512x512")
+
+    return shape
+
+
+def report_duplicates(program):
+    aliases = program.compile().aliases
+
+    if aliases:
+        sys.stderr.write("Merged {} duplicate command(s):\n".format(len(aliases)))
+        for name, original in aliases.items():
+            sys.stderr.write(
+                "    {} (line {}) is the same as {} (line {})\n".format(
+                    name,
+                    program.commands[name].lineno,
+                    original,
+                    program.commands[original].lineno,
+                )
+            )
+
 
 @click.command()
 @click.argument("library")
@@ -23,7 +73,133 @@ LINE_CONTEX_LENGTH = 3
     default=[],
     help="Add a command library by its Python path (e.g., mpilot.libraries.eems.csv)",
 )
-def main(library, path, libraries):
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=1,
+    help="Number of commands to run concurrently (0 uses one per CPU)",
+)
+@click.option(
+    "--processes",
+    is_flag=True,
+    default=False,
+    help="Run commands in worker processes instead of threads",
+)
+@click.option(
+    "--memory-budget",
+    default=None,
+    callback=validate_size,
+    help="Limit on memory held by results, e.g. 8G. Concurrent commands wait rather than exceed it.",
+)
+@click.option(
+    "--spill-limit",
+    default=None,
+    callback=validate_size,
+    help="Spill results waiting to be used to disk when results in memory exceed this size, e.g. 32G",
+)
+@click.option(
+    "--scratch-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory for spilled results (defaults to the system temporary directory)",
+)
+@click.option(
+    "--tile-shape",
+    default=None,
+    callback=validate_shape,
+    help="Run the model over windows of the input grids of this shape, e.g. 512x512 (rows x columns)",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory in which to keep results between runs, so that unchanged commands aren't run again",
+)
+@click.option(
+    "--cache-size",
+    default=None,
+    callback=validate_size,
+    help="Limit on the size of the result cache, e.g. 20G. The least recently used results are removed first.",
+)
+@click.option(
+    "--target",
+    "-t",
+    "targets",
+    multiple=True,
+    default=[],
+    help="Compute only this result and the results it depends on (may be repeated). "
+    "By default, commands which write output are targeted.",
+)
+@click.option(
+    "--prefetch",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Start reading inputs up to this many commands ahead of their turn, so reading overlaps with computation",
+)
+@click.option(
+    "--write-behind",
+    default=None,
+    callback=validate_size,
+    help="Write output in the background while other commands run, with up to this much data waiting, e.g. 1G",
+)
+@click.option(
+    "--chunk-shape",
+    default=None,
+    callback=validate_shape,
+    help="Default chunk shape of written netCDF variables, e.g. 256x256 (rows x columns)",
+)
+@click.option(
+    "--compression-level",
+    type=click.IntRange(min=0, max=9),
+    default=None,
+    help="Default zlib compression level of written netCDF variables (0 disables compression)",
+)
+@click.option(
+    "--shuffle/--no-shuffle",
+    default=None,
+    help="Whether written netCDF variables use the shuffle filter by default",
+)
+@click.option(
+    "--output-type",
+    type=click.Choice(["Float32", "Float64", "Integer32", "Integer64"]),
+    default=None,
+    help="Default data type of written netCDF variables, e.g. Float32 to halve the size of float results",
+)
+@click.option(
+    "--significant-digits",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Default number of decimal digits to keep in written netCDF variables (improves compression)",
+)
+@click.option(
+    "--merge-duplicates",
+    is_flag=True,
+    default=False,
+    help="Compute the results of identical commands only once, and report which commands were merged",
+)
+def main(
+    library,
+    path,
+    libraries,
+    jobs,
+    processes,
+    memory_budget,
+    spill_limit,
+    scratch_dir,
+    tile_shape,
+    cache_dir,
+    cache_size,
+    targets,
+    prefetch,
+    write_behind,
+    chunk_shape,
+    compression_level,
+    shuffle,
+    output_type,
+    significant_digits,
+    merge_duplicates,
+):
     if not os.path.exists(path):
         sys.stderr.write(
             "\n".join(
@@ -49,10 +225,38 @@ def main(library, path, libraries):
         program = Program.from_source(
             source,
             libraries=libraries
-            + (EEMS_CSV_LIBRARIES if library == "eems-csv" else EEMS_NETCDF_LIBRARIES),
+            + LIBRARIES.get(library, EEMS_NETCDF_LIBRARIES),
             working_dir=os.path.dirname(path),
         )
-        program.run()
+
+        if cache_dir is not None:
+            program.cache = ResultCache(cache_dir, max_size=cache_size)
+
+        output_defaults = {
+            "ChunkShape": list(chunk_shape) if chunk_shape else None,
+            "CompressionLevel": compression_level,
+            "Shuffle": shuffle,
+            "OutputType": output_type,
+            "SignificantDigits": significant_digits,
+        }
+        program.output_defaults = {name: value for name, value in output_defaults.items() if value is not None}
+
+        if merge_duplicates:
+            program.merge_duplicates = True
+            report_duplicates(program)
+
+        program.run(
+            jobs=jobs or None,
+            executor=ProcessExecutor(jobs or None) if processes else None,
+            release_results=True,
+            memory_budget=memory_budget,
+            spill_limit=spill_limit,
+            scratch_dir=scratch_dir,
+            tile_shape=tile_shape,
+            targets=list(targets) or None,
+            write_behind=write_behind,
+            prefetch=prefetch,
+        )
     except MPilotError as ex:
         sys.stderr.write(
             "\n".join(
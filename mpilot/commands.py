@@ -11,8 +11,9 @@ from .exceptions import UnexpectedError
 if six.PY3:
     from typing import List, Any, Dict  # noqa: F401 (used for typing)
 
-from mpilot.exceptions import MissingParameters, NoSuchParameter, MPilotError
+from mpilot.exceptions import MissingParameters, NoSuchParameter, MPilotError, RecursiveModelStructure
 from mpilot.params import TupleParameter
+from mpilot.utils import flatten
 
 
 Argument = namedtuple("Argument", ("name", "value", "lineno"))
@@ -58,6 +59,20 @@ class CommandMeta(type):
 
 @add_metaclass(CommandMeta)
 class Command(object):
+    # Commands which write files or have other side effects are run by default when a program is run
+    has_side_effects = False
+
+    # Commands with side effects should set this to False, so they always run
+    cacheable = True
+
+    # Commands which only read input may be run ahead of time on an I/O thread (see the `prefetch` argument of
+    # `Executor.run`)
+    prefetchable = False
+
+    # Commands which can't be run one window of the grid at a time should set this to False, so that tiled runs fail
+    # before anything is run (see `mpilot.tiling`)
+    tileable = True
+
     @classmethod
     def get_commands(cls):
         # type: () -> List[CommandInfo]
@@ -77,13 +92,22 @@ class Command(object):
         self.is_finished = False
         self._result = None
 
+        # The key of the result in the program's result cache, set when the command is run
+        self.cache_key = None
+
     @property
     def result(self):
         if not self.is_finished:
-            self.run()
+            self.run_upstream()
 
         return self._result
 
+    @property
+    def window(self):
+        """ The part of the grid being computed when the program is run in tiles, or ``None`` """
+
+        return getattr(self.program, "window", None)
+
     @property
     def metadata(self):
         # type: () -> Dict[str, str]
@@ -130,16 +154,54 @@ class Command(object):
 
         return cleaned
 
-    def run(self):
+    def get_params(self):
+        # type: () -> Dict[str, Any]
+        """
+        Returns the cleaned arguments of the command. These come from the program's compiled plan (see
+        :py:meth:`mpilot.program.Program.compile`) if it has one, so that arguments aren't cleaned on every run.
+        """
+
+        plan = getattr(self.program, "plan", None)
+
+        if plan is not None and self.result_name in plan.params:
+            return plan.params[self.result_name]
+
+        return self.validate_params({arg.name: arg.value for arg in self.arguments})
+
+    def get_alias(self):
+        # type: () -> str
+        """
+        Returns the result name of the command this command duplicates, if the program's plan merged them (see
+        :py:func:`mpilot.plan.find_duplicates`), or ``None``.
+        """
+
+        plan = getattr(self.program, "plan", None)
+
+        if plan is None:
+            return None
+        return plan.aliases.get(self.result_name)
+
+    def run(self, params=None):
+        # type: (Dict[str, Any]) -> None
+        """ Runs the command if it hasn't been run yet. Already cleaned ``params`` may be passed to skip validation. """
+
         if not self.is_finished:
             self.is_running = True
 
             try:
-                self._result = self.execute(
-                    **self.validate_params(
-                        {arg.name: arg.value for arg in self.arguments}
-                    )
-                )
+                alias = self.get_alias()
+
+                if alias is not None:
+                    # Share the result of the original command rather than computing the same result again
+                    original = self.program.commands[alias]
+                    self._result = original.result
+                    self.cache_key = original.cache_key
+                else:
+                    if params is None:
+                        params = self.get_params()
+                    if not self.load_cached(params):
+                        self._result = self.execute(**params)
+                        self.save_cached()
             except Exception as exc:
                 if isinstance(exc, MPilotError):
                     raise
@@ -147,5 +209,78 @@ class Command(object):
 
             self.is_finished = True
 
+    def run_upstream(self):
+        # type: () -> None
+        """
+        Runs the command, and first any unfinished commands it depends on, in dependency order. Only those commands are
+        validated and run; the rest of the program isn't. Dependencies are followed with an explicit stack, rather than
+        recursively through the ``result`` of each upstream command, which would be limited by the depth of the Python
+        stack.
+        """
+
+        params = {}  # {id(command): cleaned arguments, ...} for commands waiting for their dependencies
+        stack = [self]
+
+        while stack:
+            command = stack[-1]
+            if command.is_finished:
+                stack.pop()
+                continue
+
+            if id(command) not in params:
+                command_params = params[id(command)] = command.get_params()
+
+                upstream = [item for item in flatten(list(command_params.values())) if isinstance(item, Command)]
+                alias = command.get_alias()
+                if alias is not None:
+                    upstream.append(command.program.commands[alias])
+
+                upstream = [item for item in upstream if not item.is_finished]
+                if any(id(item) in params for item in upstream):
+                    raise RecursiveModelStructure(command.lineno)
+
+                if upstream:
+                    stack.extend(reversed(upstream))
+                    continue
+
+            stack.pop()
+            command.run(params.pop(id(command)))
+
+    def load_cached(self, params):
+        # type: (Dict[str, Any]) -> bool
+        """
+        Looks up the result in the program's result cache (see :py:class:`mpilot.cache.ResultCache`), if it has one.
+        Returns ``True`` if the cached result was loaded.
+        """
+
+        cache = getattr(self.program, "cache", None)
+        self.cache_key = None
+
+        if cache is None or not self.cacheable:
+            return False
+
+        self.cache_key = cache.get_key(self, params)
+        if self.cache_key is None:
+            return False
+
+        try:
+            self._result = cache.load(self.cache_key)
+        except KeyError:
+            return False
+
+        return True
+
+    def save_cached(self):
+        """ Adds the result to the program's result cache, if it has one and the result can be cached. """
+
+        if self.cache_key is not None:
+            self.program.cache.store(self.cache_key, self._result)
+
+    def release(self):
+        """ Discards the result to free memory. Accessing :py:attr:`result` afterward will run the command again. """
+
+        self._result = None
+        self.is_finished = False
+
     def execute(self, **kwargs):
         raise NotImplementedError
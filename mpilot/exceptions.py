@@ -292,3 +292,49 @@ class UnexpectedError(ProgramError):
                 "Solution: Report this issue at https://github.com/consbio/mpilot/issues",
             )
         )
+
+
+@python_2_unicode_compatible
+class TilingNotSupported(ProgramError):
+    """ A model run in tiles has a command which can't be run one window at a time, e.g., to read part of a grid. """
+
+    def __init__(self, command, lineno=None):
+        # type: (str, int) -> None
+
+        super(TilingNotSupported, self).__init__(lineno)
+
+        self.command = command
+
+    def __str__(self):
+        return "\n".join(
+            (
+                'Problem: The command "{}" does not support running the model in tiles.'.format(
+                    self.command
+                ),
+                "Solution: Run the model without tiling, or use only commands which support it (e.g., commands which "
+                "read gridded data).",
+            )
+        )
+
+
+@python_2_unicode_compatible
+class MixedGridShapes(ProgramError):
+    """ A model run in tiles reads grids of different shapes. """
+
+    def __init__(self, shape, other_shape, lineno=None):
+        # type: (Sequence[int], Sequence[int], int) -> None
+
+        super(MixedGridShapes, self).__init__(lineno)
+
+        self.shape = shape
+        self.other_shape = other_shape
+
+    def __str__(self):
+        return "\n".join(
+            (
+                "Problem: The model reads grids with different shapes: {} and {}".format(
+                    self.shape, self.other_shape
+                ),
+                "Solution: Make sure every input grid has the same dimensions.",
+            )
+        )
@@ -0,0 +1,659 @@
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import os
+from collections import namedtuple, OrderedDict
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    wait,
+    FIRST_COMPLETED,
+)
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy
+import six
+
+if six.PY3:
+    from typing import Dict, List, Sequence, Any, Tuple  # noqa: F401 (used for typing)
+
+from .commands import Command
+from .exceptions import RecursiveModelStructure
+from .spill import SpillStore
+from .utils import result_nbytes
+
+# Describes a NumPy array stored in shared memory, which can be attached to by name from another process
+SharedArray = namedtuple(
+    "SharedArray",
+    ("data", "mask", "shape", "dtype", "fill_value", "hard_mask", "is_masked"),
+)
+
+# A finished command whose result is passed to a worker process
+SharedResult = namedtuple(
+    "SharedResult", ("command_cls", "result_name", "lineno", "value")
+)
+
+
+def topological_sort(dependencies, commands=None):
+    # type: (Dict[str, Sequence[str]], Dict[str, Any]) -> List[str]
+    """
+    Returns result names ordered so that each command comes after all of the commands it depends on. Ties are broken
+    by the order of ``dependencies``. Raises ``RecursiveModelStructure`` if the dependencies contain a loop.
+    """
+
+    position = {name: i for i, name in enumerate(dependencies)}
+    waiting = {name: len(set(upstream)) for name, upstream in dependencies.items()}
+    dependents = {}
+    for name, upstream in dependencies.items():
+        for upstream_name in set(upstream):
+            dependents.setdefault(upstream_name, []).append(name)
+
+    ready = [(position[name], name) for name, count in waiting.items() if not count]
+    heapq.heapify(ready)
+
+    order = []
+    while ready:
+        _, name = heapq.heappop(ready)
+        order.append(name)
+
+        for dependent in dependents.get(name, ()):
+            waiting[dependent] -= 1
+            if not waiting[dependent]:
+                heapq.heappush(ready, (position[dependent], dependent))
+
+    if len(order) != len(dependencies):
+        remaining = [name for name in dependencies if waiting[name]]
+        lineno = getattr((commands or {}).get(remaining[0]), "lineno", None)
+        raise RecursiveModelStructure(lineno)
+
+    return order
+
+
+def memory_order(dependencies, commands=None):
+    # type: (Dict[str, Sequence[str]], Dict[str, Any]) -> List[str]
+    """
+    Returns a topological order which keeps few results alive at once when results are released after use. Each
+    command's dependencies are evaluated depth-first, starting with the dependency whose subtree needs the most results
+    held at the same time (Sethi-Ullman numbering). Commands without dependents are evaluated in the order given.
+    """
+
+    need = {}
+    for name in topological_sort(dependencies, commands):
+        upstream = sorted((need[u] for u in set(dependencies[name])), reverse=True)
+        need[name] = max([n + i for i, n in enumerate(upstream)] + [len(upstream) + 1])
+
+    has_dependents = {u for upstream in dependencies.values() for u in upstream}
+
+    order = []
+    visited = set()
+
+    for root in (name for name in dependencies if name not in has_dependents):
+        stack = [(root, False)]
+
+        while stack:
+            name, expanded = stack.pop()
+
+            if expanded:
+                order.append(name)
+                continue
+            if name in visited:
+                continue
+
+            visited.add(name)
+            stack.append((name, True))
+
+            upstream = sorted(
+                OrderedDict.fromkeys(dependencies[name]), key=need.get, reverse=True
+            )
+            stack.extend((u, False) for u in reversed(upstream) if u not in visited)
+
+    return order
+
+
+def upstream(dependencies, names):
+    # type: (Dict[str, Sequence[str]], Sequence[str]) -> set
+    """ Returns the given result names along with every result they depend on, directly or indirectly. """
+
+    found = set()
+    stack = list(names)
+
+    while stack:
+        name = stack.pop()
+        if name not in found:
+            found.add(name)
+            stack.extend(dependencies[name])
+
+    return found
+
+
+def downstream(dependencies, names):
+    # type: (Dict[str, Sequence[str]], Sequence[str]) -> set
+    """ Returns the given result names along with every result which depends on them, directly or indirectly. """
+
+    dependents = {}
+    for name, upstream_names in dependencies.items():
+        for upstream_name in upstream_names:
+            dependents.setdefault(upstream_name, []).append(name)
+
+    found = set()
+    stack = list(names)
+
+    while stack:
+        name = stack.pop()
+        if name not in found:
+            found.add(name)
+            stack.extend(dependents.get(name, ()))
+
+    return found
+
+
+class Executor(object):
+    """
+    Runs program commands in dependency order. The base executor runs one command at a time in the calling thread;
+    subclasses override :py:meth:`submit` to dispatch commands elsewhere.
+    """
+
+    def __init__(self, jobs=1):
+        # type: (int) -> None
+
+        self.jobs = jobs
+
+        # The largest number of bytes held by results at once during the last run
+        self.peak_bytes = 0
+
+    def start(self):
+        """ Called before the first command is submitted. """
+
+    def shutdown(self):
+        """ Called once all commands have finished, or after an error. """
+
+    def complete(self, command, value):
+        # type: (Any, Any) -> None
+        """ Called in the calling thread with the value of a completed future, before any dependents are submitted. """
+
+    def release(self, command):
+        # type: (Any) -> None
+        """ Called once every dependent of a command has finished, if results are being released. """
+
+        command.release()
+
+    def spill(self, command, store):
+        # type: (Any, SpillStore) -> None
+        """ Called to move a finished result that is waiting for its dependents out of memory. """
+
+        command._result = store.spill(command._result)
+
+    def submit(self, command):
+        # type: (Any) -> Future
+        """ Runs a command whose dependencies have all finished, and returns a future for its completion. """
+
+        future = Future()
+        try:
+            command.run()
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(None)
+
+        return future
+
+    def run(
+        self,
+        program,
+        order,
+        dependencies,
+        release_results=False,
+        memory_budget=None,
+        spill_limit=None,
+        spill_store=None,
+        prefetch=0,
+    ):
+        # type: (Any, Sequence[str], Dict[str, Sequence[str]], bool, int, int, SpillStore, int) -> None
+        """
+        Runs the commands in ``order``. A command is dispatched as soon as every command it depends on has finished;
+        when several commands are ready, the one that comes first in ``order`` is dispatched first.
+
+        If ``release_results`` is ``True``, each result is released as soon as the last command depending on it has
+        finished, unless it is in ``program.pinned``. Results without dependents are always kept.
+
+        If ``memory_budget`` (in bytes) is set, a ready command is held back while dispatching it could push the
+        results in memory over the budget. A command's result is estimated to be as large as its largest input (or
+        the largest result so far, for commands without inputs). At least one command is always allowed to run.
+
+        If ``spill_limit`` (in bytes) is set, whenever results in memory exceed it, the least recently used results
+        which are still waiting for dependents are spilled to ``spill_store`` until they no longer do.
+
+        If ``prefetch`` is greater than 0, commands which read input (see
+        :py:attr:`~mpilot.commands.Command.prefetchable`) among the next ``prefetch`` commands in ``order`` are started
+        early on an I/O thread, so that reading overlaps with computation. Prefetched results count toward
+        ``memory_budget``, and are only started while they are estimated to fit within it.
+        """
+
+        if spill_limit is not None and spill_store is None:
+            spill_store = SpillStore()
+
+        position = {name: i for i, name in enumerate(order)}
+        waiting = {name: len(set(dependencies[name])) for name in order}
+        dependents = {}
+        for name in order:
+            for upstream_name in set(dependencies[name]):
+                dependents.setdefault(upstream_name, []).append(name)
+
+        consumers = {name: len(dependents.get(name, ())) for name in order}
+        sizes = {
+            name: result_nbytes(program.commands[name]._result)
+            for name in order
+            if program.commands[name].is_finished
+        }
+        self.peak_bytes = live_bytes = sum(sizes.values())
+
+        def estimate(name):
+            # Returns None until the size of at least one result is known
+            upstream_sizes = [sizes.get(u, 0) for u in dependencies[name]]
+            return max(upstream_sizes or list(sizes.values()) or [None])
+
+        def can_dispatch():
+            if memory_budget is None or not running:
+                return True
+
+            pending = list(estimates.values()) + [estimate(ready[0][1])]
+            pending += [size for n, size in prefetch_estimates.items() if n != ready[0][1]]
+            if None in pending:
+                return False
+            return live_bytes + sum(pending) <= memory_budget
+
+        def can_prefetch(name):
+            if memory_budget is None:
+                return True
+
+            pending = list(estimates.values()) + list(prefetch_estimates.values()) + [estimate(name)]
+            if None in pending:
+                return False
+            return live_bytes + sum(pending) <= memory_budget
+
+        estimates = {}  # {result_name: estimated bytes, ...} for running commands
+        tick = itertools.count()
+        # {result_name: tick, ...} for least-recently-used spilling. Results finished before this run are the oldest.
+        last_used = {name: next(tick) for name in sizes}
+        spilled = set()
+
+        def spill():
+            in_use = {u for n in running.values() for u in dependencies[n]}
+            candidates = sorted(
+                (last_used[n], n)
+                for n in sizes
+                if sizes[n]
+                and consumers[n]
+                and n not in in_use
+                and n not in spilled
+                and program.commands[n].is_finished
+            )
+
+            freed = 0
+            for _, n in candidates:
+                if live_bytes - freed <= spill_limit:
+                    break
+
+                self.spill(program.commands[n], spill_store)
+                spilled.add(n)
+                freed += sizes[n]
+
+            return freed
+
+        ready = [(position[name], name) for name in order if not waiting[name]]
+        heapq.heapify(ready)
+        running = {}
+
+        prefetched = {}  # {result_name: future, ...} for commands started early which haven't been dispatched
+        prefetch_estimates = {}  # {result_name: estimated bytes, ...} for prefetched commands
+        io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mpilot-prefetch") if prefetch else None
+        dispatched = set()
+        cursor = 0  # The position in `order` of the first command which hasn't been dispatched
+
+        self.start()
+        try:
+            while ready or running:
+                while ready and len(running) < self.jobs and can_dispatch():
+                    _, name = heapq.heappop(ready)
+                    dispatched.add(name)
+                    estimates[name] = prefetch_estimates.pop(name, None) or estimate(name)
+                    for upstream_name in dependencies[name]:
+                        last_used[upstream_name] = next(tick)
+
+                    future = prefetched.pop(name, None)
+                    if future is None:
+                        future = self.submit(program.commands[name])
+                    running[future] = name
+
+                if io_pool is not None:
+                    while cursor < len(order) and order[cursor] in dispatched:
+                        cursor += 1
+
+                    upcoming = (n for n in itertools.islice(order, cursor, None) if n not in dispatched)
+                    for name in itertools.islice(upcoming, prefetch):
+                        command = program.commands[name]
+                        if (
+                            name in prefetched
+                            or dependencies[name]
+                            or not command.prefetchable
+                            or command.is_finished
+                            or not can_prefetch(name)
+                        ):
+                            continue
+
+                        prefetch_estimates[name] = estimate(name)
+                        prefetched[name] = io_pool.submit(command.run)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in sorted(done, key=lambda f: position[running[f]]):
+                    name = running.pop(future)
+                    del estimates[name]
+                    command = program.commands[name]
+                    self.complete(command, future.result())
+
+                    if name not in sizes:
+                        sizes[name] = result_nbytes(command._result)
+                        live_bytes += sizes[name]
+                        self.peak_bytes = max(self.peak_bytes, live_bytes)
+                    last_used[name] = next(tick)
+
+                    for upstream_name in set(dependencies[name]):
+                        consumers[upstream_name] -= 1
+                        if (
+                            release_results
+                            and not consumers[upstream_name]
+                            and upstream_name not in program.pinned
+                        ):
+                            self.release(program.commands[upstream_name])
+                            if upstream_name not in spilled:
+                                live_bytes -= sizes[upstream_name]
+
+                    if spill_limit is not None and live_bytes > spill_limit:
+                        live_bytes -= spill()
+
+                    for dependent in dependents.get(name, ()):
+                        waiting[dependent] -= 1
+                        if not waiting[dependent]:
+                            heapq.heappush(ready, (position[dependent], dependent))
+        finally:
+            if io_pool is not None:
+                io_pool.shutdown(wait=True, cancel_futures=True)
+
+            self.shutdown()
+
+            if spill_store is not None:
+                spill_store.close()
+
+
+class ThreadExecutor(Executor):
+    """
+    Runs independent commands concurrently in a pool of ``jobs`` threads. Most NumPy operations release the GIL, so
+    independent branches of a model can make use of multiple cores.
+    """
+
+    def __init__(self, jobs=None):
+        # type: (int) -> None
+
+        super(ThreadExecutor, self).__init__(jobs=jobs or os.cpu_count() or 1)
+
+        self.pool = None
+
+    def start(self):
+        self.pool = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+    def submit(self, command):
+        return self.pool.submit(command.run)
+
+
+class _SharedMemory(SharedMemory):
+    """
+    A shared memory segment which may be closed while arrays still refer to its buffer. In that case, the memory is
+    unmapped once the last array is garbage collected.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_SharedMemory, self).__init__(*args, **kwargs)
+
+        # The mapping stays valid without the file descriptor, which would otherwise leak if closing fails.
+        if getattr(self, "_fd", -1) >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def close(self):
+        try:
+            super(_SharedMemory, self).close()
+        except BufferError:
+            pass
+
+
+def _from_segment(segment, shape, dtype):
+    """
+    Returns an array backed by a shared memory segment. Unlike ``numpy.ndarray(buffer=...)``, ``frombuffer`` holds an
+    export of the buffer, which keeps the memory mapped for as long as the array (or any view of it) exists.
+    """
+
+    count = int(numpy.prod(shape, dtype=numpy.int64))
+    return numpy.frombuffer(segment.buf, dtype=dtype, count=count).reshape(shape)
+
+
+def _map_values(value, cls, fn):
+    """ Applies ``fn`` to each instance of ``cls`` in ``value``, which may be a (nested) list or tuple """
+
+    if isinstance(value, cls):
+        return fn(value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_map_values(item, cls, fn) for item in value)
+    return value
+
+
+def share_array(value):
+    # type: (Any) -> Tuple[Any, List[SharedMemory]]
+    """
+    Copies a NumPy array (or masked array) into shared memory, and returns a ``SharedArray`` describing it along with
+    the new memory segments. Other values are returned unmodified, to be pickled.
+    """
+
+    if not isinstance(value, numpy.ndarray) or value.dtype.hasobject:
+        return value, []
+
+    is_masked = isinstance(value, numpy.ma.MaskedArray)
+    mask = numpy.ma.getmask(value) if is_masked else numpy.ma.nomask
+    segments = []
+
+    for arr in (numpy.ma.getdata(value), mask):
+        if arr is numpy.ma.nomask:
+            continue
+
+        segment = _SharedMemory(create=True, size=max(arr.nbytes, 1))
+        shared = _from_segment(segment, arr.shape, arr.dtype)
+        shared[...] = arr
+        del shared
+        segments.append(segment)
+
+    return (
+        SharedArray(
+            segments[0].name,
+            segments[1].name if len(segments) > 1 else None,
+            value.shape,
+            value.dtype.str,
+            value.fill_value if is_masked else None,
+            value.hardmask if is_masked else False,
+            is_masked,
+        ),
+        segments,
+    )
+
+
+def attach_array(value):
+    # type: (Any) -> Tuple[Any, List[SharedMemory]]
+    """ The inverse of ``share_array``: returns an array backed by the shared memory described by ``value``. """
+
+    if not isinstance(value, SharedArray):
+        return value, []
+
+    segments = [_SharedMemory(name=value.data)]
+    data = _from_segment(segments[0], value.shape, value.dtype)
+
+    if not value.is_masked:
+        return data, segments
+
+    mask = numpy.ma.nomask
+    if value.mask is not None:
+        segments.append(_SharedMemory(name=value.mask))
+        mask = _from_segment(segments[1], value.shape, bool)
+
+    arr = numpy.ma.MaskedArray(
+        data, mask=mask, fill_value=value.fill_value, hard_mask=value.hard_mask
+    )
+
+    return arr, segments
+
+
+def _run_in_process(command_cls, result_name, arguments, lineno, params):
+    """ Runs a command in a worker process, with its upstream results attached from shared memory. """
+
+    segments = []
+
+    def attach(shared_result):
+        upstream = shared_result.command_cls(
+            shared_result.result_name, lineno=shared_result.lineno
+        )
+        upstream._result, upstream_segments = attach_array(shared_result.value)
+        upstream.is_finished = True
+        segments.extend(upstream_segments)
+        return upstream
+
+    try:
+        command = command_cls(result_name, arguments, lineno=lineno)
+        command.run(
+            {
+                name: _map_values(value, SharedResult, attach)
+                for name, value in params.items()
+            }
+        )
+
+        value, result_segments = share_array(command._result)
+        segments.extend(result_segments)
+        return value
+    finally:
+        for segment in segments:
+            segment.close()
+
+
+class ProcessExecutor(Executor):
+    """
+    Runs independent commands concurrently in a pool of ``jobs`` worker processes, which avoids contention for the GIL.
+    Arrays are passed between processes in shared memory rather than being pickled; other results are pickled.
+    Results are attached back to the commands in the calling process once each command finishes.
+    """
+
+    def __init__(self, jobs=None, mp_context=None):
+        # type: (int, Any) -> None
+
+        super(ProcessExecutor, self).__init__(jobs=jobs or os.cpu_count() or 1)
+
+        self.mp_context = mp_context
+        self.pool = None
+        self.shared = {}  # {result_name: SharedArray or value, ...}
+        self.segments = {}  # {result_name: [segment, ...], ...}
+
+    def start(self):
+        if os.name == "posix":
+            # Start the resource tracker before forking, so that workers share it with this process
+            from multiprocessing import resource_tracker
+
+            resource_tracker.ensure_running()
+
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.jobs, mp_context=self.mp_context
+        )
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+        # Results remain mapped in this process, but no other process needs to attach to them anymore
+        for name in list(self.segments):
+            self.unlink(name)
+
+        self.shared = {}
+
+    def unlink(self, result_name):
+        # type: (str) -> None
+
+        for segment in self.segments.pop(result_name, []):
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+
+    def release(self, command):
+        self.shared.pop(command.result_name, None)
+        self.unlink(command.result_name)
+
+        super(ProcessExecutor, self).release(command)
+
+    def spill(self, command, store):
+        # The result is copied back into shared memory if another worker needs it
+        self.shared.pop(command.result_name, None)
+        self.unlink(command.result_name)
+
+        super(ProcessExecutor, self).spill(command, store)
+
+    def share(self, command):
+        # type: (Command) -> SharedResult
+
+        if command.result_name not in self.shared:
+            value, segments = share_array(command.result)
+            self.segments[command.result_name] = segments
+            self.shared[command.result_name] = value
+
+        return SharedResult(
+            type(command),
+            command.result_name,
+            command.lineno,
+            self.shared[command.result_name],
+        )
+
+    def submit(self, command):
+        if command.is_finished or command.get_alias() is not None:
+            return super(ProcessExecutor, self).submit(command)
+
+        params = command.get_params()
+
+        # Cached results are loaded in this process; results computed by workers are cached once they complete
+        if command.load_cached(params):
+            command.is_finished = True
+            return super(ProcessExecutor, self).submit(command)
+
+        return self.pool.submit(
+            _run_in_process,
+            type(command),
+            command.result_name,
+            command.arguments,
+            command.lineno,
+            {
+                name: _map_values(value, Command, self.share)
+                for name, value in params.items()
+            },
+        )
+
+    def complete(self, command, value):
+        if command.is_finished:
+            return
+
+        command._result, segments = attach_array(value)
+        command.is_finished = True
+        command.save_cached()
+
+        self.segments[command.result_name] = segments
+        self.shared[command.result_name] = value
@@ -13,6 +13,7 @@ from mpilot.libraries.eems.exceptions import (
     DuplicateRawValues,
 )
 from mpilot.libraries.eems.mixins import SameArrayShapeMixin
+from mpilot.tiling import GlobalStatisticsMixin, Statistics
 from mpilot.utils import insure_fuzzy
 
 
@@ -218,7 +219,7 @@ class WeightedMean(SameArrayShapeMixin, Command):
         return result / sum(weights)
 
 
-class Normalize(Command):
+class Normalize(GlobalStatisticsMixin, Command):
     """Normalizes the data from another field to range (default 0:1)"""
 
     display_name = "Normalize"
@@ -234,13 +235,14 @@ class Normalize(Command):
         start = kwargs.get("StartVal", 0)
         end = kwargs.get("EndVal", 1)
 
-        arr_min = arr.min()
-        arr_max = arr.max()
+        statistics = self.get_statistics(arr, **kwargs)["values"]
+        arr_min = statistics.minimum
+        arr_max = statistics.maximum
 
         return (arr - arr_min) * (start - end) / (arr_min - arr_max) + start
 
 
-class NormalizeZScore(Command):
+class NormalizeZScore(GlobalStatisticsMixin, Command):
     """Converts input values into normalized values using linear interpolation based on Z Score"""
 
     display_name = "Normalize by Z Score"
@@ -260,8 +262,9 @@ class NormalizeZScore(Command):
         start = kwargs.get("StartVal", 0)
         end = kwargs.get("EndVal", 1)
 
-        raw_mean = numpy.ma.mean(arr)
-        raw_std = numpy.ma.std(arr)
+        statistics = self.get_statistics(arr, **kwargs)["values"]
+        raw_mean = statistics.mean
+        raw_std = statistics.std
 
         x1 = raw_mean + raw_std * true_threshold
         x2 = raw_mean + raw_std * false_threshold
@@ -367,7 +370,7 @@ class NormalizeCurve(Command):
         return result
 
 
-class NormalizeMeanToMid(NormalizeCurve):
+class NormalizeMeanToMid(GlobalStatisticsMixin, NormalizeCurve):
     """Uses "NormalizeCurve" to create a non-linear transformation that is a good match for the input data"""
 
     display_name = "Mean to Mid"
@@ -378,22 +381,40 @@ class NormalizeMeanToMid(NormalizeCurve):
     }
     output = params.DataParameter()
 
-    def execute(self, **kwargs):
-        arr = kwargs["InFieldName"].result
-        ignore_zeros = kwargs["IgnoreZeros"]
+    def statistics_passes(self, **kwargs):
+        return 2
+
+    def partial_statistics(self, pass_index, arr, statistics, **kwargs):
+        values = numpy.ma.compressed(arr)
+
+        if kwargs["IgnoreZeros"]:
+            nonzero = values[values != 0]
+        else:
+            nonzero = values
 
-        low_value = arr.min()
-        high_value = arr.max()
+        # The first pass finds the range and mean, and the second finds the means above and below it
+        if pass_index == 0:
+            return {
+                "values": Statistics.from_array(values),
+                "nonzero": Statistics.from_array(nonzero),
+            }
 
-        if ignore_zeros:
-            arr = arr[arr != 0]
+        mean_value = statistics["nonzero"].mean
 
-        mean_value = arr.mean()
-        below_mean = arr[arr <= mean_value]
-        above_mean = arr[arr > mean_value]
+        return {
+            "below_mean": Statistics.from_array(nonzero[nonzero <= mean_value]),
+            "above_mean": Statistics.from_array(nonzero[nonzero > mean_value]),
+        }
 
-        high_mean = above_mean.compressed().mean()
-        low_mean = below_mean.compressed().mean()
+    def execute(self, **kwargs):
+        arr = kwargs["InFieldName"].result
+        statistics = self.get_statistics(arr, **kwargs)
+
+        low_value = statistics["values"].minimum
+        high_value = statistics["values"].maximum
+        mean_value = statistics["nonzero"].mean
+        high_mean = statistics["above_mean"].mean
+        low_mean = statistics["below_mean"].mean
 
         raw_values = [low_value, low_mean, mean_value, high_mean, high_value]
         normal_values = kwargs["NormalValues"][:]
@@ -412,7 +433,7 @@ class NormalizeMeanToMid(NormalizeCurve):
         return super(NormalizeMeanToMid, self).execute(**kwargs)
 
 
-class NormalizeCurveZScore(Command):
+class NormalizeCurveZScore(GlobalStatisticsMixin, Command):
     """Converts input values into narmalized values based on user-defined curve"""
 
     display_name = "Normalize Curve by Z Score"
@@ -433,8 +454,9 @@ class NormalizeCurveZScore(Command):
                 len(z_score_values), len(normal_values), lineno=self.lineno
             )
 
-        raw_mean = numpy.ma.mean(arr)
-        raw_std = numpy.ma.std(arr)
+        statistics = self.get_statistics(arr, **kwargs)["values"]
+        raw_mean = statistics.mean
+        raw_std = statistics.std
 
         raw_values = [raw_mean + value * raw_std for value in z_score_values]
 
@@ -469,6 +491,12 @@ class NormalizeCurveZScore(Command):
 class PrintVars(Command):
     """Prints each variable in a list of variable names."""
 
+    has_side_effects = True
+    cacheable = False
+
+    # Each window would replace the file written for the last one, so whole results are printed only in untiled runs
+    tileable = False
+
     display_name = "Print variable(s) to screen or file"
     inputs = {
         "InFieldNames": params.ListParameter(params.ResultParameter()),
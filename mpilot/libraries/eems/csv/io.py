@@ -1,18 +1,237 @@
 from __future__ import absolute_import
 
+import bz2
 import csv
+import gzip
+import itertools
+import lzma
+import os
 
 import numpy
+import six
 
 from mpilot import params
 from mpilot.commands import Command
+from mpilot.exceptions import MPilotError
 from mpilot.libraries.eems.exceptions import EmptyDataFile, InvalidDataFile
 from mpilot.libraries.eems.mixins import SameArrayShapeMixin
+from mpilot.utils import result_nbytes
+from mpilot.writer import write_behind
+
+if six.PY3:
+    from typing import Any, Dict, List, Sequence  # noqa: F401 (used for typing)
+
+
+# The number of lines parsed at a time. Only one chunk of text is held in memory at once.
+CHUNK_ROWS = 65536
+
+# Written in place of masked values by EEMSWrite, unless another value is given
+DEFAULT_MISSING_VALUE = "--"
+
+INVALID_VALUE_SOLUTION = (
+    "Verify that the data file doesn't contain any empty or NULL values, and that all values are numeric."
+)
+
+
+# Files with these extensions are decompressed when read, and compressed when written
+COMPRESSED_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+
+def is_compressed(path):
+    # type: (str) -> bool
+
+    return os.path.splitext(path)[1].lower() in COMPRESSED_OPENERS
+
+
+def open_text(path, mode="r"):
+    """
+    Opens a CSV file as text. Files ending in ``.gz``, ``.bz2``, or ``.xz`` are streamed through the codec, so they are
+    never entirely decompressed in memory or on disk.
+    """
+
+    if is_compressed(path):
+        return COMPRESSED_OPENERS[os.path.splitext(path)[1].lower()](path, mode + "t")
+
+    return open(path, mode)
+
+
+class CSVTable(object):
+    """
+    Columns of a CSV file, converted to floats. The file is parsed in chunks of :py:data:`CHUNK_ROWS` lines, directly
+    into arrays which are doubled in size as needed, and only the fields in ``field_names`` are kept. Within a program,
+    every ``EEMSRead`` of the same file shares one table (see :py:meth:`get`), so the file is parsed once for all of
+    the fields it reads.
+    """
+
+    def __init__(self, path, field_names, chunk_rows=CHUNK_ROWS):
+        # type: (str, Sequence[str], int) -> None
+
+        self.path = path
+        self.field_names = set(field_names)
+        self.columns = {}  # type: Dict[str, numpy.ndarray]
+        self.invalid_lines = {}  # type: Dict[str, int]
+
+        # The columns grow while the file is parsed, rather than reading it an extra time to count its rows
+        capacity = chunk_rows
+
+        with open_text(path) as f:
+            try:
+                self.headers = next(csv.reader(f))  # type: List[str]
+            except StopIteration:
+                raise EmptyDataFile(path)
+
+            for name in self.field_names:
+                if name in self.headers:
+                    self.columns[name] = numpy.empty(capacity, dtype=numpy.float64)
+
+            size = 0
+            line_number = 2
+            while True:
+                lines = list(itertools.islice(f, chunk_rows))
+                if not lines:
+                    break
+
+                if size + len(lines) > capacity:
+                    capacity = max(capacity * 2, size + len(lines))
+                    for name, column in self.columns.items():
+                        self.columns[name] = numpy.empty(capacity, dtype=numpy.float64)
+                        self.columns[name][:size] = column[:size]
+
+                size += self.parse_chunk(lines, line_number, size)
+                line_number += len(lines)
+
+        # Copy the rows out of oversized columns, so the unused capacity is freed
+        for name, column in self.columns.items():
+            self.columns[name] = column[:size].copy() if size < capacity else column
+
+    def parse_chunk(self, lines, line_number, start):
+        # type: (List[str], int, int) -> int
+        """
+        Parses lines of the file into the columns, beginning at row ``start``, and returns the number of rows parsed.
+        ``line_number`` is the line number of the first line, which is used to report invalid values.
+        """
+
+        names = [name for name in self.columns if name not in self.invalid_lines]
+        rows = [line for line in lines if line != "\n"]
+
+        if not names or not rows:
+            return len(rows)
+
+        try:
+            values = numpy.loadtxt(
+                rows,
+                dtype=numpy.float64,
+                delimiter=",",
+                quotechar='"',
+                comments=None,
+                usecols=[self.headers.index(name) for name in names],
+                ndmin=2,
+            )
+        except ValueError:
+            values = None
+
+        if values is None or len(values) != len(rows):
+            # Parse the chunk value by value, to find which fields are invalid and where
+            return self.parse_chunk_slowly(lines, line_number, start, names)
+
+        for i, name in enumerate(names):
+            self.columns[name][start : start + len(rows)] = values[:, i]
+
+        return len(rows)
+
+    def parse_chunk_slowly(self, lines, line_number, start, names):
+        # type: (List[str], int, int, List[str]) -> int
+
+        rows = []
+        line_numbers = []
+        for i, row in enumerate(csv.reader(lines)):
+            if row:
+                rows.append(row)
+                line_numbers.append(line_number + i)
+
+        for name in names:
+            idx = self.headers.index(name)
+            values = [row[idx] if idx < len(row) else "" for row in rows]
+
+            try:
+                self.columns[name][start : start + len(rows)] = numpy.array(values, dtype=numpy.float64)
+            except ValueError:
+                self.invalid_lines[name] = self.find_invalid(values, line_numbers)
+
+        return len(rows)
+
+    @classmethod
+    def get(cls, path, field_name, program=None):
+        # type: (str, str, Any) -> CSVTable
+        """
+        Returns a table with ``field_name`` from ``path``. If a program is given, the table is shared by the commands of
+        the program, and includes every field they read from the file. The file is parsed again if it has changed.
+        """
+
+        if program is None:
+            return cls(path, [field_name])
+
+        def create():
+            field_names = {field_name}
+            for command in program.commands.values():
+                if isinstance(command, EEMSRead):
+                    try:
+                        params = command.get_params()
+                    except MPilotError:
+                        # The command reports its own error if it's run
+                        continue
+
+                    if params["InFileName"] == path:
+                        field_names.add(params["InFieldName"])
+
+            return cls(path, field_names)
+
+        stat = os.stat(path)
+        table = program.get_resource((cls, path, stat.st_mtime_ns, stat.st_size), create)
+
+        if field_name not in table.field_names:
+            # The field was added to the program after the file was parsed
+            return cls(path, [field_name])
+
+        return table
+
+    @staticmethod
+    def find_invalid(values, line_numbers):
+        # type: (List[str], List[int]) -> int
+        """ Returns the line number of the first value in a chunk which isn't a number """
+
+        for value, line_number in zip(values, line_numbers):
+            try:
+                float(value)
+            except ValueError:
+                return line_number
+
+    def get_column(self, field_name):
+        # type: (str) -> numpy.ndarray
+
+        if field_name in self.invalid_lines:
+            raise InvalidDataFile(
+                'The data file contains an invalid value in the field "{}" on line {}.'.format(
+                    field_name, self.invalid_lines[field_name]
+                ),
+                solution=INVALID_VALUE_SOLUTION,
+            )
+
+        try:
+            return self.columns[field_name]
+        except KeyError:
+            raise InvalidDataFile(
+                "The data file doesn't contain the header {}: {}".format(
+                    field_name, self.path
+                )
+            )
 
 
 class EEMSRead(Command):
     """Reads a variable from a file"""
 
+    prefetchable = True
+
     display_name = "Read"
     inputs = {
         "InFileName": params.PathParameter(must_exist=True),
@@ -27,78 +246,81 @@ class EEMSRead(Command):
     output = params.DataParameter()
 
     def execute(self, **kwargs):
-        path = kwargs["InFileName"]
-
-        with open(path, "r") as f:
-            reader = csv.reader(f.readlines())
-
-            try:
-                headers = next(reader)
-            except StopIteration:
-                raise EmptyDataFile(path)
-
-            field_name = kwargs["InFieldName"]
-            try:
-                idx = headers.index(field_name)
-            except ValueError:
-                raise InvalidDataFile(
-                    "The data file doesn't contain the header {}: {}".format(
-                        field_name, path
-                    )
-                )
-
-            values = []
-            for i, row in enumerate(reader):
-                if row:
-                    try:
-                        values.append(float(row[idx]))
-                    except ValueError:
-                        raise InvalidDataFile(
-                            'The data file contains an invalid value in the field "{}" on line {}.'.format(
-                                field_name, i + 2
-                            ),
-                            solution="Verify that the data file doesn't contain any empty or NULL values, and that all values are numeric.",
-                        )
-
-        fill_value = kwargs.get("MissingVal")
+        field_name = kwargs["InFieldName"]
+        table = CSVTable.get(kwargs["InFileName"], field_name, self.program)
         data_type = kwargs.get("DataType", float)
-        if fill_value is not None:
-            data = numpy.ma.array(
-                values, mask=False, dtype=data_type, fill_value=data_type(fill_value)
-            )
-            mask = numpy.ma.where(data == data_type(fill_value), True, False)
 
-        data = numpy.ma.array(values, mask=False, dtype=data_type)
+        # Columns of a table shared by the program are used by other reads of the file, so the result gets a copy
+        data = numpy.ma.array(
+            table.get_column(field_name), mask=False, dtype=data_type, copy=self.program is not None
+        )
         data.soften_mask()
 
+        fill_value = kwargs.get("MissingVal")
         if fill_value is not None:
-            data.mask = mask
+            data.mask = data.data == data_type(fill_value)
 
         return data
 
 
 class EEMSWrite(SameArrayShapeMixin, Command):
+    has_side_effects = True
+    cacheable = False
+
     display_name = "Write"
     inputs = {
         "OutFileName": params.PathParameter(must_exist=False),
         "OutFieldNames": params.ListParameter(
             params.ResultParameter(params.DataParameter())
         ),
+        "MissingVal": params.StringParameter(required=False),
+        "Precision": params.NumberParameter(required=False),
     }
 
+    @staticmethod
+    def format_values(arr, dtype, precision=None, missing_value=DEFAULT_MISSING_VALUE):
+        # type: (numpy.ndarray, numpy.dtype, int, str) -> List[str]
+        """ Formats part of a column as strings, with ``missing_value`` in place of masked values """
+
+        data = numpy.ma.getdata(arr).astype(dtype, copy=False)
+
+        if precision is not None and numpy.issubdtype(dtype, numpy.floating):
+            values = list(map("%.{}f".format(precision).__mod__, data.tolist()))
+        else:
+            values = list(map(str, data.tolist()))
+
+        for i in numpy.flatnonzero(numpy.ma.getmaskarray(arr)).tolist():
+            values[i] = missing_value
+
+        return values
+
     def execute(self, **kwargs):
         commands = kwargs["OutFieldNames"]
         arrays = [c.result for c in commands]
         self.validate_array_shapes(arrays)
 
-        with open(kwargs["OutFileName"], "w") as f:
-            writer = csv.writer(f, lineterminator="\n")
+        missing_value = kwargs.get("MissingVal", DEFAULT_MISSING_VALUE)
+        precision = kwargs.get("Precision")
+        if precision is not None:
+            precision = int(precision)
+
+        # Columns are written with a common type, as if they were one array
+        dtype = numpy.result_type(*arrays)
+
+        def write():
+            with open_text(kwargs["OutFileName"], "w") as f:
+                writer = csv.writer(f, lineterminator="\n")
 
-            # Write headers
-            writer.writerow([c.result_name for c in commands])
+                # Write headers
+                writer.writerow([c.result_name for c in commands])
 
-            # Assumption: 1d arrays
-            out_arr = numpy.ma.array(arrays)
-            out_arr = out_arr.transpose([1, 0])
+                # Assumption: 1d arrays. Rows are formatted and written a chunk at a time.
+                size = len(arrays[0]) if arrays else 0
+                for start in range(0, size, CHUNK_ROWS):
+                    columns = [
+                        self.format_values(arr[start : start + CHUNK_ROWS], dtype, precision, missing_value)
+                        for arr in arrays
+                    ]
+                    writer.writerows(zip(*columns))
 
-            writer.writerows(out_arr[i, :] for i in range(out_arr.shape[0]))
+        write_behind(self, write, sum(result_nbytes(arr) for arr in arrays))
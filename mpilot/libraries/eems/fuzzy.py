@@ -23,13 +23,14 @@ from mpilot.libraries.eems.exceptions import (
     MismatchedWeights,
 )
 from mpilot.libraries.eems.mixins import SameArrayShapeMixin
+from mpilot.tiling import GlobalStatisticsMixin
 from mpilot.utils import insure_fuzzy, make_masked
 
 FUZZY_MIN = -1
 FUZZY_MAX = 1
 
 
-class CvtToFuzzy(Command):
+class CvtToFuzzy(GlobalStatisticsMixin, Command):
     """Converts input values into fuzzy values using linear interpolation"""
 
     is_fuzzy = True
@@ -43,6 +44,10 @@ class CvtToFuzzy(Command):
     }
     output = params.DataParameter()
 
+    def statistics_passes(self, **kwargs):
+        # The range of the input is only needed for default thresholds
+        return 0 if "TrueThreshold" in kwargs and "FalseThreshold" in kwargs else 1
+
     def execute(self, **kwargs):
         arr = kwargs["InFieldName"].result
         direction = kwargs.get("Direction")
@@ -52,12 +57,18 @@ class CvtToFuzzy(Command):
                 direction, lineno=self.argument_lines.get("Direction")
             )
 
-        false_threshold = kwargs.get(
-            "FalseThreshold", arr.max() if direction == "HighToLow" else arr.min()
-        )
-        true_threshold = kwargs.get(
-            "TrueThreshold", arr.min() if direction == "HighToLow" else arr.max()
-        )
+        false_threshold = kwargs.get("FalseThreshold")
+        true_threshold = kwargs.get("TrueThreshold")
+
+        if false_threshold is None or true_threshold is None:
+            statistics = self.get_statistics(arr, **kwargs)["values"]
+            arr_min = statistics.minimum
+            arr_max = statistics.maximum
+
+            if false_threshold is None:
+                false_threshold = arr_max if direction == "HighToLow" else arr_min
+            if true_threshold is None:
+                true_threshold = arr_min if direction == "HighToLow" else arr_max
 
         if true_threshold == false_threshold:
             raise InvalidThresholds(self.lineno)
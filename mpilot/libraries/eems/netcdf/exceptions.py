@@ -1,6 +1,10 @@
+import six
 from six import python_2_unicode_compatible
 
-from mpilot.exceptions import MPilotError
+from mpilot.exceptions import MPilotError, ProgramError
+
+if six.PY3:
+    from typing import List, Tuple  # noqa: F401 (used for typing)
 
 
 @python_2_unicode_compatible
@@ -48,7 +52,7 @@ class InvalidFuzzyData(MPilotError):
     def __init__(self, path, lineno=None):
         # type: (str, int) -> None
 
-        super(InvalidPositiveData, self).__init__(lineno)
+        super(InvalidFuzzyData, self).__init__(lineno)
 
         self.path = path
 
@@ -59,3 +63,71 @@ class InvalidFuzzyData(MPilotError):
                 "Solution: Make sure the input dataset has values within the fuzzy range.",
             )
         )
+
+
+@python_2_unicode_compatible
+class InvalidSubset(ProgramError):
+    def __init__(self, path, reason, lineno=None):
+        # type: (str, str, int) -> None
+
+        super(InvalidSubset, self).__init__(lineno)
+
+        self.path = path
+        self.reason = reason
+
+    def __str__(self):
+        return "\n".join(
+            (
+                "Problem: The subset of the dataset is invalid ({}): {}".format(self.reason, self.path),
+                "Solution: Make sure the rows, columns, or bounding box fall within the extent of the dataset.",
+            )
+        )
+
+
+@python_2_unicode_compatible
+class DimensionMismatch(ProgramError):
+    def __init__(self, path, dimension, size, expected_size, lineno=None):
+        # type: (str, str, int, int, int) -> None
+
+        super(DimensionMismatch, self).__init__(lineno)
+
+        self.path = path
+        self.dimension = dimension
+        self.size = size
+        self.expected_size = expected_size
+
+    def __str__(self):
+        return "\n".join(
+            (
+                "Problem: The dimension '{}' of the dataset has size {}, but {} was expected: {}".format(
+                    self.dimension, self.size, self.expected_size, self.path
+                ),
+                "Solution: Only append to datasets written with the same dimensions, or write to a new dataset.",
+            )
+        )
+
+
+@python_2_unicode_compatible
+class SubsetMismatch(ProgramError):
+    def __init__(self, path, variable, subset, shape, read_subsets, expected_shape, lineno=None):
+        # type: (str, str, str, Tuple[int, ...], List[str], Tuple[int, ...], int) -> None
+
+        super(SubsetMismatch, self).__init__(lineno)
+
+        self.path = path
+        self.variable = variable
+        self.subset = subset
+        self.shape = shape
+        self.read_subsets = read_subsets
+        self.expected_shape = expected_shape
+
+    def __str__(self):
+        read_subsets = " or ".join(self.read_subsets) if self.read_subsets else "a different subset"
+
+        return "\n".join(
+            (
+                "Problem: The output covers {} of '{}', with shape {}, but its results were read from {}, with shape "
+                "{}: {}".format(self.subset, self.variable, self.shape, read_subsets, self.expected_shape, self.path),
+                "Solution: Give the write the same Rows, Columns, or BoundingBox as the reads its results come from.",
+            )
+        )
@@ -1,22 +1,561 @@
 from __future__ import absolute_import
 
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import numpy
-from netCDF4 import Dataset
-from numpy.ma import is_masked
+import six
+from netCDF4 import Dataset, default_fillvals
 
 from mpilot import params
 from mpilot.commands import Command
-from mpilot.utils import insure_fuzzy
-from .exceptions import NoSuchVariable, InvalidPositiveData, InvalidFuzzyData
+from mpilot.tiling import TiledSourceMixin, is_first_window, output_lock
+from mpilot.utils import flatten, insure_fuzzy, result_nbytes
+from mpilot.writer import write_behind
+from .exceptions import (
+    NoSuchVariable,
+    InvalidPositiveData,
+    InvalidFuzzyData,
+    InvalidSubset,
+    DimensionMismatch,
+    SubsetMismatch,
+)
 from ..mixins import SameArrayShapeMixin
 
+if six.PY3:
+    from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple  # noqa: F401 (used for typing)
+
 FUZZY_MIN = -1
 FUZZY_MAX = 1
 
+# The number of datasets a program keeps open at once for reading
+MAX_OPEN_DATASETS = 64
+
+# The zlib compression level of written variables, unless set by `CompressionLevel`
+DEFAULT_COMPRESSION_LEVEL = 1
+
+# netCDF-C and HDF5 aren't thread-safe, but netCDF4 releases the GIL while it calls them, so datasets are opened,
+# read, written, and closed only with this lock held, whichever thread (or program) uses them
+NETCDF_LOCK = threading.RLock()
+
+
+class DatasetPool(object):
+    """
+    Datasets opened for reading by the commands of a program, so that each file is opened (and its metadata read) once
+    for all of the variables read from it, rather than once per variable. Up to ``max_open`` datasets are kept open;
+    beyond that, the least recently used dataset is closed.
+
+    HDF5 keeps library-wide state, so locking each dataset separately wouldn't make it safe to use two at once.
+    Instead, the pool is guarded by ``NETCDF_LOCK``, which is held while a dataset is used, so one thread uses the pool
+    at a time.
+    """
+
+    def __init__(self, max_open=MAX_OPEN_DATASETS):
+        # type: (int) -> None
+
+        self.max_open = max_open
+        self.datasets = OrderedDict()  # {path: dataset, ...}, least recently used first
+        self.users = {}  # {path: number of uses of the dataset in progress, ...}
+
+    @classmethod
+    def get(cls, program):
+        # type: (Any) -> DatasetPool
+        """ Returns the pool of a program, which is shared by its commands (see ``Program.get_resource``) """
+
+        return program.get_resource(cls, cls)
+
+    @contextmanager
+    def open(self, path):
+        # type: (str) -> Iterator[Dataset]
+
+        with NETCDF_LOCK:
+            dataset = self.datasets.get(path)
+            if dataset is None:
+                dataset = Dataset(path, "r")
+                self.datasets[path] = dataset
+            else:
+                self.datasets.move_to_end(path)
+
+            self.users[path] = self.users.get(path, 0) + 1
+            try:
+                yield dataset
+            finally:
+                self.users[path] -= 1
+                self.evict()
+
+    def evict(self):
+        """ Closes the least recently used datasets which aren't in use, until no more than ``max_open`` are open """
+
+        with NETCDF_LOCK:
+            unused = [path for path in self.datasets if not self.users.get(path)]
+
+            for path in unused[: max(len(self.datasets) - self.max_open, 0)]:
+                self.datasets.pop(path).close()
+
+    def discard(self, path):
+        # type: (str) -> None
+        """ Closes a dataset, e.g., before it is written to """
+
+        with NETCDF_LOCK:
+            dataset = self.datasets.pop(path, None)
+            if dataset is not None:
+                dataset.close()
+
+    def close(self):
+        """ Closes every dataset. Called at the end of each run. """
+
+        with NETCDF_LOCK:
+            for dataset in self.datasets.values():
+                dataset.close()
+
+            self.datasets = OrderedDict()
+
+
+@contextmanager
+def open_dataset(path, program=None):
+    # type: (str, Any) -> Iterator[Dataset]
+    """
+    Opens a dataset for reading, from the program's :py:class:`DatasetPool` if a program is given. The dataset is used
+    with ``NETCDF_LOCK`` held.
+    """
+
+    if program is None:
+        with NETCDF_LOCK, Dataset(path, "r") as dataset:
+            yield dataset
+    else:
+        with DatasetPool.get(program).open(path) as dataset:
+            yield dataset
+
+
+def expand_index(index, ndim):
+    # type: (tuple, int) -> Tuple[slice, ...]
+    """ Returns an index of ``ndim`` dimensions with a slice for each dimension, in place of any ``Ellipsis`` """
+
+    index = tuple(index)
+    for i, item in enumerate(index):
+        if item is Ellipsis:
+            index = index[:i] + (slice(None),) * (ndim - len(index) + 1) + index[i + 1 :]
+            break
+
+    return index + (slice(None),) * (ndim - len(index))
+
+
+def get_coordinate_range(path, dataset, dimension, low, high, lineno=None):
+    # type: (str, Dataset, str, float, float, int) -> slice
+    """ Returns the range of a dimension whose coordinates are within ``low`` and ``high`` """
+
+    if dimension not in dataset.variables:
+        raise InvalidSubset(path, "the dimension '{}' has no coordinate variable".format(dimension), lineno=lineno)
+
+    coordinates = dataset[dimension][:]
+    within = (coordinates >= min(low, high)) & (coordinates <= max(low, high))
+    selected = numpy.flatnonzero(numpy.ma.filled(within, False))
+
+    if not selected.size:
+        raise InvalidSubset(path, "no '{}' coordinates are within {} to {}".format(dimension, low, high), lineno=lineno)
+
+    return slice(int(selected[0]), int(selected[-1]) + 1)
+
+
+def get_subset(path, dataset, variable_name, rows=None, columns=None, bounding_box=None, lineno=None):
+    # type: (str, Dataset, str, List[int], List[int], List[float], int) -> Optional[Tuple[slice, ...]]
+    """
+    Returns the index of the part of a variable selected by a range of rows and/or columns (``[start, stop]``), or by a
+    bounding box (``[min x, min y, max x, max y]``) in the coordinates of its last two dimensions. Returns ``None`` if
+    no subset is given.
+    """
+
+    if rows is None and columns is None and bounding_box is None:
+        return None
+
+    variable = dataset[variable_name]
+    if variable.ndim < 2:
+        raise InvalidSubset(path, "the variable '{}' isn't a grid".format(variable_name), lineno=lineno)
+
+    y_dimension, x_dimension = variable.dimensions[-2:]
+
+    if bounding_box is not None:
+        if rows is not None or columns is not None:
+            raise InvalidSubset(path, "a bounding box can't be combined with rows or columns", lineno=lineno)
+        if len(bounding_box) != 4:
+            raise InvalidSubset(path, "the bounding box must be [min x, min y, max x, max y]", lineno=lineno)
+
+        min_x, min_y, max_x, max_y = bounding_box
+        trailing = (
+            get_coordinate_range(path, dataset, y_dimension, min_y, max_y, lineno),
+            get_coordinate_range(path, dataset, x_dimension, min_x, max_x, lineno),
+        )
+    else:
+        trailing = []
+        for label, index_range, size in (("rows", rows, variable.shape[-2]), ("columns", columns, variable.shape[-1])):
+            if index_range is None:
+                trailing.append(slice(0, size))
+                continue
+
+            if len(index_range) != 2:
+                raise InvalidSubset(path, "the {} must be [start, stop]".format(label), lineno=lineno)
+
+            start, stop = (int(i) for i in index_range)
+            if not 0 <= start < stop <= size:
+                raise InvalidSubset(path, "the {} must be within 0 to {}".format(label, size), lineno=lineno)
+
+            trailing.append(slice(start, stop))
+
+    return (slice(None),) * (variable.ndim - 2) + tuple(trailing)
+
+
+def get_subset_shape(subset, shape):
+    # type: (Tuple[slice, ...], Tuple[int, ...]) -> Tuple[int, ...]
+
+    return tuple(len(range(*index.indices(size))) for index, size in zip(subset, shape))
+
+
+def describe_subset(rows=None, columns=None, bounding_box=None):
+    # type: (List[int], List[int], List[float]) -> str
+    """ Returns a description of the subset selected by the ``Rows``, ``Columns``, or ``BoundingBox`` arguments """
+
+    parts = [
+        "{} = {}".format(name, list(value))
+        for name, value in (("Rows", rows), ("Columns", columns), ("BoundingBox", bounding_box))
+        if value is not None
+    ]
+    return ", ".join(parts) if parts else "the whole grid"
+
+
+def offset_window(window, subset, shape):
+    # type: (tuple, Tuple[slice, ...], Tuple[int, ...]) -> Tuple[slice, ...]
+    """ Returns the index into a variable of ``shape`` of a window of its ``subset`` """
+
+    index = []
+    for window_index, subset_index, size in zip(expand_index(window, len(shape)), subset, shape):
+        start, stop, _ = subset_index.indices(size)
+        window_start, window_stop, _ = window_index.indices(stop - start)
+        index.append(slice(start + window_start, start + window_stop))
+
+    return tuple(index)
+
+
+def offset_geotransform(geotransform, subset, shape):
+    # type: (str, Tuple[slice, ...], Tuple[int, ...]) -> str
+    """ Returns a GDAL ``GeoTransform`` attribute with its origin moved to the first cell of ``subset`` """
+
+    try:
+        x, x_column, x_row, y, y_column, y_row = (float(value) for value in geotransform.split())
+    except ValueError:
+        return geotransform
+
+    row = subset[-2].indices(shape[-2])[0]
+    column = subset[-1].indices(shape[-1])[0]
+    x += column * x_column + row * x_row
+    y += column * y_column + row * y_row
+
+    return " ".join(repr(value) for value in (x, x_column, x_row, y, y_column, y_row))
+
+
+def get_chunk_sizes(chunk_shape, shape):
+    # type: (List[int], Tuple[int, ...]) -> List[int]
+    """
+    Returns the chunk size of each dimension of a variable for a chunk shape of its trailing dimensions, like a tile
+    shape. Leading dimensions are chunked one at a time, and no chunk is larger than its dimension.
+    """
+
+    if len(chunk_shape) > len(shape):
+        raise ValueError("The chunk shape has more dimensions than the variable")
+
+    chunk_shape = [1] * (len(shape) - len(chunk_shape)) + [int(size) for size in chunk_shape]
+    return [max(min(chunk, size), 1) for chunk, size in zip(chunk_shape, shape)]
+
+
+def get_fill_value(arr, dtype):
+    # type: (numpy.ma.MaskedArray, numpy.dtype) -> Any
+    """
+    Returns the fill value of an array as ``dtype``, or the netCDF default fill value for ``dtype`` if it can't be
+    represented exactly (e.g., when writing float results as integers).
+    """
+
+    fill_value = numpy.ma.MaskedArray(arr).fill_value
+
+    with numpy.errstate(all="ignore"):
+        converted = numpy.array(fill_value).astype(dtype)
+
+    if converted == fill_value:
+        return converted
+
+    return default_fillvals[dtype.str[1:]]
+
+
+class GridTemplate(object):
+    """
+    The dimensions, coordinates, and CRS metadata of a variable (or a subset of it), which are copied to each dataset
+    written with the variable as its template. Templates are read once per program and dimension file (see
+    :py:meth:`get`), rather than once per output.
+    """
+
+    def __init__(self, shape, dimensions, esri_pe=None, grid_mapping=None):
+        # type: (Tuple[int, ...], List[Dict[str, Any]], str, Dict[str, Any]) -> None
+
+        self.shape = shape
+        self.dimensions = dimensions
+        self.esri_pe = esri_pe
+        self.grid_mapping = grid_mapping
+
+    @classmethod
+    def get(cls, path, variable_name, program=None, rows=None, columns=None, bounding_box=None, lineno=None):
+        # type: (str, str, Any, List[int], List[int], List[float], int) -> GridTemplate
+        """
+        Returns the template of a variable, which is shared by the commands of a program. Errors are reported at
+        ``lineno``.
+        """
+
+        def read():
+            with open_dataset(path, program) as dataset:
+                return cls.read(path, dataset, variable_name, rows, columns, bounding_box, lineno)
+
+        if program is None:
+            return read()
+
+        stat = os.stat(path)
+        key = (
+            cls,
+            path,
+            stat.st_mtime_ns,
+            stat.st_size,
+            variable_name,
+            tuple(rows or ()),
+            tuple(columns or ()),
+            tuple(bounding_box or ()),
+        )
+        return program.get_resource(key, read)
+
+    @classmethod
+    def read(cls, path, dataset, variable_name, rows=None, columns=None, bounding_box=None, lineno=None):
+        # type: (str, Dataset, str, List[int], List[int], List[float], int) -> GridTemplate
+
+        variable = dataset[variable_name]
+
+        # The coordinates are copied for only the subset of the template which was read
+        subset = get_subset(
+            path, dataset, variable_name, rows=rows, columns=columns, bounding_box=bounding_box, lineno=lineno
+        )
+        if subset is None:
+            subset = (slice(None),) * variable.ndim
+
+        dimensions = []
+        for dimension, dimension_index in zip(variable.dimensions, subset):
+            coordinates = dataset[dimension]
+            dimensions.append(
+                {
+                    "name": dimension,
+                    "dtype": coordinates.dtype,
+                    "fill_value": coordinates.get_fill_value(),
+                    "attributes": OrderedDict(
+                        (name, coordinates.getncattr(name)) for name in coordinates.ncattrs() if name != "_FillValue"
+                    ),
+                    "values": coordinates[dimension_index],
+                }
+            )
+
+        # Discover CRS metadata (ESRI and CF)
+        esri_pe = None
+        grid_mapping = None
+        for other in dataset.variables.values():
+            if "esri_pe_string" in other.ncattrs():
+                esri_pe = other.getncattr("esri_pe_string")
+                if "grid_mapping" in other.ncattrs() and other.getncattr("grid_mapping") in dataset.variables:
+                    grid_mapping_in = dataset.variables[other.getncattr("grid_mapping")]
+
+                    attributes = OrderedDict()
+                    for name in grid_mapping_in.ncattrs():
+                        value = grid_mapping_in.getncattr(name)
+                        if name == "GeoTransform":
+                            value = offset_geotransform(value, subset, variable.shape)
+                        attributes[name] = value
+
+                    grid_mapping = {
+                        "name": grid_mapping_in.name,
+                        "dtype": grid_mapping_in.dtype,
+                        "dimensions": [(name, dataset.dimensions[name].size) for name in grid_mapping_in.dimensions],
+                        "attributes": attributes,
+                    }
+
+                break
+
+        return cls(
+            get_subset_shape(subset, variable.shape),
+            dimensions,
+            esri_pe=esri_pe,
+            grid_mapping=grid_mapping,
+        )
+
+    def create_dimension(self, dataset, path, name, size, lineno=None):
+        # type: (Dataset, str, str, int, int) -> bool
+        """ Creates a dimension, or checks the size of an existing one. Returns ``True`` if it was created. """
+
+        if name in dataset.dimensions:
+            if len(dataset.dimensions[name]) != size:
+                raise DimensionMismatch(path, name, len(dataset.dimensions[name]), size, lineno=lineno)
+            return False
+
+        dataset.createDimension(name, size)
+        return True
+
+    def create(self, dataset, path, lineno=None):
+        # type: (Dataset, str, int) -> None
+        """
+        Creates the dimensions, coordinate variables, and grid mapping of a dataset, unless it already has them. Errors
+        are reported at ``lineno``.
+        """
+
+        for dimension in self.dimensions:
+            name = dimension["name"]
+            if not self.create_dimension(dataset, path, name, len(dimension["values"]), lineno):
+                continue
+
+            variable = dataset.createVariable(name, dimension["dtype"], [name], fill_value=dimension["fill_value"])
+            variable.setncatts(dimension["attributes"])
+            variable[:] = dimension["values"]
+
+        grid_mapping = self.grid_mapping
+        if grid_mapping is not None and grid_mapping["name"] not in dataset.variables:
+            for name, size in grid_mapping["dimensions"]:
+                if name not in dataset.dimensions:
+                    dataset.createDimension(name, size)
+
+            variable = dataset.createVariable(
+                grid_mapping["name"], grid_mapping["dtype"], [name for name, _ in grid_mapping["dimensions"]]
+            )
+            variable.setncatts(grid_mapping["attributes"])
+
+
+# Attributes which netCDF4 uses to decode the values of a variable. Variables without them are read undecoded, and
+# masked without netCDF4's copies.
+DECODED_ATTRIBUTES = ("scale_factor", "add_offset", "valid_min", "valid_max", "valid_range", "_Unsigned")
+
+# The number of bytes of a variable to read at once
+READ_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def get_missing_values(variable):
+    # type: (Any) -> List[Any]
+    """ Returns the values which mark missing data in a variable, which netCDF4 would mask """
+
+    attributes = variable.ncattrs()
+    values = []
+
+    if "missing_value" in attributes:
+        values.extend(numpy.atleast_1d(variable.getncattr("missing_value")).tolist())
+
+    if "_FillValue" in attributes:
+        values.append(variable.getncattr("_FillValue"))
+    elif variable.dtype.str[1:] not in ("i1", "u1"):
+        # Unwritten values have the default fill value, which isn't used for bytes
+        fill_value = variable.get_fill_value()
+        if fill_value is not None:
+            values.append(fill_value)
+
+    return values
+
+
+def get_variable_fill_value(variable, dtype):
+    # type: (Any, Any) -> Any
+    """
+    Returns the value which fills missing data in a variable (its ``_FillValue``, or else its first ``missing_value``)
+    as ``dtype``, or ``None`` if it has neither, or the value can't be represented as ``dtype``.
+    """
+
+    attributes = variable.ncattrs()
+
+    if "_FillValue" in attributes:
+        value = variable.getncattr("_FillValue")
+    elif "missing_value" in attributes:
+        value = numpy.atleast_1d(variable.getncattr("missing_value"))[0]
+    else:
+        return None
 
-class EEMSRead(Command):
+    with numpy.errstate(all="ignore"):
+        converted = numpy.array(value).astype(dtype)
+
+    return converted if numpy.array_equal(converted, value, equal_nan=True) else None
+
+
+def read_variable(variable, index, dtype, missing_values=(), validate=None):
+    # type: (Any, tuple, Any, Sequence[Any], Callable[[numpy.ndarray, numpy.ndarray], None]) -> Tuple[Any, Any]
+    """
+    Reads part of a variable into a new array of ``dtype``, and returns it with a mask of its missing values (or
+    ``nomask`` if none are missing). Values in ``missing_values`` are masked as well as those netCDF4 would mask. If
+    ``validate`` is given, it is called with the values and missing values of each chunk before they are converted.
+
+    The variable is read a chunk of rows at a time and converted into the result, rather than read whole and copied,
+    so reading takes little more memory than the result itself. Floats converted to integers are rounded.
+    """
+
+    index = expand_index(index, variable.ndim)
+    shape = get_subset_shape(index, variable.shape)
+    data = numpy.empty(shape, dtype=dtype)
+    mask = numpy.ma.nomask
+
+    if not data.size:
+        return data, mask
+
+    # Values are decoded by netCDF4 only if they need to be scaled, checked against a valid range, or read as unsigned
+    attributes = variable.ncattrs()
+    decode = any(name in attributes for name in DECODED_ATTRIBUTES)
+    variable_missing_values = [] if decode else get_missing_values(variable)
+
+    # Reads are aligned with the chunks the variable is stored in, so that no stored chunk is decompressed twice
+    row_bytes = max(int(numpy.prod(shape[1:], dtype=numpy.int64)) * variable.dtype.itemsize, 1)
+    step = max(READ_CHUNK_BYTES // row_bytes, 1)
+    chunking = variable.chunking()
+    if chunking != "contiguous" and chunking:
+        step = max(step // chunking[0], 1) * chunking[0]
+
+    first = index[0].indices(variable.shape[0])[0]
+
+    variable.set_auto_maskandscale(decode)
+    try:
+        start = 0
+        while start < shape[0]:
+            stop = min(((first + start) // step + 1) * step - first, shape[0])
+            chunk = variable[(slice(first + start, first + stop),) + index[1:]]
+
+            values = numpy.ma.getdata(chunk)
+            missing = numpy.ma.getmaskarray(chunk) if decode else numpy.zeros(values.shape, dtype=bool)
+            for value in variable_missing_values + list(missing_values):
+                if numpy.issubdtype(values.dtype, numpy.floating) and numpy.isnan(value):
+                    missing |= numpy.isnan(values)
+                else:
+                    missing |= values == value
+
+            if validate is not None:
+                validate(values, missing)
+
+            if numpy.issubdtype(dtype, numpy.integer) and numpy.issubdtype(values.dtype, numpy.floating):
+                values = numpy.rint(values, out=values)
+
+            data[start:stop] = values
+
+            if missing.any():
+                if mask is numpy.ma.nomask:
+                    mask = numpy.zeros(shape, dtype=bool)
+                mask[start:stop] = missing
+
+            # netCDF4 copies each chunk as it's read, so the last one is released first
+            del chunk, values, missing
+            start = stop
+    finally:
+        variable.set_auto_maskandscale(True)
+
+    return data, mask
+
+
+class EEMSRead(TiledSourceMixin, Command):
     """Reads a variable from a file, converting floats to nearest int when necessary."""
 
+    # Prefetched reads run on the I/O thread, which is safe since every read holds `NETCDF_LOCK`
+    prefetchable = True
+
     display_name = "Read"
     inputs = {
         "InFileName": params.PathParameter(must_exist=True),
@@ -32,58 +571,83 @@ class EEMSRead(Command):
                 "Fuzzy": numpy.float64,
             },
         ),
+        "Rows": params.ListParameter(params.NumberParameter(), required=False),
+        "Columns": params.ListParameter(params.NumberParameter(), required=False),
+        "BoundingBox": params.ListParameter(params.NumberParameter(), required=False),
     }
     output = params.DataParameter()
 
+    def get_subset(self, dataset, **kwargs):
+        # type: (Dataset, Any) -> Optional[Tuple[slice, ...]]
+
+        return get_subset(
+            kwargs["InFileName"],
+            dataset,
+            kwargs["InFieldName"],
+            rows=kwargs.get("Rows"),
+            columns=kwargs.get("Columns"),
+            bounding_box=kwargs.get("BoundingBox"),
+            lineno=self.lineno,
+        )
+
+    def get_shape(self, **kwargs):
+        path = kwargs["InFileName"]
+        variable_name = kwargs["InFieldName"]
+
+        with open_dataset(path, self.program) as dataset:
+            if variable_name not in dataset.variables:
+                raise NoSuchVariable(path, variable_name, lineno=self.lineno)
+
+            shape = dataset[variable_name].shape
+            subset = self.get_subset(dataset, **kwargs)
+
+            return shape if subset is None else get_subset_shape(subset, shape)
+
     def execute(self, **kwargs):
         path = kwargs["InFileName"]
         variable_name = kwargs["InFieldName"]
-        data_type = kwargs.get("DataType", "Float")
+        data_type = kwargs.get("DataType", numpy.float64)
 
-        with Dataset(kwargs["InFileName"], "r") as dataset:
-            if kwargs["InFieldName"] not in dataset.variables:
+        with open_dataset(path, self.program) as dataset:
+            if variable_name not in dataset.variables:
                 raise NoSuchVariable(path, variable_name, lineno=self.lineno)
 
             variable = dataset[variable_name]
-            data = variable[:]
-
-        if self.get_argument_value("DataType", "Float") in ("Positive Integer", "Positive Float") and data.min() < 0:
-            raise InvalidPositiveData(path, kwargs["DataType"], lineno=self.lineno)
-
-        if numpy.issubdtype(data.dtype, numpy.float64) and data_type in (
-            int,
-            numpy.uint,
-        ):
-            data = numpy.rint(data, out=data)  # round in-place
-
-        result = numpy.ma.array(
-            data,
-            mask=data.mask if is_masked(data) else False,
-            dtype=data_type,
-            fill_value=999999 if data_type in (int, numpy.uint) else None,
-        )
+            window = self.window if self.window is not None else (Ellipsis,)
+
+            # Only the subset (or the window of it) is read from disk
+            subset = self.get_subset(dataset, **kwargs)
+            index = window if subset is None else offset_window(window, subset, variable.shape)
+            data_type_name = self.get_argument_value("DataType", "Float")
+
+            def validate_positive(values, missing):
+                if numpy.ma.MaskedArray(values, missing).min() < 0:
+                    raise InvalidPositiveData(path, data_type_name, lineno=self.lineno)
+
+            data, mask = read_variable(
+                variable,
+                index,
+                data_type,
+                missing_values=[kwargs["MissingValue"]] if "MissingValue" in kwargs else [],
+                validate=validate_positive if data_type_name in ("Positive Integer", "Positive Float") else None,
+            )
+
+            # Float results keep the fill value of the variable, so that it's written out again
+            fill_value = 999999 if data_type in (int, numpy.uint) else get_variable_fill_value(variable, data_type)
 
-        if kwargs.get("DataType", "Float") == "Fuzzy":
+        result = numpy.ma.MaskedArray(data, mask=mask, fill_value=fill_value, copy=False)
+        result.soften_mask()
+
+        if data_type_name == "Fuzzy":
             fuzzy_pad = 0.01 * (FUZZY_MAX - FUZZY_MIN)
 
-            if data.max() > FUZZY_MAX + fuzzy_pad or data.min() < FUZZY_MIN - fuzzy_pad:
+            if result.max() > FUZZY_MAX + fuzzy_pad or result.min() < FUZZY_MIN - fuzzy_pad:
                 raise InvalidFuzzyData(path, lineno=self.lineno)
 
             insure_fuzzy(result, FUZZY_MIN, FUZZY_MAX)
 
-        result.soften_mask()
-
-        # Mask missing values
-        if "MissingValue" in kwargs:
-            missing_value = (
-                int(kwargs["MissingValue"])
-                if numpy.issubdtype(result.mask.dtype, int)
-                else float(kwargs["MissingValue"])
-            )
-
-            self.result.mask = numpy.where(result.data == missing_value, True, result.mask or False)
-
-        result.data[result.mask] = result.fill_value
+        if mask is not numpy.ma.nomask:
+            numpy.copyto(result.data, result.fill_value, where=mask)
 
         return result
 
@@ -91,90 +655,181 @@ class EEMSRead(Command):
 class EEMSWrite(SameArrayShapeMixin, Command):
     """Writes one or more file"""
 
+    has_side_effects = True
+    cacheable = False
+
     display_name = "Write"
     inputs = {
         "OutFileName": params.PathParameter(must_exist=False),
         "OutFieldNames": params.ListParameter(params.ResultParameter(params.DataParameter())),
         "DimensionFileName": params.PathParameter(must_exist=True),
         "DimensionFieldName": params.StringParameter(),
+        "Rows": params.ListParameter(params.NumberParameter(), required=False),
+        "Columns": params.ListParameter(params.NumberParameter(), required=False),
+        "BoundingBox": params.ListParameter(params.NumberParameter(), required=False),
+        "ChunkShape": params.ListParameter(params.NumberParameter(), required=False),
+        "CompressionLevel": params.NumberParameter(required=False),
+        "Shuffle": params.BooleanParameter(required=False),
+        "OutputType": params.DataTypeParameter(
+            required=False,
+            valid_types={
+                "Float32": numpy.float32,
+                "Float64": numpy.float64,
+                "Integer32": numpy.int32,
+                "Integer64": numpy.int64,
+            },
+        ),
+        "SignificantDigits": params.NumberParameter(required=False),
+        "Append": params.BooleanParameter(required=False),
     }
     output = params.BooleanParameter()
 
+    def get_params(self):
+        """
+        Returns the cleaned arguments, with the program's defaults for those which weren't given (see
+        `Program.output_defaults`). Defaults are resolved here rather than in `execute`, so that they reach commands run
+        in worker processes, which have no program.
+        """
+
+        params = super(EEMSWrite, self).get_params()
+        defaults = getattr(self.program, "output_defaults", {})
+        missing = [name for name in defaults if name in self.inputs and name not in params]
+
+        if not missing:
+            return params
+
+        params = dict(params)
+        for name in missing:
+            params[name] = self.inputs[name].clean(defaults[name], self.program, self.lineno)
+
+        return params
+
     def execute(self, **kwargs):
         commands = kwargs["OutFieldNames"]
         arrays = [c.result for c in commands]
         self.validate_array_shapes(arrays)
 
-        with Dataset(kwargs["OutFileName"], "w") as dataset:
-            with Dataset(kwargs["DimensionFileName"]) as dim_dataset:
-                dimensions = dim_dataset[kwargs["DimensionFieldName"]].dimensions
-                for dimension in dimensions:
-                    in_dimension_variable = dim_dataset[dimension]
-                    dataset.createDimension(dimension, in_dimension_variable.size)
-                    out_dimension_variable = dataset.createVariable(
-                        dimension,
-                        in_dimension_variable.dtype,
-                        [dimension],
-                        fill_value=in_dimension_variable.get_fill_value(),
-                    )
+        path = kwargs["OutFileName"]
+        window = self.window
+        create = window is None or is_first_window(window)
+
+        # The template is read before the output is opened, since it may be read from the output itself
+        template = self.get_template(**kwargs) if create else None
+        if template is not None:
+            shape = arrays[0].shape if window is None else self.program.grid_shape
+            if tuple(template.shape[len(template.shape) - len(shape) :]) != tuple(shape):
+                raise SubsetMismatch(
+                    path,
+                    kwargs["DimensionFieldName"],
+                    describe_subset(kwargs.get("Rows"), kwargs.get("Columns"), kwargs.get("BoundingBox")),
+                    template.shape,
+                    self.get_read_subsets(commands),
+                    shape,
+                    lineno=self.lineno,
+                )
 
-                    for attribute in dir(in_dimension_variable):
-                        if attribute not in dir(out_dimension_variable) and attribute not in (
-                            "_FillValue",
-                            "missing_value",
-                        ):
-                            setattr(out_dimension_variable, attribute, getattr(in_dimension_variable, attribute))
-
-                    for ncattr in in_dimension_variable.ncattrs():
-                        if ncattr != "_FillValue":
-                            out_dimension_variable.setncattr(ncattr, in_dimension_variable.getncattr(ncattr))
-
-                    out_dimension_variable[:] = in_dimension_variable[:]
-
-                # Discover CRS metadata (ESRI and CF)
-                esri_pe = None
-                grid_mapping = None
-                for variable in dim_dataset.variables.values():
-                    if "esri_pe_string" in variable.ncattrs():
-                        esri_pe = variable.getncattr("esri_pe_string")
-                        if "grid_mapping" in variable.ncattrs():
-                            grid_mapping_name = variable.getncattr("grid_mapping")
-                            if grid_mapping_name in dim_dataset.variables:
-                                grid_mapping = grid_mapping_name
-                                grid_mapping_in = dim_dataset.variables[grid_mapping]
-
-                                for dimension in grid_mapping_in.dimensions:
-                                    if dimension not in dataset.dimensions:
-                                        dataset.createDimension(dimension, dim_dataset.dimensions[dimension].size)
-
-                                grid_mapping_out = dataset.createVariable(
-                                    grid_mapping, grid_mapping_in.dtype, grid_mapping_in.dimensions
-                                )
-
-                                for ncattr in grid_mapping_in.ncattrs():
-                                    grid_mapping_out.setncattr(ncattr, grid_mapping_in.getncattr(ncattr))
-
-                        break
-
-            mask = numpy.copy(arrays[0].mask)
+        def write():
+            mask = numpy.copy(numpy.ma.getmaskarray(arrays[0]))
             for arr in arrays[1:]:
-                mask |= arr.mask
-
-            for command in commands:
-                variable = dataset.createVariable(
-                    command.result_name,
-                    command.result.dtype.char,
-                    dimensions,
-                    fill_value=command.result.fill_value,
-                    compression="zlib",
-                    complevel=1,
-                )
-                variable[:] = numpy.ma.MaskedArray(command.result.data, mask)
+                mask |= numpy.ma.getmaskarray(arr)
+
+            # A dataset can't be written while it is open for reading
+            if self.program is not None:
+                DatasetPool.get(self.program).discard(path)
 
-                # Apply CRS metadata
-                if esri_pe:
-                    variable.setncattr("esri_pe_string", esri_pe)
-                if grid_mapping:
-                    variable.setncattr("grid_mapping", grid_mapping)
+            append = kwargs.get("Append", False) and os.path.exists(path)
+
+            # When run in tiles, the output is created for the first window, and each window is written into it
+            with output_lock(), NETCDF_LOCK, Dataset(path, "w" if create and not append else "a") as dataset:
+                if create:
+                    self.create_variables(dataset, template, commands, arrays, **kwargs)
+
+                for command, arr in zip(commands, arrays):
+                    variable = dataset[command.result_name]
+                    variable[window if window is not None else slice(None)] = numpy.ma.MaskedArray(
+                        numpy.ma.getdata(arr), mask
+                    )
+
+        write_behind(self, write, sum(result_nbytes(arr) for arr in arrays))
 
         return True
+
+    def get_read_subsets(self, commands):
+        # type: (List[Command]) -> List[str]
+        """Returns descriptions of the subsets read by the `EEMSRead` commands which results are computed from"""
+
+        if self.program is None:
+            return []
+
+        subsets = OrderedDict()
+        stack = list(commands)
+        seen = set()
+        while stack:
+            command = stack.pop()
+            if command.result_name in seen:
+                continue
+            seen.add(command.result_name)
+
+            params = command.get_params()
+            if isinstance(command, EEMSRead):
+                subsets[describe_subset(params.get("Rows"), params.get("Columns"), params.get("BoundingBox"))] = True
+            else:
+                stack.extend(item for item in flatten(list(params.values())) if isinstance(item, Command))
+
+        return list(subsets)
+
+    def get_template(self, **kwargs):
+        """Returns the template of the output, read from `DimensionFileName`"""
+
+        return GridTemplate.get(
+            kwargs["DimensionFileName"],
+            kwargs["DimensionFieldName"],
+            self.program,
+            rows=kwargs.get("Rows"),
+            columns=kwargs.get("Columns"),
+            bounding_box=kwargs.get("BoundingBox"),
+            lineno=self.lineno,
+        )
+
+    def create_variables(self, dataset, template, commands, arrays, **kwargs):
+        """Creates the dimensions, CRS, and (empty) output variables of a dataset, unless it already has them"""
+
+        template.create(dataset, kwargs["OutFileName"], lineno=self.lineno)
+
+        dimensions = [dimension["name"] for dimension in template.dimensions]
+        esri_pe = template.esri_pe
+        grid_mapping = template.grid_mapping["name"] if template.grid_mapping else None
+
+        shape = tuple(len(dataset.dimensions[dimension]) for dimension in dimensions)
+        chunk_shape = kwargs.get("ChunkShape")
+        complevel = int(kwargs.get("CompressionLevel", DEFAULT_COMPRESSION_LEVEL))
+        significant_digits = kwargs.get("SignificantDigits")
+
+        for command, arr in zip(commands, arrays):
+            if command.result_name in dataset.variables:
+                continue
+
+            dtype = numpy.dtype(kwargs.get("OutputType", arr.dtype))
+
+            variable = dataset.createVariable(
+                command.result_name,
+                dtype.char,
+                dimensions,
+                fill_value=get_fill_value(arr, dtype),
+                compression="zlib" if complevel else None,
+                complevel=complevel,
+                shuffle=bool(complevel) and kwargs.get("Shuffle", True),
+                chunksizes=get_chunk_sizes(chunk_shape, shape) if chunk_shape else None,
+                least_significant_digit=(
+                    int(significant_digits)
+                    if significant_digits is not None and numpy.issubdtype(dtype, numpy.floating)
+                    else None
+                ),
+            )
+
+            # Apply CRS metadata
+            if esri_pe:
+                variable.setncattr("esri_pe_string", esri_pe)
+            if grid_mapping:
+                variable.setncattr("grid_mapping", grid_mapping)
+
@@ -0,0 +1,225 @@
+from __future__ import absolute_import
+
+import json
+import os
+import tempfile
+
+import numpy
+import six
+from numpy.lib.format import open_memmap
+
+from mpilot import params
+from mpilot.commands import Command
+from mpilot.libraries.eems.exceptions import InvalidDataFile
+from mpilot.libraries.eems.mixins import SameArrayShapeMixin
+from mpilot.tiling import TiledSourceMixin, is_first_window, output_lock
+
+if six.PY3:
+    from typing import Any, Dict, Tuple  # noqa: F401 (used for typing)
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+
+def read_manifest(path):
+    # type: (str) -> Dict[str, Any]
+    """ Returns the manifest of a dataset directory """
+
+    try:
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        raise InvalidDataFile(
+            "The dataset doesn't have a valid {}: {}".format(MANIFEST_NAME, path),
+            solution="Check that the directory was written by the EEMS NPY library.",
+        )
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise InvalidDataFile(
+            "The dataset was written by an unsupported version of the EEMS NPY library: {}".format(path)
+        )
+
+    return manifest
+
+
+def write_manifest(path, manifest):
+    # type: (str, Dict[str, Any]) -> None
+    """ Replaces the manifest of a dataset directory, so that readers never see a partially written manifest """
+
+    fd, temp_path = tempfile.mkstemp(dir=path, suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, os.path.join(path, MANIFEST_NAME))
+
+
+def pack_mask(mask):
+    # type: (numpy.ndarray) -> numpy.ndarray
+    """ Packs a boolean mask into bits along its last axis, so that windows of rows can be read without the rest """
+
+    return numpy.packbits(mask, axis=-1)
+
+
+def get_packed_index(window, size):
+    # type: (tuple, int) -> Tuple[tuple, slice]
+    """
+    Returns the index of the bytes of a packed mask which hold a window of a grid with ``size`` columns, and the index
+    of the window's bits within those bytes once they are unpacked.
+    """
+
+    if not isinstance(window[-1], slice):
+        window = window + (slice(None),)
+
+    start, stop, _ = window[-1].indices(size)
+    first_byte = start // 8
+
+    return (
+        window[:-1] + (slice(first_byte, (stop + 7) // 8),),
+        slice(start - first_byte * 8, stop - first_byte * 8),
+    )
+
+
+class EEMSRead(TiledSourceMixin, Command):
+    """Reads a variable from a dataset directory of .npy files"""
+
+    display_name = "Read"
+    inputs = {
+        "InFileName": params.PathParameter(must_exist=True),
+        "InFieldName": params.StringParameter(),
+        "DataType": params.DataTypeParameter(
+            required=False, valid_types={"Float": numpy.float64, "Integer": int}
+        ),
+    }
+    output = params.DataParameter()
+
+    def get_field(self, path, field_name):
+        # type: (str, str) -> Dict[str, Any]
+
+        manifest = read_manifest(path)
+
+        try:
+            return manifest["fields"][field_name]
+        except KeyError:
+            raise InvalidDataFile(
+                "The dataset doesn't contain the field {}: {}".format(field_name, path)
+            )
+
+    def get_shape(self, **kwargs):
+        field = self.get_field(kwargs["InFileName"], kwargs["InFieldName"])
+        return tuple(field["shape"])
+
+    def execute(self, **kwargs):
+        path = kwargs["InFileName"]
+        field = self.get_field(path, kwargs["InFieldName"])
+        window = self.window if self.window is not None else (Ellipsis,)
+
+        # The data is mapped rather than read, and is only copied if it needs to be converted to another type
+        data = numpy.load(os.path.join(path, field["data"]), mmap_mode="r")[window].view(numpy.ndarray)
+
+        if field["mask"] is not None:
+            packed = numpy.load(os.path.join(path, field["mask"]), mmap_mode="r")
+            packed_index, bits_index = get_packed_index(window, field["shape"][-1])
+            mask = numpy.unpackbits(packed[packed_index], axis=-1)[..., bits_index].astype(bool)
+        else:
+            mask = numpy.zeros(data.shape, dtype=bool)
+
+        data_type = kwargs.get("DataType", data.dtype)
+        result = numpy.ma.MaskedArray(data, mask=mask, dtype=data_type, fill_value=field["fill_value"])
+        result.soften_mask()
+
+        return result
+
+
+class EEMSWrite(SameArrayShapeMixin, Command):
+    """Writes one or more variables to a dataset directory of .npy files"""
+
+    has_side_effects = True
+    cacheable = False
+
+    display_name = "Write"
+    inputs = {
+        "OutFileName": params.PathParameter(must_exist=False),
+        "OutFieldNames": params.ListParameter(
+            params.ResultParameter(params.DataParameter())
+        ),
+    }
+    output = params.BooleanParameter()
+
+    def execute(self, **kwargs):
+        path = kwargs["OutFileName"]
+        commands = kwargs["OutFieldNames"]
+        arrays = [c.result for c in commands]
+        self.validate_array_shapes(arrays)
+
+        window = self.window
+
+        if window is None:
+            self.write_fields(path, commands, arrays)
+            return True
+
+        # When run in tiles, the files are created for the first window, and each window is written into them
+        with output_lock():
+            if is_first_window(window):
+                self.create_fields(path, commands, self.program.grid_shape)
+
+            for command, arr in zip(commands, arrays):
+                data = open_memmap(os.path.join(path, command.result_name + ".npy"), mode="r+")
+                data[window] = numpy.ma.getdata(arr)
+                data.flush()
+
+                packed = open_memmap(os.path.join(path, command.result_name + ".mask.npy"), mode="r+")
+                packed_index, bits_index = get_packed_index(window, data.shape[-1])
+
+                # Windows may share bytes of the packed mask at their edges, so the bits of other windows are kept
+                bits = numpy.unpackbits(packed[packed_index], axis=-1)
+                bits[..., bits_index] = numpy.ma.getmaskarray(arr)
+                packed[packed_index] = pack_mask(bits)
+                packed.flush()
+
+        return True
+
+    def get_field(self, command, arr, has_mask):
+        # type: (Command, numpy.ma.MaskedArray, bool) -> Dict[str, Any]
+
+        return {
+            "data": command.result_name + ".npy",
+            "mask": command.result_name + ".mask.npy" if has_mask else None,
+            "shape": list(arr.shape),
+            "dtype": arr.dtype.str,
+            "fill_value": numpy.ma.MaskedArray(arr).fill_value.item(),
+        }
+
+    def write_fields(self, path, commands, arrays):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        fields = {}
+        for command, arr in zip(commands, arrays):
+            numpy.save(os.path.join(path, command.result_name + ".npy"), numpy.ma.getdata(arr))
+
+            has_mask = numpy.ma.is_masked(arr)
+            if has_mask:
+                mask_path = os.path.join(path, command.result_name + ".mask.npy")
+                numpy.save(mask_path, pack_mask(numpy.ma.getmaskarray(arr)))
+
+            fields[command.result_name] = self.get_field(command, arr, has_mask)
+
+        write_manifest(path, {"version": MANIFEST_VERSION, "fields": fields})
+
+    def create_fields(self, path, commands, shape):
+        """Creates empty data and mask files for each output, with the shape of the whole grid"""
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        fields = {}
+        for command in commands:
+            arr = command.result
+            data_path = os.path.join(path, command.result_name + ".npy")
+            mask_path = os.path.join(path, command.result_name + ".mask.npy")
+
+            open_memmap(data_path, mode="w+", dtype=arr.dtype, shape=shape)
+            open_memmap(mask_path, mode="w+", dtype=numpy.uint8, shape=tuple(shape[:-1]) + ((shape[-1] + 7) // 8,))
+
+            fields[command.result_name] = dict(self.get_field(command, arr, True), shape=list(shape))
+
+        write_manifest(path, {"version": MANIFEST_VERSION, "fields": fields})
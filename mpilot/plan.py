@@ -0,0 +1,225 @@
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from types import MappingProxyType
+
+import numpy
+import six
+
+if six.PY3:
+    from typing import Dict, List, Sequence, Tuple, Any, Mapping  # noqa: F401 (used for typing)
+
+from .commands import Command
+from .exceptions import ResultDoesNotExist
+from .executors import memory_order, topological_sort, upstream
+from .utils import flatten
+
+
+def get_references(params):
+    # type: (Dict[str, Any]) -> List[str]
+    """ Returns the result names of the commands referenced by cleaned arguments, in order and without duplicates """
+
+    references = OrderedDict()
+    for value in params.values():
+        for item in flatten([value]):
+            if isinstance(item, Command):
+                references[item.result_name] = True
+
+    return list(references)
+
+
+def fingerprint(value, aliases):
+    # type: (Any, Dict[str, str]) -> Any
+    """
+    Returns a hashable representation of a cleaned argument value. Commands are represented by their result names, or by
+    the result name they are aliased to if they are duplicates.
+    """
+
+    if isinstance(value, Command):
+        return ("result", aliases.get(value.result_name, value.result_name))
+
+    if isinstance(value, (list, tuple)):
+        return tuple(fingerprint(item, aliases) for item in value)
+
+    if isinstance(value, dict):
+        return tuple((k, fingerprint(v, aliases)) for k, v in sorted(value.items()))
+
+    if isinstance(value, numpy.ndarray):
+        return ("array", value.dtype.str, value.shape, value.tobytes())
+
+    return (type(value).__name__, repr(value))
+
+
+def find_duplicates(dependencies, params, commands):
+    # type: (Dict[str, Sequence[str]], Dict[str, Dict[str, Any]], Dict[str, Command]) -> Dict[str, str]
+    """
+    Finds commands which would compute the same result as another command: the same command class, with the same
+    arguments (other than ``Metadata``) and the same inputs. Returns a lookup of each duplicate's result name to the
+    result name of the first such command. Commands with side effects and commands which can't be cached are never
+    considered duplicates.
+    """
+
+    aliases = OrderedDict()
+    seen = {}
+
+    for name in topological_sort(dependencies, commands):
+        command = commands[name]
+        if command.has_side_effects or not command.cacheable:
+            continue
+
+        key = (
+            type(command).__module__,
+            type(command).__name__,
+            fingerprint({k: v for k, v in params[name].items() if k != "Metadata"}, aliases),
+        )
+
+        if key in seen:
+            aliases[name] = seen[key]
+        else:
+            seen[key] = name
+
+    return aliases
+
+
+class Plan(object):
+    """
+    A compiled program: the cleaned arguments of every command, the dependencies between commands, and the order to run
+    them in. Plans are created with :py:meth:`mpilot.program.Program.compile`, and can be reused for any number of runs,
+    as long as the commands and their arguments don't change.
+
+    Duplicate commands (see :py:func:`find_duplicates`) are aliased to the command they duplicate: they depend only on
+    that command, and take its result rather than computing their own.
+    """
+
+    __slots__ = ("_order", "_dependencies", "_params", "_aliases", "_selections")
+
+    def __init__(self, order, dependencies, params, aliases=None):
+        # type: (Sequence[str], Dict[str, Sequence[str]], Dict[str, Dict[str, Any]], Dict[str, str]) -> None
+
+        self._order = tuple(order)
+        self._dependencies = MappingProxyType(
+            OrderedDict((name, tuple(dependencies[name])) for name in dependencies)
+        )
+        self._params = MappingProxyType(
+            {name: MappingProxyType(dict(command_params)) for name, command_params in params.items()}
+        )
+        self._aliases = MappingProxyType(dict(aliases or {}))
+        self._selections = {}
+
+    def __getstate__(self):
+        return (
+            self._order,
+            dict(self._dependencies),
+            {name: dict(command_params) for name, command_params in self._params.items()},
+            dict(self._aliases),
+        )
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @classmethod
+    def from_commands(cls, commands, merge_duplicates=False):
+        # type: (Dict[str, Command], bool) -> Plan
+        """
+        Validates the arguments of each command and orders them. Raises an exception if any are invalid. If
+        ``merge_duplicates`` is ``True``, duplicate commands are aliased to the first command they duplicate.
+        """
+
+        params = OrderedDict(
+            (name, command.validate_params({arg.name: arg.value for arg in command.arguments}))
+            for name, command in commands.items()
+        )
+
+        return cls.from_params(params, commands, merge_duplicates)
+
+    @classmethod
+    def from_params(cls, params, commands, merge_duplicates=False):
+        # type: (Dict[str, Dict[str, Any]], Dict[str, Command], bool) -> Plan
+        """ Creates a plan from the already cleaned arguments of each command in ``commands``. """
+
+        dependencies = OrderedDict((name, get_references(params[name])) for name in params)
+        aliases = find_duplicates(dependencies, params, commands) if merge_duplicates else {}
+
+        for name, original in aliases.items():
+            dependencies[name] = [original]
+
+        return cls(memory_order(dependencies, commands), dependencies, params, aliases)
+
+    def update(self, result_name, params, commands, merge_duplicates=False):
+        # type: (str, Dict[str, Any], Dict[str, Command], bool) -> Plan
+        """
+        Returns a new plan with the cleaned arguments of one command replaced, and its dependencies updated to match.
+        The arguments of other commands are reused, and the order is kept as long as it still runs each of the
+        command's new dependencies before it; otherwise it is computed again. If duplicates are merged, an edit can
+        make any command downstream of the edited one a duplicate (or no longer one), so the plan is created again
+        from the cleaned arguments (see :py:meth:`from_params`).
+        """
+
+        all_params = OrderedDict(self._params)
+        all_params[result_name] = params
+
+        if merge_duplicates or self._aliases:
+            return Plan.from_params(all_params, commands, merge_duplicates)
+
+        dependencies = OrderedDict(self._dependencies)
+        dependencies[result_name] = get_references(params)
+
+        position = {name: i for i, name in enumerate(self._order)}
+        if all(position.get(name, len(position)) < position[result_name] for name in dependencies[result_name]):
+            order = self._order
+        else:
+            order = memory_order(dependencies, commands)
+
+        return Plan(order, dependencies, all_params)
+
+    @property
+    def order(self):
+        # type: () -> Tuple[str, ...]
+        """ Every result name, in the order to run them (see :py:func:`~mpilot.executors.memory_order`) """
+
+        return self._order
+
+    @property
+    def dependencies(self):
+        # type: () -> Mapping[str, Tuple[str, ...]]
+        """ The results each command depends on, in the form of ``{result_name: (upstream_name, ...), ...}`` """
+
+        return self._dependencies
+
+    @property
+    def params(self):
+        # type: () -> Mapping[str, Mapping[str, Any]]
+        """ The cleaned arguments of each command, in the form of ``{result_name: {name: value, ...}, ...}`` """
+
+        return self._params
+
+    @property
+    def aliases(self):
+        # type: () -> Mapping[str, str]
+        """ Duplicate commands, in the form of ``{result_name: original_result_name, ...}`` """
+
+        return self._aliases
+
+    def select(self, targets):
+        # type: (Sequence[str]) -> Tuple[List[str], Dict[str, Tuple[str, ...]]]
+        """ Returns the order and dependencies of only the ``targets`` and the results they depend on. """
+
+        key = tuple(sorted(set(targets)))
+
+        if key not in self._selections:
+            for name in key:
+                if name not in self._dependencies:
+                    raise ResultDoesNotExist(name)
+
+            needed = upstream(self._dependencies, key)
+
+            if len(needed) == len(self._order):
+                self._selections[key] = (self._order, OrderedDict(self._dependencies))
+            else:
+                dependencies = OrderedDict(
+                    (name, self._dependencies[name]) for name in self._dependencies if name in needed
+                )
+                self._selections[key] = (memory_order(dependencies), dependencies)
+
+        order, dependencies = self._selections[key]
+        return list(order), dependencies
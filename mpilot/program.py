@@ -1,15 +1,15 @@
 from __future__ import absolute_import
 
 import pkgutil
+import threading
 from collections import Counter, OrderedDict
 from importlib import import_module
 
 import six
 
 if six.PY3:
-    from importlib.util import module_from_spec
-
-    from typing import Dict, Any, Union, TextIO, Sequence, Type  # noqa: F401 (used for typing)
+    from typing import Dict, Any, Union, TextIO, Sequence, Type, List  # noqa: F401 (used for typing)
+    from typing import Callable, Hashable  # noqa: F401 (used for typing)
     from types import ModuleType  # noqa: F401 (used for typing)
 
 from .arguments import Argument, ListArgument
@@ -20,10 +20,16 @@ from .exceptions import (
     MissingParameters,
     NoSuchParameter,
     MPilotError,
+    ResultDoesNotExist,
 )
+from .executors import Executor, ThreadExecutor, downstream
 from .params import ResultParameter, ListParameter
 from .parser.parser import Parser, ProgramNode
-from .utils import flatten, EEMS_COMMANDS, convert_eems2_commands
+from .plan import Plan
+from .spill import SpillStore
+from .tiling import run_tiled
+from .utils import EEMS_COMMANDS, convert_eems2_commands
+from .writer import BackgroundWriter
 
 EEMS_CSV_LIBRARIES = (
     "mpilot.libraries.eems.basic",
@@ -35,6 +41,11 @@ EEMS_NETCDF_LIBRARIES = (
     "mpilot.libraries.eems.netcdf",
     "mpilot.libraries.eems.fuzzy",
 )
+EEMS_NPY_LIBRARIES = (
+    "mpilot.libraries.eems.basic",
+    "mpilot.libraries.eems.npy",
+    "mpilot.libraries.eems.fuzzy",
+)
 
 
 class Program(object):
@@ -74,6 +85,51 @@ class Program(object):
 
         self.working_dir = working_dir
 
+        # Results which are kept when the program is run with `release_results`
+        self.pinned = set()
+
+        # The part of the grid being computed when the program is run in tiles, and the shape of the whole grid
+        self.window = None
+        self.grid_shape = None
+
+        # An optional `mpilot.cache.ResultCache`, used to reuse results from earlier runs
+        self.cache = None
+
+        # The plan from the last call to `compile`, reused until commands are added
+        self.plan = None
+
+        # Whether commands which compute the same result as another command share that command's result
+        self.merge_duplicates = False
+
+        # Defaults for arguments of commands which write output, such as compression settings, in the form of
+        # {name: value, ...}. Arguments given to a command take precedence.
+        self.output_defaults = {}
+
+        # Results discarded by `update_argument`, which are computed again by `rerun`
+        self.dirty = set()
+
+        # The `mpilot.writer.BackgroundWriter` which writes output during a run with `write_behind`
+        self.writer = None
+
+        # State shared by commands during a run, such as parsed input files, in the form of {key: resource, ...}
+        self.resources = {}
+        self.resource_lock = threading.Lock()
+        self.resource_locks = {}
+
+    def __getstate__(self):
+        # Resources and locks belong to this process; worker processes create their own
+        state = self.__dict__.copy()
+        for name in ("resources", "resource_lock", "resource_locks", "writer"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.writer = None
+        self.resources = {}
+        self.resource_lock = threading.Lock()
+        self.resource_locks = {}
+
     @classmethod
     def load_commands(cls, module):
         # type: (Union[str, ModuleType]) -> None
@@ -89,12 +145,10 @@ class Program(object):
 
         if hasattr(module, "__path__"):
             if six.PY3:
-                for info, name, _ in pkgutil.walk_packages(
+                for _, name, _ in pkgutil.walk_packages(
                     module.__path__, prefix=module.__name__ + "."
                 ):
-                    spec = info.find_spec(name)
-                    new_module = module_from_spec(spec)
-                    spec.loader.exec_module(new_module)
+                    import_module(name)
             else:
                 for info in pkgutil.iter_modules(module.__path__):
                     name = info[1]
@@ -191,6 +245,7 @@ class Program(object):
         self.commands[result_name] = command_cls(
             result_name, command_args, program=self, lineno=lineno
         )
+        self.plan = None
 
     def to_string(self):
         # type: () -> str
@@ -258,35 +313,213 @@ class Program(object):
 
         f.write(self.to_string())
 
-    def run(self):
-        # Build dependency lookup
-        dependents = {}  # {result_name, [dependent_name, ...], ...}
+    def compile(self):
+        # type: () -> Plan
+        """
+        Validates the arguments of every command, resolves references between commands, and returns a
+        :py:class:`~mpilot.plan.Plan` for running them. The plan is kept as :py:attr:`plan` and reused by later runs,
+        and commands use its cleaned arguments rather than cleaning their own. Call ``compile`` again after changing
+        the arguments of a command.
+
+        If :py:attr:`merge_duplicates` is set, commands which would compute the same result as an earlier command
+        are aliased to it in the plan (see :py:attr:`Plan.aliases <mpilot.plan.Plan.aliases>`), so that the result is
+        computed and held only once.
+        """
 
-        for command in self.commands.values():
-            references = []
-            for argument in command.arguments:
-                if argument.name in command.inputs:
-                    value = command.inputs[argument.name].clean(
-                        argument.value, self, lineno=argument.lineno
-                    )
+        self.plan = Plan.from_commands(self.commands, self.merge_duplicates)
+        return self.plan
 
-                    if isinstance(command.inputs[argument.name], ResultParameter):
-                        references.append(
-                            value.result_name if isinstance(value, Command) else value
-                        )
-                    if isinstance(value, (list, tuple)):
-                        references += [
-                            x for x in flatten(value) if isinstance(x, Command)
-                        ]
-
-            for reference in references:
-                dependents[reference] = dependents.get(reference, set())
-                dependents[reference].add(command.result_name)
-
-        # Find and run leaf nodes (commands without any dependents)
-        for command in (
-            command
-            for command in self.commands.values()
-            if not dependents.get(command.result_name)
-        ):
-            command.run()
+    def get_dependencies(self):
+        # type: () -> Dict[str, List[str]]
+        """
+        Validates the arguments of every command and returns the results each command depends on, in the form of
+        ``{result_name: [upstream_name, ...], ...}``.
+        """
+
+        plan = self.plan or self.compile()
+        return OrderedDict((name, list(upstream)) for name, upstream in plan.dependencies.items())
+
+    def update_argument(self, result_name, name, value):
+        # type: (str, str, Any) -> None
+        """
+        Changes an argument of a command. The command's result, and the result of every command which depends on it,
+        is discarded; results which aren't affected are kept. Use :py:meth:`rerun` to compute the discarded results
+        again.
+        """
+
+        try:
+            command = self.commands[result_name]
+        except KeyError:
+            raise ResultDoesNotExist(result_name)
+
+        if name not in command.inputs and not command.allow_extra_inputs:
+            raise NoSuchParameter(type(command), name, lineno=command.lineno)
+
+        if not isinstance(value, Argument):
+            value = Argument(name, value, command.argument_lines.get(name))
+        arguments = [arg for arg in command.arguments if arg.name != name] + [value]
+
+        # Validate the new argument before changing anything
+        params = command.validate_params({arg.name: arg.value for arg in arguments})
+        plan = self.plan or self.compile()
+        updated = plan.update(result_name, params, self.commands, self.merge_duplicates)
+
+        # A merged duplicate depends only on the command it was merged into, so commands downstream of the edit are
+        # found in both plans, along with those downstream of any command which became (or stopped being) a duplicate
+        changed = [result_name] + [
+            name
+            for name in set(plan.aliases) | set(updated.aliases)
+            if plan.aliases.get(name) != updated.aliases.get(name)
+        ]
+        affected = downstream(plan.dependencies, changed) | downstream(updated.dependencies, changed)
+
+        self.plan = updated
+        command.arguments = arguments
+        command.argument_lines[name] = value.lineno
+
+        for affected_name in affected:
+            affected_command = self.commands[affected_name]
+
+            if affected_command.is_finished:
+                self.dirty.add(affected_name)
+            affected_command.release()
+
+    def rerun(self, **kwargs):
+        # type: (Any) -> None
+        """
+        Computes the results discarded by :py:meth:`update_argument` since the last run, along with any other results
+        they need. Other finished results are reused. Takes the same arguments as :py:meth:`run`, except ``targets``.
+        """
+
+        dirty = sorted(self.dirty)
+        self.dirty = set()
+
+        if dirty:
+            self.run(targets=dirty, **kwargs)
+
+    def get_resource(self, key, factory):
+        # type: (Hashable, Callable[[], Any]) -> Any
+        """
+        Returns a resource shared by the commands of the program, such as an input file which has been parsed, calling
+        ``factory`` to create it the first time ``key`` is requested. Concurrent requests for the same key wait for it
+        to be created once. Resources are kept until the end of the run (see :py:meth:`clear_resources`), and aren't
+        copied to worker processes.
+        """
+
+        with self.resource_lock:
+            lock = self.resource_locks.setdefault(key, threading.Lock())
+
+        with lock:
+            if key not in self.resources:
+                self.resources[key] = factory()
+
+            return self.resources[key]
+
+    def clear_resources(self):
+        """ Discards every resource, closing those which have a ``close`` method. Called at the end of each run. """
+
+        with self.resource_lock:
+            resources = list(self.resources.values())
+            self.resources = {}
+            self.resource_locks = {}
+
+        for resource in resources:
+            if hasattr(resource, "close"):
+                resource.close()
+
+    def get_targets(self):
+        # type: () -> List[str]
+        """
+        Returns the results a program runs by default: commands with side effects, such as writing files. If there are
+        none, every command is a target.
+        """
+
+        targets = [name for name, command in self.commands.items() if command.has_side_effects]
+        return targets or list(self.commands)
+
+    def run(
+        self,
+        jobs=1,
+        executor=None,
+        release_results=False,
+        memory_budget=None,
+        spill_limit=None,
+        scratch_dir=None,
+        tile_shape=None,
+        targets=None,
+        plan=None,
+        write_behind=None,
+        prefetch=0,
+    ):
+        # type: (int, Executor, bool, int, int, str, Sequence[int], Sequence[str], Plan, int, int) -> None
+        """
+        Runs the program. Only the results named in ``targets``, and the results they depend on, are computed. By
+        default, the targets are commands with side effects, or every command if there are none (see
+        :py:meth:`get_targets`). Other results are computed only if they are accessed afterward.
+
+        The program is compiled first (see :py:meth:`compile`), unless it has been already or a ``plan`` is given.
+
+        Commands are run in dependency order, and up to ``jobs`` independent commands are run concurrently in a
+        thread pool. A custom :py:class:`~mpilot.executors.Executor` may be given instead.
+
+        If ``release_results`` is ``True``, intermediate results are released as soon as every command that depends on
+        them has finished, which keeps peak memory use down. Results without dependents, and results named in
+        :py:attr:`pinned`, are kept. Commands are ordered to keep as few results in memory at once as possible (see
+        :py:func:`~mpilot.executors.memory_order`), and ``memory_budget`` (in bytes) may be given to hold back
+        concurrent commands rather than exceed it.
+
+        If ``spill_limit`` (in bytes) is set, results waiting to be used by other commands are spilled to
+        memory-mapped files in ``scratch_dir`` (or the system temporary directory) whenever the results held in memory
+        exceed it. Spilled results are mapped back transparently when they are used.
+
+        If ``tile_shape`` is given, e.g. ``(rows, cols)``, the whole program is run once for each window of that size
+        over the input grids, so only one window of each result is held in memory at once. Commands which depend on
+        statistics of an entire input compute them over every window first, so the output is the same as an untiled
+        run. Every command reading data must support tiling (see :py:class:`~mpilot.tiling.TiledSourceMixin`), and
+        results are released afterward. With a :py:class:`~mpilot.executors.ProcessExecutor`, tiles are run
+        concurrently, one per worker process.
+
+        If ``write_behind`` (in bytes) is set, commands which write output hand their data to a background thread and
+        finish right away, so other commands are computed while it is written. Up to ``write_behind`` bytes of output
+        may be waiting to be written at once. The run returns once everything has been written, and raises the error
+        of the first write to fail, if any. Commands run in worker processes write their output directly.
+
+        If ``prefetch`` is greater than 0, commands which read input are started up to ``prefetch`` commands ahead of
+        their turn on an I/O thread, so that reading overlaps with computation (see
+        :py:meth:`~mpilot.executors.Executor.run`). Prefetched results count toward ``memory_budget``.
+        """
+
+        if plan is None:
+            plan = self.plan or self.compile()
+        self.plan = plan
+
+        order, dependencies = plan.select(targets if targets is not None else self.get_targets())
+
+        if executor is None:
+            executor = Executor() if jobs == 1 else ThreadExecutor(jobs)
+
+        kwargs = {
+            "release_results": release_results,
+            "memory_budget": memory_budget,
+            "spill_limit": spill_limit,
+            "spill_store": SpillStore(scratch_dir) if spill_limit is not None else None,
+            "prefetch": prefetch,
+        }
+
+        if write_behind:
+            self.writer = BackgroundWriter(write_behind)
+
+        try:
+            if tile_shape is None:
+                executor.run(self, order, dependencies, **kwargs)
+            else:
+                run_tiled(self, tile_shape, order, dependencies, executor, **kwargs)
+
+            if self.writer is not None:
+                self.writer.drain()
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+            self.clear_resources()
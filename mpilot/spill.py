@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy
+import six
+
+if six.PY3:
+    from typing import Any  # noqa: F401 (used for typing)
+
+
+class SpillStore(object):
+    """
+    Moves results out of memory into memory-mapped files in a scratch directory. A spilled result is replaced with an
+    equivalent array backed by the file, so commands reading it map it back transparently, and the operating system
+    can drop its pages from memory whenever they aren't in use.
+    """
+
+    def __init__(self, directory=None):
+        # type: (str) -> None
+
+        self.directory = directory
+        self.path = None
+        self.lock = threading.Lock()
+        self.counter = 0
+
+    def _create_file(self, arr):
+        # type: (numpy.ndarray) -> numpy.ndarray
+
+        with self.lock:
+            if self.path is None:
+                self.path = tempfile.mkdtemp(prefix="mpilot-", dir=self.directory)
+            self.counter += 1
+            path = os.path.join(self.path, "{}.dat".format(self.counter))
+
+        with open(path, "wb") as f:
+            numpy.ascontiguousarray(arr).tofile(f)
+
+        mapped = numpy.memmap(path, dtype=arr.dtype, mode="c", shape=arr.shape).view(
+            numpy.ndarray
+        )
+
+        # The mapping stays valid after the file is removed, and disk space is reclaimed once it is garbage collected.
+        # Where open files can't be removed, the file is left for `close` to clean up.
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+        return mapped
+
+    def spill(self, value):
+        # type: (Any) -> Any
+        """ Writes the data and mask of an array to disk, and returns a memory-mapped array with the same contents """
+
+        if not isinstance(value, numpy.ndarray) or value.dtype.hasobject or not value.size:
+            return value
+
+        if not isinstance(value, numpy.ma.MaskedArray):
+            return self._create_file(value)
+
+        mask = numpy.ma.getmask(value)
+        spilled = numpy.ma.MaskedArray(
+            self._create_file(numpy.ma.getdata(value)),
+            mask=self._create_file(mask) if mask is not numpy.ma.nomask else mask,
+            fill_value=value.fill_value,
+            hard_mask=value.hardmask,
+        )
+
+        return spilled
+
+    def close(self):
+        """ Removes the scratch directory. Any spilled results still referenced remain valid on POSIX systems. """
+
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
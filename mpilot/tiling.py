@@ -0,0 +1,410 @@
+from __future__ import absolute_import, division
+
+import itertools
+import math
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+import six
+
+if six.PY3:
+    from typing import Dict, List, Sequence, Tuple, Any, Iterator  # noqa: F401 (used for typing)
+
+from .exceptions import TilingNotSupported, MixedGridShapes
+from .executors import Executor, ProcessExecutor, upstream
+
+
+class Statistics(object):
+    """
+    The count, minimum, maximum, mean, and sum of squared differences from the mean of a set of values. Statistics of
+    separate parts of an array can be combined to give the statistics of the whole array.
+    """
+
+    def __init__(
+        self,
+        count=0,
+        minimum=numpy.ma.masked,
+        maximum=numpy.ma.masked,
+        mean=numpy.ma.masked,
+        m2=0.0,
+    ):
+        self.count = count
+        self.minimum = minimum
+        self.maximum = maximum
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def from_array(cls, arr):
+        # type: (numpy.ndarray) -> Statistics
+        """ Returns the statistics of the unmasked values of an array """
+
+        values = numpy.ma.compressed(arr)
+
+        if not values.size:
+            return cls()
+
+        mean = values.mean()
+
+        return cls(
+            count=values.size,
+            minimum=values.min(),
+            maximum=values.max(),
+            mean=mean,
+            m2=float(((values - mean) ** 2).sum()),
+        )
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count else numpy.ma.masked
+
+    def combine(self, other):
+        # type: (Statistics) -> Statistics
+        """ Returns the statistics of the values of both sets (Chan et al.'s parallel algorithm) """
+
+        if not other.count:
+            return self
+        if not self.count:
+            return other
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+
+        return Statistics(
+            count=count,
+            minimum=min(self.minimum, other.minimum),
+            maximum=max(self.maximum, other.maximum),
+            mean=self.mean + delta * other.count / count,
+            m2=self.m2 + other.m2 + delta ** 2 * self.count * other.count / count,
+        )
+
+
+def combine_statistics(statistics, other):
+    # type: (Dict[str, Statistics], Dict[str, Statistics]) -> Dict[str, Statistics]
+
+    return {key: value.combine(other[key]) for key, value in statistics.items()}
+
+
+class GlobalStatisticsMixin(object):
+    """
+    For commands which depend on statistics of an entire input, such as its minimum or mean. When a program is run in
+    tiles, these are computed over every tile of the input beforehand and set as :py:attr:`statistics`.
+    """
+
+    # The input the statistics are computed over
+    statistics_input = "InFieldName"
+
+    # Statistics of the entire input, if computed ahead of time
+    statistics = None
+
+    def statistics_passes(self, **kwargs):
+        # type: (Any) -> int
+        """ Returns the number of passes over the input needed to compute the statistics, or 0 if none are needed. """
+
+        return 1
+
+    def partial_statistics(self, pass_index, arr, statistics, **kwargs):
+        # type: (int, numpy.ndarray, Dict[str, Statistics], Any) -> Dict[str, Statistics]
+        """
+        Returns a dictionary of :py:class:`Statistics` for part of the input. ``statistics`` holds the combined results
+        of earlier passes. By default, the statistics of all values are returned as ``"values"``.
+        """
+
+        return {"values": Statistics.from_array(arr)}
+
+    def get_statistics(self, arr, **kwargs):
+        # type: (numpy.ndarray, Any) -> Dict[str, Statistics]
+        """ Returns the statistics computed ahead of time, or computes them from the (complete) input array """
+
+        if self.statistics is not None:
+            return self.statistics
+
+        statistics = {}
+        for pass_index in range(self.statistics_passes(**kwargs)):
+            statistics.update(self.partial_statistics(pass_index, arr, statistics, **kwargs))
+
+        return statistics
+
+
+class TiledSourceMixin(object):
+    """
+    For commands which read gridded data and can read a single window of it. When a program is run in tiles, the
+    window being computed is available as :py:attr:`~mpilot.commands.Command.window`.
+    """
+
+    def get_shape(self, **kwargs):
+        # type: (Any) -> Tuple[int, ...]
+        """ Returns the shape of the complete grid """
+
+        raise NotImplementedError
+
+
+def iter_windows(shape, tile_shape):
+    # type: (Sequence[int], Sequence[int]) -> Iterator[tuple]
+    """
+    Yields indexes which split the trailing dimensions of ``shape`` into tiles of (at most) ``tile_shape``, in row-major
+    order. Leading dimensions are included whole.
+    """
+
+    if len(tile_shape) > len(shape):
+        raise ValueError("The tile shape has more dimensions than the grid")
+
+    trailing = shape[len(shape) - len(tile_shape) :]
+    starts = [range(0, size, tile) for size, tile in zip(trailing, tile_shape)]
+
+    for start in itertools.product(*starts):
+        yield (Ellipsis,) + tuple(
+            slice(i, min(i + tile, size)) for i, tile, size in zip(start, tile_shape, trailing)
+        )
+
+
+def is_first_window(window):
+    # type: (tuple) -> bool
+    """ Returns ``True`` for the first window of a tiled run, which commands writing output use to create it. """
+
+    return all(index.start == 0 for index in window if isinstance(index, slice))
+
+
+def get_grid_shape(program, order, dependencies):
+    # type: (Any, List[str], Dict[str, List[str]]) -> Tuple[int, ...]
+    """
+    Returns the shape of the grids read by the program. Every command must support tiling, and every command which
+    reads data must be a :py:class:`TiledSourceMixin`.
+    """
+
+    shape = None
+
+    for name in order:
+        command = program.commands[name]
+        if not command.tileable:
+            raise TilingNotSupported(command.name, command.lineno)
+
+        if dependencies[name]:
+            continue
+
+        if not isinstance(command, TiledSourceMixin):
+            raise TilingNotSupported(command.name, command.lineno)
+
+        params = command.get_params()
+        source_shape = tuple(command.get_shape(**params))
+
+        if shape is None:
+            shape = source_shape
+        elif source_shape != shape:
+            raise MixedGridShapes(shape, source_shape, command.lineno)
+
+    return shape
+
+
+def output_lock():
+    """
+    Returns the lock held by commands while they write a window of output. In tile-parallel runs, the lock is shared
+    by every worker process.
+    """
+
+    return _output_lock
+
+
+_output_lock = threading.Lock()
+
+# The program run by this worker process in a tile-parallel run
+_worker_program = None
+
+
+def _init_worker(program, lock):
+    global _worker_program, _output_lock
+
+    _worker_program = program
+    _output_lock = lock
+
+
+def _run_window(program, window, order, dependencies, executor, **kwargs):
+    program.window = window
+
+    for name in order:
+        program.commands[name].release()
+
+    executor.run(program, order, dependencies, **kwargs)
+
+
+def _partial_statistics(program, requests, computed):
+    partials = {}
+
+    for name, pass_index in requests:
+        command = program.commands[name]
+        params = command.get_params()
+        arr = params[command.statistics_input].result
+        partials[name] = command.partial_statistics(pass_index, arr, computed[name], **params)
+
+    return partials
+
+
+def _run_window_in_process(window, order, dependencies, pinned, requests, computed, finished):
+    program = _worker_program
+    program.pinned = set(pinned)
+
+    for name, statistics in finished.items():
+        program.commands[name].statistics = statistics
+
+    _run_window(program, window, order, dependencies, Executor(), release_results=True)
+
+    return _partial_statistics(program, requests, computed)
+
+
+class WindowRunner(object):
+    """ Runs the commands of a program for each window in turn, using the given executor. """
+
+    def __init__(self, program, executor, **kwargs):
+        # type: (Any, Executor, Any) -> None
+
+        self.program = program
+        self.executor = executor
+        self.kwargs = kwargs
+
+    def start(self):
+        """ Called before the first window is run. """
+
+    def shutdown(self):
+        """ Called after the last window is run, or after an error. """
+
+    def run(self, windows, order, dependencies, requests=(), computed=None):
+        # type: (List[tuple], List[str], Dict[str, List[str]], Sequence[Tuple[str, int]], Dict[str, Any]) -> Iterator
+        """
+        Runs the commands in ``order`` for each window, and yields the partial statistics of each window, in order.
+        ``requests`` lists the ``(result_name, pass_index)`` of each command to compute partial statistics for, and
+        ``computed`` holds the statistics of their earlier passes.
+        """
+
+        for window in windows:
+            _run_window(self.program, window, order, dependencies, self.executor, **self.kwargs)
+            yield _partial_statistics(self.program, requests, computed)
+
+
+class ProcessWindowRunner(WindowRunner):
+    """
+    Runs windows concurrently in a pool of worker processes, each of which runs every command for its window. The first
+    window is run on its own, so that commands writing output can create it before other windows are written.
+    """
+
+    def start(self):
+        # Results are not needed by the workers, and would otherwise be copied to each of them
+        for command in self.program.commands.values():
+            command.release()
+
+        mp_context = self.executor.mp_context or multiprocessing.get_context()
+
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.executor.jobs,
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(self.program, mp_context.Lock()),
+        )
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+    def run(self, windows, order, dependencies, requests=(), computed=None):
+        finished = {
+            name: command.statistics
+            for name, command in self.program.commands.items()
+            if isinstance(command, GlobalStatisticsMixin) and command.statistics is not None
+        }
+        args = (order, dependencies, sorted(self.program.pinned), requests, computed, finished)
+
+        if not windows:
+            return
+
+        yield self.pool.submit(_run_window_in_process, windows[0], *args).result()
+
+        futures = [self.pool.submit(_run_window_in_process, window, *args) for window in windows[1:]]
+        for future in futures:
+            yield future.result()
+
+
+def _compute_statistics(program, windows, order, dependencies, runner):
+    pending = []
+    for name in order:
+        command = program.commands[name]
+
+        # Duplicates share the result of the original command, so they don't need statistics of their own
+        if isinstance(command, GlobalStatisticsMixin) and command.get_alias() is None:
+            params = command.get_params()
+            passes = command.statistics_passes(**params)
+
+            if passes:
+                pending.append((command, params[command.statistics_input].result_name, passes))
+
+    # Each sweep over the windows computes the statistics of every command whose input doesn't depend on statistics
+    # which are still pending. Partial statistics are combined in window order, so results don't depend on the order
+    # in which windows finish.
+    while pending:
+        pending_names = {command.result_name for command, _, _ in pending}
+        ready = [item for item in pending if not pending_names.intersection(upstream(dependencies, [item[1]]))]
+        pending = [item for item in pending if item not in ready]
+
+        sources = {source for _, source, _ in ready}
+        needed = upstream(dependencies, sources)
+        sweep_order = [name for name in order if name in needed]
+        computed = {command.result_name: {} for command, _, _ in ready}
+
+        pinned = program.pinned
+        program.pinned = pinned.union(sources)
+
+        try:
+            for pass_index in range(max(passes for _, _, passes in ready)):
+                requests = [(command.result_name, pass_index) for command, _, passes in ready if pass_index < passes]
+                combined = {}
+
+                for partials in runner.run(windows, sweep_order, dependencies, requests, computed):
+                    for name, partial in partials.items():
+                        combined[name] = combine_statistics(combined[name], partial) if name in combined else partial
+
+                for name, statistics in combined.items():
+                    computed[name].update(statistics)
+        finally:
+            program.pinned = pinned
+
+        for command, _, _ in ready:
+            command.statistics = computed[command.result_name]
+
+
+def run_tiled(program, tile_shape, order, dependencies, executor, **kwargs):
+    # type: (Any, Sequence[int], List[str], Dict[str, List[str]], Any, Any) -> None
+    """
+    Runs every command of a program once for each tile of the grid it reads. Statistics needed by commands which
+    depend on an entire input are computed over all tiles first. Afterward, results are released, since each only
+    holds the last tile.
+
+    With a :py:class:`~mpilot.executors.ProcessExecutor`, tiles are run concurrently in its number of worker
+    processes, and each worker runs the commands for its tile one at a time.
+    """
+
+    shape = get_grid_shape(program, order, dependencies)
+    windows = list(iter_windows(shape, tile_shape)) if shape is not None else []
+    program.grid_shape = shape
+
+    if isinstance(executor, ProcessExecutor):
+        runner = ProcessWindowRunner(program, executor)
+    else:
+        runner = WindowRunner(program, executor, **kwargs)
+
+    runner.start()
+
+    try:
+        _compute_statistics(program, windows, order, dependencies, runner)
+
+        for _ in runner.run(windows, order, dependencies):
+            pass
+    finally:
+        runner.shutdown()
+        program.window = None
+        program.grid_shape = None
+
+        for name in order:
+            command = program.commands[name]
+            command.release()
+
+            if isinstance(command, GlobalStatisticsMixin):
+                command.statistics = None
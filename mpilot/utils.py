@@ -3,7 +3,7 @@ import six
 from numpy.ma import is_masked
 
 if six.PY3:
-    from typing import Sequence, Any  # noqa: F401 (used for typing)
+    from typing import Sequence, Any, Union  # noqa: F401 (used for typing)
 
 from mpilot.exceptions import ProgramError
 from mpilot.parser.parser import CommandNode
@@ -103,3 +103,29 @@ def make_masked(arr):
     if is_masked(arr):
         return arr
     return numpy.ma.asarray(arr)
+
+
+def result_nbytes(value):
+    # type: (Any) -> int
+    """ Returns the number of bytes held by a command result: the data and mask of arrays, or 0 for other values """
+
+    if not isinstance(value, numpy.ndarray):
+        return 0
+
+    mask = numpy.ma.getmask(value)
+    return value.nbytes + (mask.nbytes if mask is not numpy.ma.nomask else 0)
+
+
+def parse_size(value):
+    # type: (Union[str, int]) -> int
+    """ Parses a size in bytes with an optional K, M, G or T suffix (e.g., "512M") """
+
+    if isinstance(value, six.integer_types):
+        return value
+
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    value = value.strip().upper().rstrip("B")
+
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
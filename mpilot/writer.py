@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+
+import threading
+from collections import deque
+from traceback import format_exc
+
+import six
+
+if six.PY3:
+    from typing import Any, Callable  # noqa: F401 (used for typing)
+
+from .exceptions import MPilotError, UnexpectedError
+
+
+class BackgroundWriter(object):
+    """
+    Writes output in a background thread, so that commands which write output finish as soon as their data is queued,
+    and other commands are computed while it is compressed and written. Writes are run one at a time, in the order
+    they were submitted.
+
+    At most ``max_bytes`` of data waits to be written at once. Submitting more blocks until earlier writes finish,
+    although a single write larger than ``max_bytes`` is always accepted when nothing else is waiting.
+    """
+
+    def __init__(self, max_bytes):
+        # type: (int) -> None
+
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        self.queue = deque()  # [(command, write, nbytes), ...]
+        self.pending_bytes = 0
+        self.pending = 0  # Writes queued or running
+        self.error = None
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._run, name="mpilot-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, command, write, nbytes=0):
+        # type: (Any, Callable[[], None], int) -> None
+        """
+        Queues ``write``, a function which writes the output of ``command``. If an earlier write has failed, its error
+        is raised instead.
+        """
+
+        with self.condition:
+            while self.error is None and self.pending and self.pending_bytes + nbytes > self.max_bytes:
+                self.condition.wait()
+
+            if self.error is not None:
+                raise self.error
+
+            self.queue.append((command, write, nbytes))
+            self.pending_bytes += nbytes
+            self.pending += 1
+            self.condition.notify_all()
+
+    def drain(self):
+        """ Waits for every queued write to finish, and raises the error of the first one which failed, if any """
+
+        with self.condition:
+            while self.pending and self.error is None:
+                self.condition.wait()
+
+            if self.error is not None:
+                raise self.error
+
+    def close(self):
+        """ Discards writes which haven't started, and waits for the current write to finish """
+
+        with self.condition:
+            self.closed = True
+            self._discard()
+            self.condition.notify_all()
+
+        self.thread.join()
+
+    def _discard(self):
+        # Called with the condition held
+        for _, _, nbytes in self.queue:
+            self.pending_bytes -= nbytes
+        self.pending -= len(self.queue)
+        self.queue.clear()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+
+                if not self.queue:
+                    return
+
+                command, write, nbytes = self.queue.popleft()
+
+            try:
+                write()
+            except Exception as exc:
+                error = exc
+                if not isinstance(exc, MPilotError):
+                    error = UnexpectedError(exc, format_exc(), command.lineno)
+                    error.__cause__ = exc
+
+                with self.condition:
+                    if self.error is None:
+                        self.error = error
+
+                    # Later writes are skipped, since the run has failed
+                    self._discard()
+
+            with self.condition:
+                self.pending_bytes -= nbytes
+                self.pending -= 1
+                self.condition.notify_all()
+
+
+def write_behind(command, write, nbytes=0):
+    # type: (Any, Callable[[], None], int) -> None
+    """
+    Runs ``write``, a function which writes the output of ``command``, in the background writer of the command's
+    program if it has one (see the ``write_behind`` argument of :py:meth:`mpilot.program.Program.run`), or immediately
+    otherwise. ``nbytes`` is the size of the data held by ``write``. Anything ``write`` depends on which may change
+    before it runs, such as :py:attr:`~mpilot.commands.Command.window`, must be read beforehand. Since ``write`` may run
+    while other commands read input, it must hold any lock its library needs for either, such as the ``NETCDF_LOCK`` of
+    :py:mod:`mpilot.libraries.eems.netcdf.io`.
+    """
+
+    writer = getattr(command.program, "writer", None)
+
+    if writer is None:
+        write()
+    else:
+        writer.submit(command, write, nbytes)
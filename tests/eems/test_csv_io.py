@@ -12,7 +12,8 @@ if six.PY3:
 else:
     from mock import mock_open, patch, call
 
-from mpilot.libraries.eems.csv.io import EEMSRead, EEMSWrite
+from mpilot.libraries.eems.csv.io import CSVTable, EEMSRead, EEMSWrite
+from mpilot.program import Program
 
 
 def test_eems_write():
@@ -30,6 +31,23 @@ def test_eems_write():
         )
 
 
+def test_eems_write_options(tmp_path, monkeypatch):
+    monkeypatch.setattr("mpilot.libraries.eems.csv.io.CHUNK_ROWS", 2)
+    a_command = create_command_with_result("A", numpy.ma.masked_array([1.25, 2.5, 3.0], mask=[False, True, False]))
+    b_command = create_command_with_result("B", numpy.ma.masked_array([1, 2, 3], mask=[True, False, False]))
+    path = str(tmp_path / "out.csv")
+
+    EEMSWrite("WriteResult").execute(OutFileName=path, OutFieldNames=[a_command, b_command])
+    with open(path) as f:
+        assert f.read() == "A,B\n1.25,--\n--,2.0\n3.0,3.0\n"
+
+    EEMSWrite("WriteResult").execute(
+        OutFileName=path, OutFieldNames=[a_command, b_command], MissingVal="NA", Precision=1
+    )
+    with open(path) as f:
+        assert f.read() == "A,B\n1.2,NA\nNA,2.0\n3.0,3.0\n"
+
+
 def test_read_empty_field():
     mock = mock_open(read_data="a,b,c\n1,2,3\n4,,6")
 
@@ -38,3 +56,71 @@ def test_read_empty_field():
             EEMSRead("ReadResult").execute(InFileName="test.csv", InFieldName="b")
 
     assert 'in the field "b" on line 3' in str(ex)
+
+
+def test_read_shared_table(tmp_path, monkeypatch):
+    (tmp_path / "input.csv").write_text(u"a,b,name\n1,2,x\n4,5,y\n")
+    source = """
+        A = EEMSRead(InFileName = "input.csv", InFieldName = "a")
+        B = EEMSRead(InFileName = "input.csv", InFieldName = "b", DataType = Integer)
+    """
+
+    parsed = []
+    init = CSVTable.__init__
+
+    def count_init(self, path, field_names, **kwargs):
+        parsed.append(sorted(field_names))
+        init(self, path, field_names, **kwargs)
+
+    monkeypatch.setattr(CSVTable, "__init__", count_init)
+
+    program = Program.from_source(source, working_dir=str(tmp_path))
+    program.run()
+
+    assert parsed == [["a", "b"]]
+    assert program.resources == {}
+    assert program.commands["A"].result.tolist() == [1.0, 4.0]
+    assert program.commands["B"].result.dtype == int
+    assert program.commands["B"].result.tolist() == [2, 5]
+
+
+
+def test_read_chunks(tmp_path):
+    path = tmp_path / "input.csv"
+    path.write_text(u"a,b,name\n1,2,x\n\n4,-9999,y\n7,8,z\n\n10,11,w\n")
+
+    table = CSVTable(str(path), ["a", "b", "name", "missing"], chunk_rows=2)
+    assert table.get_column("a").tolist() == [1, 4, 7, 10]
+
+    with pytest.raises(InvalidDataFile) as ex:
+        table.get_column("name")
+    assert 'in the field "name" on line 2' in str(ex)
+
+    with pytest.raises(InvalidDataFile) as ex:
+        table.get_column("missing")
+    assert "doesn't contain the header missing" in str(ex)
+
+    result = EEMSRead("ReadResult").execute(InFileName=str(path), InFieldName="b", MissingVal=-9999)
+    assert result.tolist() == [2, None, 8, 11]
+
+    path.write_text(u"a\n1\n2\n\n3\nx\n")
+    with pytest.raises(InvalidDataFile) as ex:
+        CSVTable(str(path), ["a"], chunk_rows=2).get_column("a")
+    assert 'in the field "a" on line 6' in str(ex)
+
+
+@pytest.mark.parametrize("extension", [".csv.gz", ".csv.bz2", ".csv.xz"])
+def test_compressed(tmp_path, monkeypatch, extension):
+    monkeypatch.setattr("mpilot.libraries.eems.csv.io.CHUNK_ROWS", 2)
+    arr = numpy.ma.masked_array(numpy.arange(7, dtype=float), mask=[False] * 6 + [True])
+    path = str(tmp_path / ("out" + extension))
+
+    EEMSWrite("WriteResult").execute(
+        OutFileName=path, OutFieldNames=[create_command_with_result("A", arr)], MissingVal="-9999"
+    )
+
+    with open(path, "rb") as f:
+        assert b"A\n" not in f.read()
+
+    result = EEMSRead("ReadResult").execute(InFileName=path, InFieldName="A", MissingVal=-9999)
+    assert result.tolist() == [0, 1, 2, 3, 4, 5, None]
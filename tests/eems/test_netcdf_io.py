@@ -1,10 +1,21 @@
+import shutil
 import tempfile
+import threading
 from pathlib import Path
 
 import numpy
+import pytest
 from netCDF4 import Dataset
 
-from mpilot.libraries.eems.netcdf.io import EEMSWrite, EEMSRead
+from mpilot.arguments import Argument
+from mpilot.executors import ProcessExecutor
+from mpilot.libraries.eems.netcdf.exceptions import (
+    InvalidSubset,
+    InvalidPositiveData,
+    InvalidFuzzyData,
+    SubsetMismatch,
+)
+from mpilot.libraries.eems.netcdf.io import EEMSWrite, EEMSRead, offset_geotransform
 from ..utils import create_command_with_result
 
 TEST_NETCDF_DIMENSIONS = (17, 11)
@@ -232,3 +243,436 @@ def test_eems_read():
     ).reshape(TEST_NETCDF_DIMENSIONS[1], TEST_NETCDF_DIMENSIONS[0])
 
     assert (read_result == expected_result).all()
+
+
+def test_dataset_pool(tmp_path, monkeypatch):
+    from mpilot.libraries.eems.netcdf import io
+    from mpilot.program import Program, EEMS_NETCDF_LIBRARIES
+
+    shutil.copy(str(Path(__file__).parent / "data" / "netcdf_test.nc"), str(tmp_path / "input.nc"))
+    source = """
+        A = EEMSRead(InFileName = "input.nc", InFieldName = "elevation")
+        B = EEMSRead(InFileName = "input.nc", InFieldName = "elevation", DataType = Integer)
+        Out = EEMSWrite(
+            OutFileName = "out.nc", OutFieldNames = [A, B], DimensionFileName = "input.nc", DimensionFieldName = "elevation"
+        )
+    """
+
+    opened = []
+
+    def open_counted(path, *args, **kwargs):
+        opened.append(path)
+        return Dataset(path, *args, **kwargs)
+
+    monkeypatch.setattr(io, "Dataset", open_counted)
+
+    program = Program.from_source(source, libraries=EEMS_NETCDF_LIBRARIES, working_dir=str(tmp_path))
+    program.run()
+
+    assert opened.count(str(tmp_path / "input.nc")) == 1
+    assert program.resources == {}
+
+    pool = io.DatasetPool(max_open=1)
+    with pool.open(str(tmp_path / "input.nc")) as dataset:
+        # Datasets are used by one thread at a time
+        assert io.NETCDF_LOCK._is_owned()
+
+        with pool.open(str(tmp_path / "out.nc")) as other:
+            pass
+
+        # Datasets in use aren't closed, so the other one is closed to keep within the limit
+        assert dataset.isopen()
+        assert not other.isopen()
+
+    assert list(pool.datasets) == [str(tmp_path / "input.nc")]
+
+    pool.close()
+    assert not pool.datasets
+    assert not dataset.isopen()
+
+
+@pytest.mark.parametrize("write_behind, prefetch", [(None, 0), (1000, 0), (None, 4), (1000, 4)])
+def test_threaded(tmp_path, monkeypatch, write_behind, prefetch):
+    from mpilot.libraries.eems.netcdf import io
+    from mpilot.program import Program, EEMS_NETCDF_LIBRARIES
+
+    lines = []
+    for i in range(8):
+        shutil.copy(str(Path(__file__).parent / "data" / "netcdf_test.nc"), str(tmp_path / "input{}.nc".format(i)))
+        lines.append('A{0} = EEMSRead(InFileName = "input{0}.nc", InFieldName = "elevation")'.format(i))
+        lines.append('B{0} = EEMSRead(InFileName = "input{0}.nc", InFieldName = "elevation", Rows = [2, 7])'.format(i))
+        lines.append(
+            'Out{0} = EEMSWrite(OutFileName = "out{0}.nc", OutFieldNames = [A{0}], DimensionFileName = "input{0}.nc", '
+            'DimensionFieldName = "elevation")'.format(i)
+        )
+        lines.append(
+            'Rows{0} = EEMSWrite(OutFileName = "rows{0}.nc", OutFieldNames = [B{0}], DimensionFileName = "input{0}.nc",'
+            ' DimensionFieldName = "elevation", Rows = [2, 7])'.format(i)
+        )
+
+    threads = set()
+    read_variable = io.read_variable
+
+    def open_locked(*args, **kwargs):
+        assert io.NETCDF_LOCK._is_owned()
+        threads.add(threading.current_thread().name)
+        return Dataset(*args, **kwargs)
+
+    def read_locked(*args, **kwargs):
+        assert io.NETCDF_LOCK._is_owned()
+        threads.add(threading.current_thread().name)
+        return read_variable(*args, **kwargs)
+
+    monkeypatch.setattr(io, "Dataset", open_locked)
+    monkeypatch.setattr(io, "read_variable", read_locked)
+
+    program = Program.from_source("\n".join(lines), libraries=EEMS_NETCDF_LIBRARIES, working_dir=str(tmp_path))
+    program.run(jobs=8, write_behind=write_behind, prefetch=prefetch)
+
+    # Output is written by the background writer, and input is read ahead by the I/O thread, while other threads read
+    # and write
+    assert ("mpilot-writer" in threads) == bool(write_behind)
+    assert any(name.startswith("mpilot-prefetch") for name in threads) == bool(prefetch)
+
+    with Dataset(str(tmp_path / "input0.nc")) as dataset:
+        elevation = dataset["elevation"][:]
+
+    for i in range(8):
+        with Dataset(str(tmp_path / "out{}.nc".format(i))) as dataset:
+            assert numpy.ma.allequal(dataset["A{}".format(i)][:], elevation)
+        with Dataset(str(tmp_path / "rows{}.nc".format(i))) as dataset:
+            assert numpy.ma.allequal(dataset["B{}".format(i)][:], elevation[2:7])
+
+
+@pytest.mark.parametrize("tile_shape, write_behind", [(None, None), ((2, 3), None), ((2, 3), 100)])
+def test_subset(tmp_path, tile_shape, write_behind):
+    from mpilot.program import Program, EEMS_NETCDF_LIBRARIES
+
+    shutil.copy(str(Path(__file__).parent / "data" / "netcdf_test.nc"), str(tmp_path / "input.nc"))
+
+    with Dataset(str(tmp_path / "input.nc"), "a") as dataset:
+        dataset["lat"][:] = 46.9012 - numpy.arange(11) * 0.00833
+        elevation = dataset["elevation"][:]
+        lat = dataset["lat"][:]
+        lon = dataset["lon"][:]
+
+    source = """
+        Rows = EEMSRead(InFileName = "input.nc", InFieldName = "elevation", Rows = [2, 7], Columns = [3, 11])
+        Box = EEMSRead(InFileName = "input.nc", InFieldName = "elevation", BoundingBox = [{}, {}, {}, {}])
+        Out = EEMSWrite(
+            OutFileName = "out.nc",
+            OutFieldNames = [Rows, Box],
+            DimensionFileName = "input.nc",
+            DimensionFieldName = "elevation",
+            Rows = [2, 7],
+            Columns = [3, 11]
+        )
+    """.format(lon[3], lat[6], lon[10], lat[2])
+
+    program = Program.from_source(source, libraries=EEMS_NETCDF_LIBRARIES, working_dir=str(tmp_path))
+    program.run(tile_shape=tile_shape, write_behind=write_behind)
+
+    with Dataset(str(tmp_path / "out.nc")) as dataset:
+        assert numpy.array_equal(dataset["lat"][:], lat[2:7])
+        assert numpy.array_equal(dataset["lon"][:], lon[3:11])
+
+        for name in ("Rows", "Box"):
+            assert numpy.ma.allequal(dataset[name][:], elevation[2:7, 3:11])
+
+    geotransform = offset_geotransform("-110.925 0.0083 0 46.905 0 -0.0083", (slice(2, 7), slice(3, 11)), (11, 17))
+    assert [float(value) for value in geotransform.split()] == pytest.approx(
+        [-110.925 + 3 * 0.0083, 0.0083, 0, 46.905 - 2 * 0.0083, 0, -0.0083]
+    )
+
+
+@pytest.mark.parametrize("tile_shape", [None, (2, 3)])
+def test_subset_mismatch(tmp_path, tile_shape):
+    from mpilot.program import Program, EEMS_NETCDF_LIBRARIES
+
+    shutil.copy(str(Path(__file__).parent / "data" / "netcdf_test.nc"), str(tmp_path / "input.nc"))
+    source = """
+        Rows = EEMSRead(InFileName = "input.nc", InFieldName = "elevation", Rows = [2, 7])
+        Out = EEMSWrite(
+            OutFileName = "out.nc", OutFieldNames = [Rows], DimensionFileName = "input.nc", DimensionFieldName = "elevation"
+        )
+    """
+
+    program = Program.from_source(source, libraries=EEMS_NETCDF_LIBRARIES, working_dir=str(tmp_path))
+    with pytest.raises(SubsetMismatch) as exc_info:
+        program.run(tile_shape=tile_shape)
+
+    assert exc_info.value.lineno == 3
+    assert "the whole grid" in str(exc_info.value)
+    assert "Rows = [2, 7]" in str(exc_info.value)
+    assert not (tmp_path / "out.nc").exists()
+
+
+def test_invalid_subset(tmp_path):
+    from mpilot.program import Program, EEMS_NETCDF_LIBRARIES
+
+    in_file = str(Path(__file__).parent / "data" / "netcdf_test.nc")
+
+    with pytest.raises(InvalidSubset):
+        EEMSRead("ReadResult").execute(InFileName=in_file, InFieldName="elevation", Rows=[5, 20])
+
+    with pytest.raises(InvalidSubset):
+        EEMSRead("ReadResult").execute(InFileName=in_file, InFieldName="elevation", BoundingBox=[0, 0, 1, 1])
+
+    # Errors point at the command with the invalid subset, whether it reads or writes
+    source = """
+        A = EEMSRead(InFileName = "{0}", InFieldName = "elevation")
+        B = EEMSRead(InFileName = "{0}", InFieldName = "elevation", Rows = [5, 20])
+    """.format(in_file)
+    program = Program.from_source(source, libraries=EEMS_NETCDF_LIBRARIES)
+    with pytest.raises(InvalidSubset) as exc_info:
+        program.run()
+    assert exc_info.value.lineno == 3
+
+    source = """
+        A = EEMSRead(InFileName = "{0}", InFieldName = "elevation")
+        Out = EEMSWrite(
+            OutFileName = "out.nc",
+            OutFieldNames = [A],
+            DimensionFileName = "{0}",
+            DimensionFieldName = "elevation",
+            BoundingBox = [0, 0, 1, 1]
+        )
+    """.format(in_file)
+    program = Program.from_source(source, libraries=EEMS_NETCDF_LIBRARIES, working_dir=str(tmp_path))
+    with pytest.raises(InvalidSubset) as exc_info:
+        program.run()
+    assert exc_info.value.lineno == 3
+    assert not (tmp_path / "out.nc").exists()
+
+
+@pytest.mark.parametrize("executor", [None, ProcessExecutor(2)])
+def test_write_options(tmp_path, executor):
+    from mpilot.program import Program, EEMS_NETCDF_LIBRARIES
+
+    shutil.copy(str(Path(__file__).parent / "data" / "netcdf_test.nc"), str(tmp_path / "input.nc"))
+    source = """
+        A = EEMSRead(InFileName = "input.nc", InFieldName = "elevation")
+        B = EEMSRead(InFileName = "input.nc", InFieldName = "elevation", DataType = Integer)
+        Out = EEMSWrite(
+            OutFileName = "out.nc",
+            OutFieldNames = [A, B],
+            DimensionFileName = "input.nc",
+            DimensionFieldName = "elevation",
+            ChunkShape = [4, 20],
+            OutputType = Float32,
+            SignificantDigits = 1
+        )
+    """
+
+    program = Program.from_source(source, libraries=EEMS_NETCDF_LIBRARIES, working_dir=str(tmp_path))
+    program.output_defaults = {"CompressionLevel": 6, "Shuffle": False, "ChunkShape": [1, 1]}
+    program.run(executor=executor)
+
+    with Dataset(str(tmp_path / "out.nc")) as dataset:
+        for name in ("A", "B"):
+            variable = dataset[name]
+
+            assert variable.dtype == numpy.float32
+            assert variable.chunking() == [4, 17]
+            assert variable.filters()["complevel"] == 6
+            assert not variable.filters()["shuffle"]
+            assert variable.least_significant_digit == 1
+
+    # Without any options, results are written with their own type and the default compression
+    source = source.replace("ChunkShape = [4, 20],", "").replace("OutputType = Float32,", "")
+    program = Program.from_source(source, libraries=EEMS_NETCDF_LIBRARIES, working_dir=str(tmp_path))
+    program.output_defaults = {"CompressionLevel": 0}
+    program.run(executor=executor)
+
+    with Dataset(str(tmp_path / "out.nc")) as dataset:
+        assert dataset["A"].dtype == numpy.float64
+        assert dataset["B"].dtype == numpy.int64
+        assert not dataset["A"].filters()["zlib"]
+
+
+def test_append(tmp_path, monkeypatch):
+    from mpilot.libraries.eems.netcdf import io
+    from mpilot.libraries.eems.netcdf.exceptions import DimensionMismatch
+    from mpilot.program import Program, EEMS_NETCDF_LIBRARIES
+
+    shutil.copy(str(Path(__file__).parent / "data" / "netcdf_test.nc"), str(tmp_path / "input.nc"))
+
+    with Dataset(str(tmp_path / "input.nc"), "a") as dataset:
+        dataset["elevation"].esri_pe_string = "GEOGCS[]"
+
+    source = """
+        A = EEMSRead(InFileName = "input.nc", InFieldName = "elevation")
+        B = EEMSRead(InFileName = "input.nc", InFieldName = "elevation", DataType = Integer)
+        OutA = EEMSWrite(
+            OutFileName = "out.nc",
+            OutFieldNames = [A],
+            DimensionFileName = "input.nc",
+            DimensionFieldName = "elevation",
+            Append = True
+        )
+        OutB = EEMSWrite(
+            OutFileName = "out.nc",
+            OutFieldNames = [B],
+            DimensionFileName = "input.nc",
+            DimensionFieldName = "elevation",
+            Append = True
+        )
+    """
+
+    reads = []
+    read = io.GridTemplate.read.__func__
+
+    def counting_read(cls, *args, **kwargs):
+        reads.append(args[0])
+        return read(cls, *args, **kwargs)
+
+    monkeypatch.setattr(io.GridTemplate, "read", classmethod(counting_read))
+
+    program = Program.from_source(source, libraries=EEMS_NETCDF_LIBRARIES, working_dir=str(tmp_path))
+    program.run()
+
+    # The template is read once, and shared by both outputs
+    assert len(reads) == 1
+
+    # Variables which already exist are overwritten
+    program.run()
+
+    with Dataset(str(tmp_path / "out.nc")) as dataset:
+        assert set(dataset.variables) == {"lat", "lon", "crs", "A", "B"}
+        assert dataset["B"].esri_pe_string == "GEOGCS[]"
+        assert dataset["B"].grid_mapping == "crs"
+        assert dataset["crs"].grid_mapping_name == "latitude_longitude"
+        assert numpy.ma.allequal(dataset["A"][:], dataset["B"][:])
+
+    source = """
+        A = EEMSRead(InFileName = "input.nc", InFieldName = "elevation", Rows = [0, 5])
+        Out = EEMSWrite(
+            OutFileName = "out.nc",
+            OutFieldNames = [A],
+            DimensionFileName = "input.nc",
+            DimensionFieldName = "elevation",
+            Rows = [0, 5],
+            Append = True
+        )
+    """
+
+    program = Program.from_source(source, libraries=EEMS_NETCDF_LIBRARIES, working_dir=str(tmp_path))
+    with pytest.raises(DimensionMismatch) as exc_info:
+        program.run()
+    assert exc_info.value.lineno == 3
+
+
+@pytest.mark.parametrize("data_type", ["Float", "Integer"])
+def test_fill_value_round_trip(tmp_path, data_type):
+    from mpilot.program import Program, EEMS_NETCDF_LIBRARIES
+
+    shutil.copy(str(Path(__file__).parent / "data" / "netcdf_test.nc"), str(tmp_path / "input.nc"))
+
+    with Dataset(str(tmp_path / "input.nc"), "a") as dataset:
+        elevation = dataset["elevation"][:]
+        variable = dataset.createVariable("filled", "f4", dataset["elevation"].dimensions, fill_value=-9999)
+        variable[:] = numpy.ma.masked_greater(elevation, 2000)
+
+    source = """
+        Filled = EEMSRead(InFileName = "input.nc", InFieldName = "filled", DataType = {})
+        Out = EEMSWrite(
+            OutFileName = "out.nc", OutFieldNames = [Filled], DimensionFileName = "input.nc", DimensionFieldName = "filled"
+        )
+    """.format(data_type)
+
+    program = Program.from_source(source, libraries=EEMS_NETCDF_LIBRARIES, working_dir=str(tmp_path))
+    program.run()
+
+    with Dataset(str(tmp_path / "out.nc")) as dataset:
+        variable = dataset["Filled"]
+        assert variable.getncattr("_FillValue") == (-9999 if data_type == "Float" else 999999)
+        assert numpy.array_equal(numpy.ma.getmaskarray(variable[:]), elevation > 2000)
+
+
+@pytest.fixture
+def variables_path(tmp_path):
+    path = str(tmp_path / "variables.nc")
+    rng = numpy.random.RandomState(0)
+
+    with Dataset(path, "w") as dataset:
+        dataset.createDimension("y", 23)
+        dataset.createDimension("x", 7)
+
+        values = rng.rand(23, 7) * 2 - 1
+        values[::5, ::2] = -9999
+
+        variable = dataset.createVariable("filled", "f8", ("y", "x"), fill_value=-9999, chunksizes=(4, 7))
+        variable[:] = numpy.ma.masked_equal(values, -9999)
+
+        variable = dataset.createVariable("unfilled", "f4", ("y", "x"))
+        variable[:] = rng.rand(23, 7)
+
+        variable = dataset.createVariable("wide", "f8", ("y", "x"))
+        variable[:] = values * 10
+
+        variable = dataset.createVariable("scaled", "i2", ("y", "x"), fill_value=-32768)
+        variable.scale_factor = 0.01
+        variable[:] = numpy.ma.masked_equal(values, -9999)
+
+        # Bytes from 0 to 255, stored as signed bytes
+        variable = dataset.createVariable("unsigned", "i1", ("y", "x"))
+        variable.setncattr("_Unsigned", "true")
+        variable.set_auto_maskandscale(False)
+        variable[:] = rng.randint(0, 256, (23, 7)).astype(numpy.uint8).view(numpy.int8)
+
+    return path
+
+
+@pytest.mark.parametrize("name", ["filled", "unfilled", "scaled", "unsigned"])
+@pytest.mark.parametrize("data_type", [numpy.float64, int])
+def test_read_variable(variables_path, monkeypatch, name, data_type):
+    from mpilot.libraries.eems.netcdf import io
+
+    # Read a few rows at a time
+    monkeypatch.setattr(io, "READ_CHUNK_BYTES", 100)
+
+    with Dataset(variables_path) as dataset:
+        expected = dataset[name][:]
+        index = (slice(3, 19), slice(1, 6))
+        data, mask = io.read_variable(dataset[name], index, numpy.dtype(data_type))
+
+    if data_type is int:
+        expected = numpy.ma.MaskedArray(numpy.rint(expected), expected.mask)
+
+    assert data.dtype == numpy.dtype(data_type)
+    result = numpy.ma.MaskedArray(data, mask)
+    assert numpy.array_equal(numpy.ma.getmaskarray(result), numpy.ma.getmaskarray(expected[index]))
+    assert numpy.ma.allclose(result, expected[index].astype(data_type))
+
+    # Masks are only created if there are missing values
+    assert (mask is numpy.ma.nomask) == (not numpy.ma.is_masked(expected[index]))
+
+    if name == "unsigned":
+        assert data.max() > 127
+
+
+def test_read_missing_value(variables_path):
+    result = EEMSRead("Read").execute(InFileName=variables_path, InFieldName="unfilled", MissingValue=0)
+    assert result.mask is numpy.ma.nomask
+
+    with Dataset(variables_path) as dataset:
+        missing_value = float(dataset["unfilled"][0, 0])
+
+    result = EEMSRead("Read").execute(InFileName=variables_path, InFieldName="unfilled", MissingValue=missing_value)
+    assert result.mask[0, 0]
+    assert numpy.ma.count_masked(result) == 1
+    assert result.data[0, 0] == result.fill_value
+
+
+def test_read_invalid_data(variables_path):
+    read = EEMSRead("Read")
+    read.arguments = [Argument("DataType", "Positive Float")]
+    with pytest.raises(InvalidPositiveData):
+        read.execute(InFileName=variables_path, InFieldName="filled", DataType=numpy.float64)
+
+    read.arguments = [Argument("DataType", "Fuzzy")]
+    result = read.execute(InFileName=variables_path, InFieldName="filled", DataType=numpy.float64)
+    assert result.min() >= -1 and result.max() <= 1
+
+    with pytest.raises(InvalidFuzzyData):
+        read.execute(InFileName=variables_path, InFieldName="wide", DataType=numpy.float64)
@@ -0,0 +1,92 @@
+import json
+import os
+
+import numpy
+import pytest
+
+from mpilot.executors import ProcessExecutor
+from mpilot.libraries.eems.exceptions import InvalidDataFile
+from mpilot.libraries.eems.npy.io import EEMSRead, EEMSWrite
+from mpilot.program import Program, EEMS_NPY_LIBRARIES
+from tests.utils import create_command_with_result
+
+MODEL = """
+    A = EEMSRead(InFileName = "input", InFieldName = "A")
+    B = EEMSRead(InFileName = "input", InFieldName = "B")
+    Total = Sum(InFieldNames = [A, B])
+    Out = EEMSWrite(OutFileName = "output", OutFieldNames = [A, Total])
+"""
+
+
+@pytest.fixture
+def arrays():
+    rng = numpy.random.RandomState(0)
+    return {
+        "A": numpy.ma.masked_array(rng.rand(5, 11) * 2 - 1, mask=rng.rand(5, 11) > 0.7),
+        "B": numpy.ma.masked_array(rng.rand(5, 11) * 2 - 1, mask=False),
+    }
+
+
+@pytest.fixture
+def npy_dir(tmp_path, arrays):
+    commands = [create_command_with_result(name, arr) for name, arr in sorted(arrays.items())]
+    EEMSWrite("Out").execute(OutFileName=str(tmp_path / "input"), OutFieldNames=commands)
+
+    return str(tmp_path)
+
+
+def test_write_read(npy_dir, arrays):
+    with open(os.path.join(npy_dir, "input", "manifest.json")) as f:
+        manifest = json.load(f)
+
+    assert manifest["fields"]["A"]["mask"] == "A.mask.npy"
+    assert manifest["fields"]["B"]["mask"] is None
+
+    for name, arr in arrays.items():
+        result = EEMSRead("Read").execute(InFileName=os.path.join(npy_dir, "input"), InFieldName=name)
+
+        # The data is mapped from the file, rather than copied
+        assert not result.data.flags.writeable
+        assert numpy.array_equal(result.mask, numpy.ma.getmaskarray(arr))
+        assert numpy.ma.allequal(result, arr)
+
+    with pytest.raises(InvalidDataFile):
+        EEMSRead("Read").execute(InFileName=os.path.join(npy_dir, "input"), InFieldName="C")
+
+
+@pytest.mark.parametrize("executor", [None, ProcessExecutor(2)])
+def test_tiled_write(npy_dir, executor):
+    program = Program.from_source(MODEL, libraries=EEMS_NPY_LIBRARIES, working_dir=npy_dir)
+    program.run()
+    expected = {name: program.commands[name].result for name in ("A", "Total")}
+
+    # Windows 3 columns wide share bytes of the packed mask
+    program = Program.from_source(MODEL, libraries=EEMS_NPY_LIBRARIES, working_dir=npy_dir)
+    program.run(executor=executor, tile_shape=(2, 3))
+
+    for name, arr in expected.items():
+        result = EEMSRead("Read").execute(InFileName=os.path.join(npy_dir, "output"), InFieldName=name)
+
+        assert numpy.array_equal(result.mask, arr.mask)
+        assert numpy.ma.allequal(result, arr)
+
+
+def test_cached_read(npy_dir, arrays, tmp_path):
+    from mpilot.cache import ResultCache
+
+    cache = ResultCache(str(tmp_path / "cache"))
+    program = Program.from_source(MODEL, libraries=EEMS_NPY_LIBRARIES, working_dir=npy_dir)
+    program.cache = cache
+    program.run()
+
+    # Rewriting the dataset changes its files, but not the path of its directory
+    commands = [create_command_with_result("A", arrays["A"] * 0.5), create_command_with_result("B", arrays["B"])]
+    EEMSWrite("Out").execute(OutFileName=os.path.join(npy_dir, "input"), OutFieldNames=commands)
+    later = os.stat(os.path.join(npy_dir, "input", "A.npy")).st_mtime + 10
+    os.utime(os.path.join(npy_dir, "input", "A.npy"), (later, later))
+
+    program = Program.from_source(MODEL, libraries=EEMS_NPY_LIBRARIES, working_dir=npy_dir)
+    program.cache = cache
+    program.run()
+
+    assert numpy.ma.allequal(program.commands["A"].result, arrays["A"] * 0.5)
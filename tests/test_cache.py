@@ -0,0 +1,95 @@
+import os
+
+import numpy
+import pytest
+
+from mpilot.cache import ResultCache
+from mpilot.executors import ProcessExecutor
+from mpilot.program import Program
+from .test_executors import EEMS_MODEL, eems_dir  # noqa: F401 (fixture)
+
+
+@pytest.fixture
+def executed(monkeypatch):
+    """ Records the result names of commands which are executed, rather than loaded from the cache """
+
+    names = []
+    program = Program()
+
+    for cls in set(program.command_library.values()):
+        def execute(self, __execute=cls.execute, **kwargs):
+            names.append(self.result_name)
+            return __execute(self, **kwargs)
+
+        monkeypatch.setattr(cls, "execute", execute)
+
+    return names
+
+
+def run_model(source, working_dir, cache, executor=None):
+    program = Program.from_source(source, working_dir=working_dir)
+    program.cache = cache
+    program.run(executor=executor)
+    return program
+
+
+@pytest.mark.parametrize("executor", [None, ProcessExecutor(2)])
+def test_cached_run(eems_dir, tmp_path, executed, executor):  # noqa: F811 (fixture)
+    cache = ResultCache(str(tmp_path / "cache"))
+
+    program = run_model(EEMS_MODEL, eems_dir, cache, executor)
+    assert len(os.listdir(cache.directory)) == 6
+    if executor is None:
+        assert sorted(executed) == ["A", "A_Fz", "B", "B_Fz", "Not", "Union"]
+
+    del executed[:]
+    cached = run_model(EEMS_MODEL, eems_dir, cache, executor)
+    assert executed == []
+
+    for name, command in program.commands.items():
+        assert numpy.ma.allequal(cached.commands[name].result, command.result)
+
+    # Only commands downstream of a changed argument are run again
+    source = EEMS_MODEL.replace("InFieldName = A, TrueThreshold = 10", "InFieldName = A, TrueThreshold = 9")
+    run_model(source, eems_dir, cache)
+    assert sorted(executed) == ["A_Fz", "Not", "Union"]
+
+
+def test_changed_input(eems_dir, tmp_path, executed):  # noqa: F811 (fixture)
+    cache = ResultCache(str(tmp_path / "cache"))
+    run_model(EEMS_MODEL, eems_dir, cache)
+
+    with open(os.path.join(eems_dir, "input.csv"), "a") as f:
+        f.write("1,1\n")
+
+    del executed[:]
+    program = run_model(EEMS_MODEL, eems_dir, cache)
+    assert len(executed) == 6
+    assert program.commands["Not"].result.shape == (6,)
+
+
+def test_side_effects_not_cached(eems_dir, tmp_path, executed):  # noqa: F811 (fixture)
+    source = EEMS_MODEL + '    Out = EEMSWrite(OutFileName = "out.csv", OutFieldNames = [Not])\n'
+    cache = ResultCache(str(tmp_path / "cache"))
+
+    run_model(source, eems_dir, cache)
+    del executed[:]
+    run_model(source, eems_dir, cache)
+
+    assert executed == ["Out"]
+
+
+def test_eviction(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+
+    for i in range(3):
+        cache.store("key{}".format(i), numpy.zeros(1000))
+        os.utime(cache.get_path("key{}".format(i)), (i, i))
+
+    cache.load("key0")
+    cache.evict(2 * os.path.getsize(cache.get_path("key0")))
+
+    assert numpy.array_equal(cache.load("key0"), numpy.zeros(1000))
+    assert numpy.array_equal(cache.load("key2"), numpy.zeros(1000))
+    with pytest.raises(KeyError):
+        cache.load("key1")
@@ -0,0 +1,351 @@
+import sys
+import threading
+
+import numpy
+import pytest
+
+from mpilot import params
+from mpilot.commands import Command
+from mpilot.exceptions import RecursiveModelStructure, UnexpectedError, ResultDoesNotExist
+from mpilot.executors import (
+    Executor,
+    ThreadExecutor,
+    ProcessExecutor,
+    memory_order,
+    topological_sort,
+    share_array,
+    attach_array,
+)
+from mpilot.program import Program, EEMS_CSV_LIBRARIES
+from mpilot.utils import result_nbytes
+
+EEMS_MODEL = """
+    A = EEMSRead(InFileName = "input.csv", InFieldName = "A")
+    B = EEMSRead(InFileName = "input.csv", InFieldName = "B")
+    A_Fz = CvtToFuzzy(InFieldName = A, TrueThreshold = 10, FalseThreshold = 2)
+    B_Fz = CvtToFuzzy(InFieldName = B, TrueThreshold = 10, FalseThreshold = 2)
+    Union = FuzzyUnion(InFieldNames = [A_Fz, B_Fz])
+    Not = FuzzyNot(InFieldName = Union)
+"""
+
+
+class BarrierCommand(Command):
+    """ Waits for another BarrierCommand to run at the same time """
+
+    inputs = {}
+    output = params.NumberParameter()
+    barrier = threading.Barrier(2, timeout=5)
+
+    def execute(self, **kwargs):
+        return self.barrier.wait()
+
+
+class SignalRead(Command):
+    """ Signals that it has started, and returns the name of the thread it ran in """
+
+    prefetchable = True
+    inputs = {}
+    output = params.StringParameter()
+    started = threading.Event()
+
+    def execute(self, **kwargs):
+        self.started.set()
+        return threading.current_thread().name
+
+
+class WaitForRead(Command):
+    """ Waits for a SignalRead to start, and returns whether it did """
+
+    inputs = {"In": params.ResultParameter(params.NumberParameter())}
+    output = params.BooleanParameter()
+
+    def execute(self, **kwargs):
+        return SignalRead.started.wait(timeout=0.5)
+
+
+class CopyNumber(Command):
+    inputs = {"In": params.ResultParameter(params.NumberParameter())}
+    output = params.NumberParameter()
+
+    def execute(self, **kwargs):
+        return kwargs["In"].result
+
+
+class ConstantNumber(Command):
+    inputs = {"Value": params.NumberParameter()}
+    output = params.NumberParameter()
+
+    def execute(self, **kwargs):
+        return kwargs["Value"]
+
+
+@pytest.fixture
+def eems_dir(tmp_path):
+    (tmp_path / "input.csv").write_text("A,B\n10,5\n8,2\n7,3\n5,10\n2,8\n")
+    return str(tmp_path)
+
+
+def test_topological_sort():
+    dependencies = {"C": ["A", "B"], "A": [], "B": ["A"], "D": []}
+    assert topological_sort(dependencies) == ["A", "B", "C", "D"]
+
+
+def test_topological_sort_loop():
+    with pytest.raises(RecursiveModelStructure):
+        topological_sort({"A": ["B"], "B": ["A"]})
+
+
+def test_recursive_model():
+    source = """
+        A = CopyNumber(In = B)
+        B = CopyNumber(In = A)
+    """
+    program = Program.from_source(source, libraries=EEMS_CSV_LIBRARIES + ("tests",))
+
+    with pytest.raises(RecursiveModelStructure) as exc:
+        program.run()
+    assert exc.value.lineno == 2
+
+
+def test_dependencies(eems_dir):
+    program = Program.from_source(EEMS_MODEL, working_dir=eems_dir)
+    dependencies = program.get_dependencies()
+
+    assert dependencies["A"] == []
+    assert dependencies["A_Fz"] == ["A"]
+    assert dependencies["Union"] == ["A_Fz", "B_Fz"]
+
+
+def test_threaded_run(eems_dir):
+    serial = Program.from_source(EEMS_MODEL, working_dir=eems_dir)
+    serial.run()
+
+    threaded = Program.from_source(EEMS_MODEL, working_dir=eems_dir)
+    threaded.run(jobs=4)
+
+    for name, command in serial.commands.items():
+        assert threaded.commands[name].is_finished
+        assert numpy.ma.allequal(threaded.commands[name].result, command.result)
+
+
+def test_run_targets(eems_dir):
+    program = Program.from_source(EEMS_MODEL, working_dir=eems_dir)
+    program.run(targets=["A_Fz"])
+
+    assert program.commands["A"].is_finished
+    assert program.commands["A_Fz"].is_finished
+    assert not any(program.commands[name].is_finished for name in ("B", "B_Fz", "Union", "Not"))
+
+    with pytest.raises(ResultDoesNotExist):
+        program.run(targets=["C"])
+
+
+def test_default_targets(eems_dir):
+    source = EEMS_MODEL + '    Out = EEMSWrite(OutFileName = "out.csv", OutFieldNames = [A_Fz, Union])\n'
+    program = Program.from_source(source, working_dir=eems_dir)
+
+    assert program.get_targets() == ["Out"]
+    program.run()
+
+    assert program.commands["Out"].is_finished
+    assert program.commands["Union"].is_finished
+    assert not program.commands["Not"].is_finished
+
+
+def test_deep_chain():
+    depth = sys.getrecursionlimit() * 2
+    program = Program(libraries=EEMS_CSV_LIBRARIES + ("tests",))
+    program.add_command(ConstantNumber, "N0", {"Value": 7})
+    for i in range(1, depth):
+        program.add_command(CopyNumber, "N{}".format(i), {"In": "N{}".format(i - 1)})
+
+    program.run(release_results=True)
+    assert program.commands["N{}".format(depth - 1)].result == 7
+
+    # Released results are computed again without recursing through each upstream result
+    assert not program.commands["N{}".format(depth // 2)].is_finished
+    assert program.commands["N{}".format(depth // 2)].result == 7
+
+
+def test_result_runs_upstream(eems_dir):
+    source = EEMS_MODEL + '    Missing = EEMSRead(InFileName = "missing.csv", InFieldName = "A")\n'
+    program = Program.from_source(source, working_dir=eems_dir)
+    resource = program.get_resource("resource", object)
+
+    # Only the commands the result depends on are validated and run, and the program's resources are kept
+    assert program.commands["A_Fz"].result.shape == (5,)
+    assert program.commands["A"].is_finished
+    assert not program.commands["B"].is_finished
+    assert not program.commands["Missing"].is_finished
+    assert program.plan is None
+    assert program.get_resource("resource", object) is resource
+
+    program.add_command(CopyNumber, "X", {"In": "Y"})
+    program.add_command(CopyNumber, "Y", {"In": "X"})
+
+    with pytest.raises(RecursiveModelStructure):
+        program.commands["X"].result
+
+
+def test_threaded_run_is_concurrent():
+    source = """
+        A = BarrierCommand()
+        B = BarrierCommand()
+    """
+    program = Program.from_source(source, libraries=EEMS_CSV_LIBRARIES + ("tests",))
+    program.run(executor=ThreadExecutor(2))
+
+    assert {program.commands["A"].result, program.commands["B"].result} == {0, 1}
+
+
+def test_process_run(eems_dir):
+    serial = Program.from_source(EEMS_MODEL, working_dir=eems_dir)
+    serial.run()
+
+    program = Program.from_source(EEMS_MODEL, working_dir=eems_dir)
+    program.run(executor=ProcessExecutor(2))
+
+    for name, command in serial.commands.items():
+        result = program.commands[name].result
+        assert isinstance(result, numpy.ma.MaskedArray)
+        assert numpy.ma.allequal(result, command.result)
+
+
+def test_process_run_error():
+    source = """
+        A = SimpleCommand(A=Test, B=3, C=[1,2,3])
+        B = BrokenCommand()
+    """
+    program = Program.from_source(source, libraries=EEMS_CSV_LIBRARIES + ("tests",))
+
+    with pytest.raises(UnexpectedError) as exc:
+        program.run(executor=ProcessExecutor(2))
+    assert exc.value.lineno == 3
+    assert "ZeroDivisionError" in str(exc.value)
+
+
+def test_shared_array():
+    arr = numpy.ma.masked_array([1.5, 2.5, 3.5], mask=[False, True, False], fill_value=-1)
+    value, segments = share_array(arr)
+
+    try:
+        shared, attached = attach_array(value)
+        assert shared.fill_value == -1
+        assert shared.mask.tolist() == [False, True, False]
+        assert numpy.ma.allequal(shared, arr)
+        del shared
+    finally:
+        for segment in segments + attached:
+            segment.close()
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+
+
+@pytest.mark.parametrize("executor", [None, ThreadExecutor(2), ProcessExecutor(2)])
+def test_release_results(eems_dir, executor):
+    program = Program.from_source(EEMS_MODEL, working_dir=eems_dir)
+    program.pinned.add("A_Fz")
+    program.run(executor=executor, release_results=True)
+
+    for name in ("A", "B", "B_Fz", "Union"):
+        assert not program.commands[name].is_finished
+        assert program.commands[name]._result is None
+
+    assert program.commands["A_Fz"].is_finished
+    assert program.commands["Not"].is_finished
+
+    # Released results are computed again when accessed
+    assert numpy.ma.allclose(program.commands["Union"].result, [0.375, -0.25, -0.25, 0.375, -0.25])
+
+
+def test_memory_order():
+    # The deeper branch (C) is evaluated first, so only one of its results needs to be held while B is evaluated
+    dependencies = {
+        "A": [],
+        "B": ["A"],
+        "C1": [],
+        "C2": [],
+        "C3": ["C1", "C2"],
+        "C": ["C3", "A"],
+        "D": ["B", "C"],
+    }
+    order = memory_order(dependencies)
+
+    assert order == ["C1", "C2", "C3", "A", "C", "B", "D"]
+    assert topological_sort(dict((name, dependencies[name]) for name in order)) == order
+
+
+TREE_MODEL = "\n".join(
+    ["R{0} = EEMSRead(InFileName = \"input.csv\", InFieldName = \"A\")".format(i) for i in range(4)]
+    + ["F{0} = CvtToFuzzy(InFieldName = R{0}, TrueThreshold = 10, FalseThreshold = 2)".format(i) for i in range(4)]
+    + [
+        "U1 = FuzzyUnion(InFieldNames = [F0, F1])",
+        "U2 = FuzzyUnion(InFieldNames = [F2, F3])",
+        "U = FuzzyUnion(InFieldNames = [U1, U2])",
+    ]
+)
+
+
+def test_memory_order_peak(eems_dir):
+    program = Program.from_source(TREE_MODEL, working_dir=eems_dir)
+    dependencies = program.get_dependencies()
+
+    # Program order reads every input before converting any of them
+    executor = Executor()
+    executor.run(program, list(dependencies), dependencies, release_results=True)
+    item_size = result_nbytes(program.commands["U"].result)
+    assert executor.peak_bytes == 5 * item_size
+
+    for command in program.commands.values():
+        command.release()
+
+    executor = Executor()
+    executor.run(program, memory_order(dependencies), dependencies, release_results=True)
+    assert executor.peak_bytes == 4 * item_size
+
+
+def test_memory_budget(eems_dir):
+    running = []
+    peak = []
+
+    class TrackingExecutor(ThreadExecutor):
+        def submit(self, command):
+            running.append(command.result_name)
+            peak.append(len(running))
+            return super(TrackingExecutor, self).submit(command)
+
+        def complete(self, command, value):
+            running.remove(command.result_name)
+
+    program = Program.from_source(TREE_MODEL, working_dir=eems_dir)
+    program.run(executor=TrackingExecutor(4), release_results=True, memory_budget=1)
+
+    assert max(peak) == 1
+    assert program.commands["U"].result.shape == (5,)
+
+
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_prefetch(prefetch):
+    source = """
+        A = ConstantNumber(Value = 1)
+        Wait = WaitForRead(In = A)
+        Read = SignalRead()
+    """
+    program = Program.from_source(source, libraries=EEMS_CSV_LIBRARIES + ("tests",))
+    dependencies = program.get_dependencies()
+    SignalRead.started.clear()
+
+    # The read comes last, so it only runs while the other commands do if it's prefetched
+    Executor().run(program, ["A", "Wait", "Read"], dependencies, prefetch=prefetch)
+
+    assert program.commands["Wait"].result is bool(prefetch)
+    assert (program.commands["Read"].result == threading.current_thread().name) is not bool(prefetch)
+
+
+def test_prefetch_eems(eems_dir):
+    program = Program.from_source(EEMS_MODEL, working_dir=eems_dir)
+    program.run(prefetch=2, release_results=True)
+
+    assert program.commands["Not"].result.shape == (5,)
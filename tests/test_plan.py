@@ -0,0 +1,165 @@
+import pickle
+
+import numpy
+import pytest
+
+from mpilot import params
+from mpilot.exceptions import ResultDoesNotExist, PathDoesNotExist, NoSuchParameter, RecursiveModelStructure
+from mpilot.program import Program
+from .test_cache import executed  # noqa: F401 (fixture)
+from .test_executors import EEMS_MODEL, TREE_MODEL, eems_dir  # noqa: F401 (fixture)
+
+
+def test_compile(eems_dir):  # noqa: F811 (fixture)
+    program = Program.from_source(EEMS_MODEL, working_dir=eems_dir)
+    plan = program.compile()
+
+    assert program.plan is plan
+    assert plan.order[-1] == "Not"
+    assert plan.dependencies["Union"] == ("A_Fz", "B_Fz")
+    assert plan.params["A_Fz"]["InFieldName"] is program.commands["A"]
+    assert plan.params["A_Fz"]["TrueThreshold"] == 10
+
+    with pytest.raises(TypeError):
+        plan.params["A_Fz"]["TrueThreshold"] = 5
+
+    order, dependencies = plan.select(["A_Fz"])
+    assert order == ["A", "A_Fz"]
+    assert list(dependencies) == ["A", "A_Fz"]
+
+    with pytest.raises(ResultDoesNotExist):
+        plan.select(["C"])
+
+    copied = pickle.loads(pickle.dumps(plan))
+    assert copied.order == plan.order
+    assert copied.dependencies == plan.dependencies
+
+
+def test_compile_invalid(eems_dir):  # noqa: F811 (fixture)
+    program = Program.from_source('A = EEMSRead(InFileName = "missing.csv", InFieldName = "A")', working_dir=eems_dir)
+
+    with pytest.raises(PathDoesNotExist) as exc:
+        program.compile()
+    assert exc.value.lineno == 1
+
+
+def test_run_reuses_plan(eems_dir, monkeypatch):  # noqa: F811 (fixture)
+    program = Program.from_source(EEMS_MODEL, working_dir=eems_dir)
+    program.compile()
+
+    cleaned = []
+    clean = params.PathParameter.clean
+
+    def count_clean(self, *args, **kwargs):
+        cleaned.append(args[0])
+        return clean(self, *args, **kwargs)
+
+    monkeypatch.setattr(params.PathParameter, "clean", count_clean)
+
+    for _ in range(2):
+        program.run()
+        for command in program.commands.values():
+            command.release()
+
+    assert cleaned == []
+    assert program.commands["Not"].result.shape == (5,)
+
+    # Adding a command discards the plan
+    program.add_command(program.find_command_class("FuzzyNot"), "Not2", {"InFieldName": "Not"})
+    assert program.plan is None
+
+
+def test_update_argument(eems_dir, executed):  # noqa: F811 (fixture)
+    program = Program.from_source(EEMS_MODEL, working_dir=eems_dir)
+    program.run()
+    b_fz = program.commands["B_Fz"].result
+    before = program.commands["Not"].result.copy()
+
+    del executed[:]
+    program.update_argument("A_Fz", "TrueThreshold", 9)
+    assert program.dirty == {"A_Fz", "Union", "Not"}
+    assert not program.commands["Not"].is_finished
+    assert program.commands["B_Fz"].is_finished
+
+    program.rerun()
+    assert sorted(executed) == ["A_Fz", "Not", "Union"]
+    assert program.dirty == set()
+    assert program.commands["B_Fz"].result is b_fz
+
+    expected = Program.from_source(
+        EEMS_MODEL.replace("InFieldName = A, TrueThreshold = 10", "InFieldName = A, TrueThreshold = 9"),
+        working_dir=eems_dir,
+    )
+    assert numpy.ma.allequal(program.commands["Not"].result, expected.commands["Not"].result)
+    assert not numpy.ma.allequal(program.commands["Not"].result, before)
+
+    # The plan is updated without cleaning other arguments, or reordering commands when their order still works
+    plan = program.plan
+    program.update_argument("Union", "InFieldNames", ["A_Fz"])
+    assert program.plan.order is plan.order
+    assert program.plan.dependencies["Union"] == ("A_Fz",)
+    assert program.plan.params["B_Fz"] == plan.params["B_Fz"]
+    program.rerun()
+
+    with pytest.raises(RecursiveModelStructure):
+        program.update_argument("Union", "InFieldNames", ["A_Fz", "Not"])
+    assert program.plan.dependencies["Union"] == ("A_Fz",)
+
+    # Invalid arguments are rejected without discarding anything
+    with pytest.raises(NoSuchParameter):
+        program.update_argument("A_Fz", "Threshold", 9)
+    with pytest.raises(ResultDoesNotExist):
+        program.update_argument("C", "TrueThreshold", 9)
+    with pytest.raises(PathDoesNotExist):
+        program.update_argument("A", "InFileName", "missing.csv")
+    assert all(command.is_finished for command in program.commands.values())
+
+
+def test_merge_duplicates(eems_dir, executed):  # noqa: F811 (fixture)
+    expected = Program.from_source(TREE_MODEL, working_dir=eems_dir)
+    expected.run()
+
+    program = Program.from_source(TREE_MODEL, working_dir=eems_dir)
+    program.merge_duplicates = True
+    plan = program.compile()
+
+    assert plan.aliases == {
+        "R1": "R0",
+        "R2": "R0",
+        "R3": "R0",
+        "F1": "F0",
+        "F2": "F0",
+        "F3": "F0",
+        "U2": "U1",
+    }
+    assert plan.dependencies["U2"] == ("U1",)
+
+    del executed[:]
+    program.run()
+    assert sorted(executed) == ["F0", "R0", "U", "U1"]
+    assert program.commands["F3"].result is program.commands["F0"].result
+    assert numpy.ma.allequal(program.commands["U"].result, expected.commands["U"].result)
+
+    # Commands which no longer match after an edit are computed separately
+    program.update_argument("F2", "TrueThreshold", 9)
+    assert program.plan.aliases["F3"] == "F0"
+    assert "F2" not in program.plan.aliases
+    assert "U2" not in program.plan.aliases
+
+    # Commands which were merged into another are computed again once they no longer match it
+    assert program.dirty == {"F2", "U2", "U"}
+    program.rerun()
+
+    expected = Program.from_source(TREE_MODEL, working_dir=eems_dir)
+    expected.update_argument("F2", "TrueThreshold", 9)
+    expected.run()
+
+    for name in ("F2", "U2", "U"):
+        assert numpy.ma.allclose(program.commands[name].result, expected.commands[name].result)
+    assert program.commands["U2"].result is not program.commands["U1"].result
+
+    # ...and share its result again once they match it
+    program.update_argument("F2", "TrueThreshold", 10)
+    assert program.dirty == {"F2", "U2", "U"}
+    program.rerun()
+    assert program.commands["U2"].result is program.commands["U1"].result
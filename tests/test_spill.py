@@ -0,0 +1,89 @@
+import mmap
+
+import numpy
+
+from mpilot.executors import Executor
+from mpilot.program import Program
+from mpilot.spill import SpillStore
+from .test_executors import TREE_MODEL, eems_dir  # noqa: F401 (fixture)
+
+
+def is_mapped(arr):
+    while arr is not None:
+        if isinstance(arr, (numpy.memmap, mmap.mmap)):
+            return True
+        arr = getattr(arr, "base", None)
+    return False
+
+
+def test_spill_masked_array(tmp_path):
+    store = SpillStore(str(tmp_path))
+    arr = numpy.ma.masked_array([1.0, 2.0, 3.0], mask=[False, True, False], fill_value=-1)
+
+    spilled = store.spill(arr)
+    store.close()
+
+    assert isinstance(spilled, numpy.ma.MaskedArray)
+    assert is_mapped(numpy.ma.getdata(spilled))
+    assert is_mapped(numpy.ma.getmask(spilled))
+    assert spilled.mask.tolist() == [False, True, False]
+    assert spilled.fill_value == -1
+    assert numpy.ma.allequal(spilled, arr)
+
+    # Spilled results can be modified without affecting anything else
+    spilled[0] = 10
+    assert spilled[0] == 10
+
+
+def test_spill_other_values():
+    store = SpillStore()
+    assert store.spill([1, 2]) == [1, 2]
+    assert store.spill(True) is True
+    store.close()
+
+
+def test_run_with_spilling(eems_dir, tmp_path):  # noqa: F811 (fixture)
+    expected = Program.from_source(TREE_MODEL, working_dir=eems_dir)
+    expected.run()
+
+    spilled = []
+
+    class SpillingExecutor(Executor):
+        def spill(self, command, store):
+            spilled.append(command.result_name)
+            super(SpillingExecutor, self).spill(command, store)
+
+    scratch_dir = tmp_path / "scratch"
+    scratch_dir.mkdir()
+
+    program = Program.from_source(TREE_MODEL, working_dir=eems_dir)
+    program.pinned.add("U1")
+    program.run(
+        executor=SpillingExecutor(), release_results=True, spill_limit=0, scratch_dir=str(scratch_dir)
+    )
+
+    assert "U1" in spilled
+    assert is_mapped(numpy.ma.getdata(program.commands["U1"]._result))
+    assert numpy.ma.allclose(program.commands["U"].result, expected.commands["U"].result)
+    assert not list(scratch_dir.iterdir())
+
+
+def test_spill_finished_results(eems_dir, tmp_path):  # noqa: F811 (fixture)
+    expected = Program.from_source(TREE_MODEL, working_dir=eems_dir)
+    expected.run()
+
+    # Results finished by an earlier run can be spilled by a later one
+    program = Program.from_source(TREE_MODEL, working_dir=eems_dir)
+    program.run()
+    program.run(spill_limit=1, scratch_dir=str(tmp_path))
+    assert numpy.ma.allclose(program.commands["U"].result, expected.commands["U"].result)
+
+    program = Program.from_source(TREE_MODEL, working_dir=eems_dir)
+    program.run()
+    program.update_argument("F2", "TrueThreshold", 9)
+    program.rerun(spill_limit=1, scratch_dir=str(tmp_path))
+
+    expected = Program.from_source(TREE_MODEL, working_dir=eems_dir)
+    expected.update_argument("F2", "TrueThreshold", 9)
+    expected.run()
+    assert numpy.ma.allclose(program.commands["U"].result, expected.commands["U"].result)
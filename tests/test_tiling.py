@@ -0,0 +1,100 @@
+import shutil
+from pathlib import Path
+
+import numpy
+import pytest
+from netCDF4 import Dataset
+
+from mpilot.exceptions import TilingNotSupported
+from mpilot.executors import ThreadExecutor, ProcessExecutor
+from mpilot.program import Program, EEMS_NETCDF_LIBRARIES
+from mpilot.tiling import Statistics, iter_windows
+from .test_executors import EEMS_MODEL, eems_dir  # noqa: F401 (fixture)
+
+NETCDF_MODEL = """
+    Elev = EEMSRead(InFileName = "input.nc", InFieldName = "elevation")
+    Norm = Normalize(InFieldName = Elev)
+    ZFz = CvtToFuzzyZScore(InFieldName = Elev, TrueThresholdZScore = 1, FalseThresholdZScore = -1)
+    Fz = CvtToFuzzy(InFieldName = Elev)
+    Mid = CvtToFuzzyMeanToMid(InFieldName = Norm, IgnoreZeros = True, FuzzyValues = [-1, -0.5, 0, 0.5, 1])
+    Union = FuzzyUnion(InFieldNames = [ZFz, Fz, Mid])
+    Out = EEMSWrite(
+        OutFileName = "{}",
+        OutFieldNames = [Norm, Union],
+        DimensionFileName = "input.nc",
+        DimensionFieldName = "elevation"
+    )
+"""
+
+
+@pytest.fixture
+def netcdf_dir(tmp_path):
+    shutil.copy(str(Path(__file__).parent / "eems" / "data" / "netcdf_test.nc"), str(tmp_path / "input.nc"))
+    return str(tmp_path)
+
+
+def test_iter_windows():
+    windows = list(iter_windows((5, 7), (2, 4)))
+
+    assert len(windows) == 6
+    assert windows[0] == (Ellipsis, slice(0, 2), slice(0, 4))
+    assert windows[-1] == (Ellipsis, slice(4, 5), slice(4, 7))
+
+    arr = numpy.zeros((3, 5, 7))
+    for window in windows:
+        arr[window] += 1
+    assert (arr == 1).all()
+
+
+def test_combine_statistics():
+    arr = numpy.ma.masked_array(numpy.random.rand(40) * 100, mask=numpy.random.rand(40) > 0.8)
+
+    statistics = Statistics()
+    for i in range(0, 40, 7):
+        statistics = statistics.combine(Statistics.from_array(arr[i : i + 7]))
+
+    assert statistics.count == arr.count()
+    assert statistics.minimum == arr.min()
+    assert statistics.maximum == arr.max()
+    assert statistics.mean == pytest.approx(arr.mean())
+    assert statistics.std == pytest.approx(arr.std())
+
+
+@pytest.mark.parametrize("executor", [None, ThreadExecutor(4), ProcessExecutor(3)])
+def test_tiled_run(netcdf_dir, executor):
+    Program.from_source(
+        NETCDF_MODEL.format("whole.nc"), libraries=EEMS_NETCDF_LIBRARIES, working_dir=netcdf_dir
+    ).run()
+
+    program = Program.from_source(
+        NETCDF_MODEL.format("tiled.nc"), libraries=EEMS_NETCDF_LIBRARIES, working_dir=netcdf_dir
+    )
+    program.run(executor=executor, release_results=True, tile_shape=(4, 5))
+
+    assert program.window is None
+    assert program.commands["Norm"].statistics is None
+
+    with Dataset(str(Path(netcdf_dir) / "whole.nc")) as whole, Dataset(str(Path(netcdf_dir) / "tiled.nc")) as tiled:
+        for name in ("Norm", "Union"):
+            assert tiled[name].shape == (11, 17)
+            assert numpy.ma.allclose(tiled[name][:], whole[name][:])
+
+
+def test_tiled_run_unsupported(eems_dir):  # noqa: F811 (fixture)
+    program = Program.from_source(EEMS_MODEL, working_dir=eems_dir)
+
+    with pytest.raises(TilingNotSupported) as exc:
+        program.run(tile_shape=(2,))
+    assert exc.value.lineno == 2
+
+
+def test_tiled_print_unsupported(netcdf_dir):
+    source = NETCDF_MODEL.format("tiled.nc") + '    Print = PrintVars(InFieldNames = [Norm], OutFileName = "print.txt")\n'
+    program = Program.from_source(source, libraries=EEMS_NETCDF_LIBRARIES, working_dir=netcdf_dir)
+
+    # Nothing is run, since printed results would only hold one window
+    with pytest.raises(TilingNotSupported) as exc:
+        program.run(tile_shape=(4, 5))
+    assert exc.value.lineno == 14
+    assert not (Path(netcdf_dir) / "tiled.nc").exists()
+    assert not (Path(netcdf_dir) / "print.txt").exists()
@@ -0,0 +1,105 @@
+import os
+import threading
+
+import numpy
+import pytest
+
+from mpilot.exceptions import UnexpectedError
+from mpilot.program import Program, EEMS_CSV_LIBRARIES
+from mpilot.writer import BackgroundWriter
+from tests.utils import create_command_with_result
+
+MODEL = """
+    A = EEMSRead(InFileName = "input.csv", InFieldName = "A")
+    B = EEMSRead(InFileName = "input.csv", InFieldName = "B")
+    Total = Sum(InFieldNames = [A, B])
+    OutA = EEMSWrite(OutFileName = "{}", OutFieldNames = [A, Total])
+    OutB = EEMSWrite(OutFileName = "out_b.csv", OutFieldNames = [B])
+"""
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    with open(str(tmp_path / "input.csv"), "w") as f:
+        f.write("A,B\n")
+        f.writelines("{},{}\n".format(i, i * 2) for i in range(100))
+
+    return str(tmp_path)
+
+
+def test_writes_in_order():
+    command = create_command_with_result("Out", True)
+    writer = BackgroundWriter(max_bytes=100)
+    written = []
+    started = threading.Event()
+    finish = threading.Event()
+
+    def first():
+        started.set()
+        finish.wait()
+        written.append(1)
+
+    writer.submit(command, first, nbytes=80)
+    started.wait()
+
+    # The second write would exceed the limit, so it waits for the first to finish
+    submitted = threading.Event()
+    thread = threading.Thread(
+        target=lambda: (writer.submit(command, lambda: written.append(2), nbytes=80), submitted.set())
+    )
+    thread.start()
+
+    assert not submitted.wait(0.1)
+    finish.set()
+    thread.join()
+
+    writer.drain()
+    writer.close()
+
+    assert written == [1, 2]
+    assert writer.pending_bytes == 0
+
+
+def test_write_behind(model_dir):
+    program = Program.from_source(MODEL.format("out_a.csv"), libraries=EEMS_CSV_LIBRARIES, working_dir=model_dir)
+    program.run(write_behind=1024)
+
+    assert program.writer is None
+
+    with open(os.path.join(model_dir, "out_a.csv")) as f:
+        lines = f.read().splitlines()
+
+    assert lines[0] == "A,Total"
+    assert lines[1:] == ["{},{}".format(float(i), float(i * 3)) for i in range(100)]
+    assert os.path.exists(os.path.join(model_dir, "out_b.csv"))
+
+
+def test_write_behind_error(model_dir):
+    program = Program.from_source(
+        MODEL.format("missing/out_a.csv"), libraries=EEMS_CSV_LIBRARIES, working_dir=model_dir
+    )
+
+    with pytest.raises(UnexpectedError) as exc_info:
+        program.run(write_behind=1024)
+
+    assert exc_info.value.lineno == program.commands["OutA"].lineno
+    assert isinstance(exc_info.value.__cause__, (IOError, OSError))
+    assert program.writer is None
+
+
+def test_submit_after_error():
+    command = create_command_with_result("Out", numpy.zeros(10))
+    writer = BackgroundWriter(max_bytes=100)
+
+    def fail():
+        raise ValueError("Failed")
+
+    writer.submit(command, fail)
+
+    with pytest.raises(UnexpectedError):
+        writer.drain()
+
+    with pytest.raises(UnexpectedError):
+        writer.submit(command, lambda: None)
+
+    writer.close()